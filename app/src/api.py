@@ -0,0 +1,378 @@
+import concurrent.futures
+import gzip
+import http.server
+import os
+import re
+import traceback
+from collections import defaultdict
+from typing import Any, Callable
+from urllib.parse import parse_qs, urlparse
+
+import orjson
+
+import tracing
+from engine import NoRouteError, Point, PointTypes, Route, find_route, snap_points
+from enums import BikeType
+from exporters import EXPORT_FORMATS, prepare_export
+from geo_utils import coordinates_from_geojson, cumulative_distance_m
+from map_updates import start_update_watcher
+from poi_suggester import suggest_pois
+from routing_workers import build_routes_multiple, get_routing_pool
+from simplify import EXPORT_PROFILES, display_geojson
+from tiles import TileError, UnknownTripError, register_trip, road_tile, route_tile
+from warmup import is_ready, start_warm_up
+
+DEFAULT_BIKE_TYPE = BikeType.trekking
+# responses smaller than this aren't worth compressing
+MIN_GZIP_SIZE = 1024
+MAX_BODY_SIZE = 64 * 1024 * 1024
+# a matrix of n points needs n * (n - 1) routes
+MAX_MATRIX_POINTS = 25
+TILE_PATH = re.compile(r"/tiles/(?:roads|routes/(?P<trip>[0-9a-f]+))/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf")
+# road tiles change only with map updates, tiles of a trip never
+ROAD_TILE_MAX_AGE_S = 3600
+ROUTE_TILE_MAX_AGE_S = 7 * 24 * 3600
+
+Json = dict[str, Any]
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class Response:
+    def __init__(
+        self,
+        body: bytes,
+        content_type: str = "application/json",
+        filename: str | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        self.body = body
+        self.content_type = content_type
+        self.filename = filename
+        self.headers = headers or {}
+
+
+def _parse_point(data: Json) -> Point:
+    try:
+        return Point(
+            lat=float(data["lat"]),
+            lon=float(data["lon"]),
+            short_desc=data.get("name") or "Default Point",
+            type=PointTypes(data["type"]) if data.get("type") else None,
+            osm_ref=data.get("osm_ref"),
+            category=data.get("category"),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise ApiError(400, f"Invalid point {data!r}: {e}") from e
+
+
+def _parse_bike_type(data: Json) -> BikeType:
+    try:
+        return BikeType(data.get("bike_type", DEFAULT_BIKE_TYPE.value))
+    except ValueError as e:
+        raise ApiError(400, f"Unknown bike type {data.get('bike_type')!r}") from e
+
+
+def _parse_route(data: Json) -> Route:
+    """Route from its GeoJSON geometry, e.g. one returned by the route endpoint."""
+    geojson = orjson.dumps(data.get("geometry"))
+    try:
+        coordinates = coordinates_from_geojson(geojson)
+    except (ValueError, KeyError, TypeError) as e:
+        raise ApiError(400, f"Invalid route geometry: {e}") from e
+    if len(coordinates) < 2:
+        raise ApiError(400, "Route geometry needs at least 2 coordinates")
+
+    start_lon, start_lat = coordinates[0].tolist()
+    end_lon, end_lat = coordinates[-1].tolist()
+    return Route(
+        start=Point(start_lat, start_lon),
+        end=Point(end_lat, end_lon),
+        geojson=geojson.decode(),
+        geom="",
+        length_m=float(data.get("length_m") or cumulative_distance_m(coordinates)[-1]),
+        length_m_road_types=data.get("length_m_road_types") or {},
+    )
+
+
+def _point_json(point: Point) -> Json:
+    return {
+        "lat": point.lat,
+        "lon": point.lon,
+        "name": point.short_desc,
+        "type": point.type.value if point.type is not None else None,
+        "osm_ref": point.osm_ref,
+        "category": point.category,
+    }
+
+
+def _route_json(route: Route, zoom: int | None = None) -> Json:
+    return {
+        "start": _point_json(route.start),
+        "end": _point_json(route.end),
+        "length_m": route.length_m,
+        "length_m_road_types": route.length_m_road_types,
+        # already serialized by the database, embed it as is
+        "geometry": orjson.Fragment(route.geojson if zoom is None else display_geojson(route, zoom)),
+    }
+
+
+def handle_snap(body: Json, query: dict[str, list[str]]) -> Json:
+    points = [_parse_point(point) for point in body.get("points", [])]
+    return {"points": [{"id": v.id, "lat": v.lat, "lon": v.lon} for v in snap_points(points)]}
+
+
+def _route_requests(requests: list[Json], zoom: int | None = None) -> list[Json]:
+    """Route a batch of requests, sharing one routing run for all requests with the same bike type."""
+    parsed = []
+    for request in requests:
+        segments = [[_parse_point(point) for point in segment] for segment in request.get("segments", [])]
+        if not segments or any(len(segment) < 2 for segment in segments):
+            raise ApiError(400, "Every request needs segments of at least 2 points")
+        parsed.append((segments, _parse_bike_type(request)))
+
+    results: list[Json] = [{} for _ in parsed]
+    by_bike_type: dict[BikeType, list[int]] = defaultdict(list)
+    for i, (_, bike_type) in enumerate(parsed):
+        by_bike_type[bike_type].append(i)
+
+    for bike_type, indices in by_bike_type.items():
+        try:
+            routed = build_routes_multiple([segment for i in indices for segment in parsed[i][0]], bike_type)
+        except NoRouteError as e:
+            if len(indices) == 1:
+                results[indices[0]] = {"error": str(e)}
+                continue
+            # find out which of the batched requests has no route, the others still get their routes
+            for i in indices:
+                try:
+                    routed = build_routes_multiple(parsed[i][0], bike_type)
+                    results[i] = {"segments": [[_route_json(route, zoom) for route in segment] for segment in routed]}
+                except NoRouteError as e:
+                    results[i] = {"error": str(e)}
+            continue
+
+        offset = 0
+        for i in indices:
+            count = len(parsed[i][0])
+            segments = routed[offset : offset + count]
+            results[i] = {"segments": [[_route_json(route, zoom) for route in segment] for segment in segments]}
+            offset += count
+
+    return results
+
+
+def handle_route(body: Json, query: dict[str, list[str]]) -> Json:
+    """Route a single request, or a batch of them given as "requests"."""
+    try:
+        # geometry simplified for drawing at a zoom level rather than the full one
+        zoom = int(query["zoom"][0]) if "zoom" in query else None
+    except ValueError as e:
+        raise ApiError(400, f"Invalid zoom level {query['zoom'][0]!r}") from e
+    if "requests" in body:
+        return {"results": _route_requests(body["requests"], zoom)}
+    result = _route_requests([body], zoom)[0]
+    if "error" in result:
+        raise ApiError(422, result["error"])
+    return result
+
+
+def handle_matrix(body: Json, query: dict[str, list[str]]) -> Json:
+    points = [_parse_point(point) for point in body.get("points", [])]
+    if len(points) > MAX_MATRIX_POINTS:
+        raise ApiError(400, f"At most {MAX_MATRIX_POINTS} points are supported")
+    bike_type = _parse_bike_type(body)
+
+    distances: list[list[float | None]] = [[0.0] * len(points) for _ in points]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        future_to_pair = {
+            executor.submit(find_route, points[i], points[j], bike_type): (i, j)
+            for i in range(len(points))
+            for j in range(len(points))
+            if i != j
+        }
+        for future in concurrent.futures.as_completed(future_to_pair):
+            i, j = future_to_pair[future]
+            try:
+                distances[i][j] = future.result().length_m
+            except NoRouteError:
+                distances[i][j] = None
+    return {"distances_m": distances}
+
+
+def handle_pois(body: Json, query: dict[str, list[str]]) -> Json:
+    routes = [_parse_route(route) for route in body.get("routes", [])]
+    return {"pois": [_point_json(poi) for poi in suggest_pois(routes)]}
+
+
+def handle_export(body: Json, query: dict[str, list[str]], format_name: str) -> Response:
+    if format_name not in EXPORT_FORMATS:
+        raise ApiError(404, f"Unknown export format {format_name!r}")
+    profile_name = query.get("profile", ["full"])[0]
+    if profile_name not in EXPORT_PROFILES:
+        raise ApiError(400, f"Unknown export profile {profile_name!r}")
+
+    export_format = EXPORT_FORMATS[format_name]
+    tracks = [[_parse_route(route) for route in track] for track in body.get("tracks", [])]
+    waypoints = [_parse_point(point) for point in body.get("waypoints", [])]
+    data = prepare_export(
+        tracks,
+        waypoints,
+        name=body.get("name", "Bike Route"),
+        profile=EXPORT_PROFILES[profile_name],
+        keep_points=waypoints,
+    )
+    return Response(
+        b"".join(export_format.write(data)),
+        content_type=export_format.mime_type,
+        filename=f"route.{export_format.extension}",
+    )
+
+
+def handle_register_trip(body: Json, query: dict[str, list[str]]) -> Json:
+    # geometries of the routes as returned by the route endpoint, one list of routes per segment
+    tracks = [[_parse_route(route).geojson for route in track] for track in body.get("tracks", [])]
+    if not any(tracks):
+        raise ApiError(400, "Trip needs at least one route")
+    return {"trip_id": register_trip(tracks)}
+
+
+def handle_tile(trip: str | None, z: int, x: int, y: int) -> Response:
+    try:
+        if trip is None:
+            tile, max_age_s = road_tile(z, x, y), ROAD_TILE_MAX_AGE_S
+        else:
+            tile, max_age_s = route_tile(trip, z, x, y), ROUTE_TILE_MAX_AGE_S
+    except UnknownTripError as e:
+        # not cached by the browser, the app registers the trip again
+        raise ApiError(404, str(e)) from e
+    except TileError as e:
+        raise ApiError(400, str(e)) from e
+    return Response(
+        tile,
+        content_type="application/vnd.mapbox-vector-tile",
+        # tiles are loaded by the map in the browser, from the page of the app
+        headers={"Cache-Control": f"public, max-age={max_age_s}", "Access-Control-Allow-Origin": "*"},
+    )
+
+
+POST_ENDPOINTS: dict[str, Callable[[Json, dict[str, list[str]]], Json]] = {
+    "/snap": handle_snap,
+    "/route": handle_route,
+    "/matrix": handle_matrix,
+    "/pois": handle_pois,
+    "/tiles/routes": handle_register_trip,
+}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # keep connections of mobile and batch clients open between requests
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status: int, response: Response) -> None:
+        body = response.body
+        compress = len(body) >= MIN_GZIP_SIZE and "gzip" in self.headers.get("Accept-Encoding", "")
+        if compress:
+            body = gzip.compress(body, compresslevel=5)
+
+        self.send_response(status)
+        self.send_header("Content-Type", response.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        if response.filename:
+            self.send_header("Content-Disposition", f'attachment; filename="{response.filename}"')
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data: Json) -> None:
+        self._send(status, Response(orjson.dumps(data)))
+
+    def _read_body(self) -> Json:
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_BODY_SIZE:
+            raise ApiError(413, "Request body too large")
+        raw = self.rfile.read(length) if length else b"{}"
+        if self.headers.get("Content-Encoding") == "gzip":
+            raw = gzip.decompress(raw)
+        try:
+            body = orjson.loads(raw)
+        except orjson.JSONDecodeError as e:
+            raise ApiError(400, f"Invalid JSON: {e}") from e
+        if not isinstance(body, dict):
+            raise ApiError(400, "Request body must be a JSON object")
+        return body
+
+    def _handle(self, handler: Callable[[], Json | Response]) -> None:
+        try:
+            with tracing.trace(f"{self.command} {urlparse(self.path).path}"):
+                result = handler()
+            if isinstance(result, Response):
+                self._send(200, result)
+            else:
+                self._send_json(200, result)
+        except ApiError as e:
+            self._send_json(e.status, {"error": str(e)})
+        except NoRouteError as e:
+            self._send_json(422, {"error": str(e)})
+        except Exception as e:
+            print(traceback.format_exc())
+            self._send_json(500, {"error": str(e)})
+
+    def do_GET(self) -> None:
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._handle(lambda: {"status": "ok"})
+        elif path == "/ready":
+            # healthchecks route traffic to this instance only once it's warmed up
+            if is_ready():
+                self._send_json(200, {"status": "ready"})
+            else:
+                self._send_json(503, {"status": "warming up"})
+        elif match := TILE_PATH.fullmatch(path):
+            self._handle(lambda: handle_tile(match["trip"], int(match["z"]), int(match["x"]), int(match["y"])))
+        elif path == "/formats":
+            self._handle(
+                lambda: {
+                    "formats": {name: f.label for name, f in EXPORT_FORMATS.items()},
+                    "profiles": {name: p.label for name, p in EXPORT_PROFILES.items()},
+                }
+            )
+        else:
+            self._send_json(404, {"error": f"Unknown endpoint {path}"})
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path in POST_ENDPOINTS:
+            self._handle(lambda: POST_ENDPOINTS[url.path](self._read_body(), query))
+        elif url.path.startswith("/export/"):
+            self._handle(lambda: handle_export(self._read_body(), query, url.path.removeprefix("/export/")))
+        else:
+            # the body has to be consumed to keep the connection usable
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self._send_json(404, {"error": f"Unknown endpoint {url.path}"})
+
+
+def main() -> None:
+    host = os.getenv("API_HOST", "0.0.0.0")
+    port = int(os.getenv("API_PORT", "8000"))
+    if os.getenv("ROUTING_EXECUTOR", "thread") == "process":
+        # workers are forked, start them before the server starts its threads
+        get_routing_pool()
+    start_update_watcher()
+    start_warm_up()
+    server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+    print(f"Routing API listening on {host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Plan many trips offline, reading trip requests from a JSONL file.
+
+Every input line is a JSON object like:
+
+    {"id": "warsaw-krakow", "points": [{"lat": 52.23, "lon": 21.01}, {"lat": 50.06, "lon": 19.94, "type": "sleep"}, ...],
+     "bike_type": "trekking", "fitness_level": "good", "daily_distance_km": 80}
+
+Points of type "sleep" split the trip into days, as in the visualizer. Results are written as they finish,
+one row per request, to a JSONL or Parquet file.
+
+Usage:
+    python batch_plan.py requests.jsonl results.jsonl --workers 8 --geometry
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import IO, Any, Iterator
+
+import orjson
+
+import tracing
+from engine import DbPoint, NoRouteError, Point, PointTypes, Route, snap_points
+from enums import BikeType, FitnessLevel, RoadType
+from exporters import EXPORT_FORMATS, prepare_export
+from helper import estimate_time_needed_s, merge_routes, split_route_by_sleeping_points
+from pipeline import suggest_places
+from routing_workers import get_routing_pool, iter_route_legs
+from simplify import EXPORT_PROFILES
+
+try:
+    import pyarrow as pa  # type: ignore[import-untyped]
+    import pyarrow.parquet as pq  # type: ignore[import-untyped]
+except ImportError:
+    # pyarrow is only needed for Parquet output
+    pa = pq = None
+
+DEFAULT_DAILY_DISTANCE_KM = 80.0
+# results are written to Parquet in row groups of this size
+PARQUET_BATCH_SIZE = 1000
+# snapped points and routed legs kept in memory by a batch, each
+ROUTE_CACHE_SIZE = int(os.getenv("BATCH_ROUTE_CACHE_SIZE", "100000"))
+
+Json = dict[str, Any]
+# snapped start vertex, snapped end vertex, bike type
+LegKey = tuple[int, int, BikeType]
+
+
+class TripRequest:
+    def __init__(self, data: Json) -> None:
+        self.id = str(data.get("id", ""))
+        self.points = [
+            Point(
+                lat=float(p["lat"]),
+                lon=float(p["lon"]),
+                short_desc=p.get("name") or "Default Point",
+                type=PointTypes(p["type"]) if p.get("type") else None,
+            )
+            for p in data["points"]
+        ]
+        if len(self.points) < 2:
+            raise ValueError("A trip needs at least 2 points")
+        self.bike_type = BikeType(data.get("bike_type", BikeType.trekking.value))
+        self.fitness_level = FitnessLevel(data.get("fitness_level", FitnessLevel.good.value))
+        if "daily_distance_m" in data:
+            self.daily_distance_m = float(data["daily_distance_m"])
+        else:
+            self.daily_distance_m = float(data.get("daily_distance_km", DEFAULT_DAILY_DISTANCE_KM)) * 1000
+
+
+class RouteCache:
+    """
+    Snapped vertices and routed legs shared by all requests of a batch.
+
+    Legs are keyed by the snapped vertices of their ends, so popular routes are only computed once
+    even if requests use slightly different coordinates for the same place. Both are evicted least recently used
+    first once there are more than `max_size` of them.
+    """
+
+    def __init__(self, max_size: int = ROUTE_CACHE_SIZE) -> None:
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._vertices: collections.OrderedDict[tuple[float, float], DbPoint] = collections.OrderedDict()
+        self._legs: collections.OrderedDict[LegKey, Route] = collections.OrderedDict()
+        self.leg_hits = 0
+        self.leg_misses = 0
+
+    def _get(self, entries: collections.OrderedDict, keys: list) -> dict:
+        """Cached entries of the keys, marked as recently used. Callers hold the lock."""
+        found = {}
+        for key in keys:
+            if key in entries:
+                entries.move_to_end(key)
+                found[key] = entries[key]
+        return found
+
+    def _put(self, entries: collections.OrderedDict, new: dict) -> None:
+        """Add entries, evicting the least recently used ones. Callers hold the lock."""
+        entries.update(new)
+        for key in new:
+            entries.move_to_end(key)
+        while len(entries) > self._max_size:
+            entries.popitem(last=False)
+
+    def snap(self, points: list[Point]) -> list[DbPoint]:
+        keys = [(p.lat, p.lon) for p in points]
+        with self._lock:
+            vertices = self._get(self._vertices, keys)
+        missing = list({(p.lat, p.lon): p for p in points if (p.lat, p.lon) not in vertices}.values())
+        if missing:
+            # all new points of a request are snapped in a single query
+            snapped = {(p.lat, p.lon): vertex for p, vertex in zip(missing, snap_points(missing))}
+            vertices.update(snapped)
+            with self._lock:
+                self._put(self._vertices, snapped)
+        return [vertices[key] for key in keys]
+
+    def route_segments(self, segments: list[list[Point]], bike_type: BikeType) -> list[list[Route]]:
+        """Route all legs of the segments, reusing cached legs and routing the rest in parallel."""
+        vertices = iter(self.snap([p for segment in segments for p in segment]))
+        vertex_ids = [[next(vertices).id for _ in segment] for segment in segments]
+        leg_keys = [[(start, end, bike_type) for start, end in itertools.pairwise(ids)] for ids in vertex_ids]
+
+        with self._lock:
+            cached = self._get(self._legs, [key for legs in leg_keys for key in legs])
+        to_route = {}
+        for segment, legs in zip(segments, leg_keys):
+            for (start, end), key in zip(itertools.pairwise(segment), legs):
+                if key not in cached and key not in to_route:
+                    to_route[key] = [start, end]
+
+        routed = dict(cached)
+        if to_route:
+            route_keys = list(to_route)
+            # the ends are snapped already, the legs are routed between their vertices
+            leg_vertex_ids = [[start, end] for start, end, _ in route_keys]
+            for segment_idx, _, route in iter_route_legs(list(to_route.values()), bike_type, leg_vertex_ids):
+                routed[route_keys[segment_idx]] = route
+            with self._lock:
+                self._put(self._legs, {key: routed[key] for key in to_route})
+        with self._lock:
+            self.leg_hits += sum(len(legs) for legs in leg_keys) - len(to_route)
+            self.leg_misses += len(to_route)
+
+        # cached legs may come from a request naming their ends differently
+        return [
+            [routed[key]._replace(start=start, end=end) for (start, end), key in zip(itertools.pairwise(segment), legs)]
+            for segment, legs in zip(segments, leg_keys)
+        ]
+
+
+def _summary(request: TripRequest, segment_routes: list[list[Route]]) -> Json:
+    length_m_road_types = {road_type.value: 0.0 for road_type in RoadType}
+    moving_time_s = 0
+    for route in (route for routes in segment_routes for route in routes):
+        for road_type, distance_m in route.length_m_road_types.items():
+            length_m_road_types[road_type] += distance_m
+            moving_time_s += estimate_time_needed_s(
+                distance_m=distance_m,
+                bike_type=request.bike_type,
+                road_type=RoadType(road_type),
+                fitness_level=request.fitness_level,
+            )
+    return {
+        "days": len(segment_routes),
+        "total_distance_m": sum(route.length_m for routes in segment_routes for route in routes),
+        "distance_by_day_m": [sum(route.length_m for route in routes) for routes in segment_routes],
+        "moving_time_s": moving_time_s,
+        "length_m_road_types": length_m_road_types,
+    }
+
+
+def plan_request(request: TripRequest, cache: RouteCache, args: argparse.Namespace) -> Json:
+    """Plan a single trip and describe it as an output row."""
+    segments = split_route_by_sleeping_points(request.points)
+    result: Json = {"id": request.id}
+
+    segment_routes = cache.route_segments(segments, request.bike_type)
+    if args.pois:
+        plan = suggest_places(segment_routes, request.daily_distance_m)
+        result["pois"] = [{"lat": p.lat, "lon": p.lon, "name": p.short_desc, "category": p.category} for p in plan.pois]
+        result["sleeping_places"] = [{"lat": p.lat, "lon": p.lon, "name": p.short_desc} for p in plan.sleeping_places]
+
+    result.update(_summary(request, segment_routes))
+    if args.geometry:
+        result["geometry"] = [orjson.loads(merge_routes(routes).geojson) for routes in segment_routes]
+    if args.export:
+        export_format = EXPORT_FORMATS[args.export]
+        waypoints = [point for point in request.points if point.type is not None]
+        data = prepare_export(
+            segment_routes, waypoints, name=request.id or "Bike Route", profile=EXPORT_PROFILES[args.profile]
+        )
+        content = b"".join(export_format.write(data))
+        # binary formats can't be embedded in a text column as they are
+        result["export"] = content.hex() if export_format.name == "fit" else content.decode("utf-8")
+    return result
+
+
+def _run_request(line: bytes, cache: RouteCache, args: argparse.Namespace) -> Json:
+    started = time.perf_counter()
+    request_id = ""
+    try:
+        data = orjson.loads(line)
+        request_id = str(data.get("id", ""))
+        with tracing.trace("batch_request", id=request_id):
+            result = plan_request(TripRequest(data), cache, args)
+        result["status"] = "ok"
+    except NoRouteError as e:
+        result = {"id": request_id, "status": "no_route", "error": str(e)}
+    except Exception as e:
+        print(traceback.format_exc(), file=sys.stderr)
+        result = {"id": request_id, "status": "error", "error": str(e)}
+    result["elapsed_s"] = time.perf_counter() - started
+    return result
+
+
+def _iter_lines(file: IO[bytes]) -> Iterator[bytes]:
+    for line in file:
+        if line.strip():
+            yield line
+
+
+class JsonlWriter:
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "wb")
+
+    def write(self, row: Json) -> None:
+        self._file.write(orjson.dumps(row) + b"\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ParquetWriter:
+    """Writes rows in row groups; nested values are stored as JSON strings so every batch has the same schema."""
+
+    _SCALAR_COLUMNS = {
+        "id": "string",
+        "status": "string",
+        "error": "string",
+        "elapsed_s": "float64",
+        "days": "int64",
+        "total_distance_m": "float64",
+        "moving_time_s": "int64",
+        "export": "string",
+    }
+    _JSON_COLUMNS = ["distance_by_day_m", "length_m_road_types", "geometry", "pois", "sleeping_places"]
+
+    def __init__(self, path: str) -> None:
+        if pa is None:
+            raise RuntimeError("Parquet output needs pyarrow, install it or write JSONL instead")
+        self._schema = pa.schema(
+            [(name, getattr(pa, type_name)()) for name, type_name in self._SCALAR_COLUMNS.items()]
+            + [(name, pa.string()) for name in self._JSON_COLUMNS]
+        )
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._rows: list[Json] = []
+
+    def write(self, row: Json) -> None:
+        self._rows.append(
+            {name: row.get(name) for name in self._SCALAR_COLUMNS}
+            | {name: orjson.dumps(row[name]).decode() if name in row else None for name in self._JSON_COLUMNS}
+        )
+        if len(self._rows) >= PARQUET_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._rows:
+            self._writer.write_table(pa.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+    def close(self) -> None:
+        self._flush()
+        self._writer.close()
+
+
+def run_batch(args: argparse.Namespace) -> None:
+    writer = ParquetWriter(args.output) if args.output.endswith(".parquet") else JsonlWriter(args.output)
+    cache = RouteCache()
+    if os.getenv("ROUTING_EXECUTOR", "thread") == "process":
+        # workers are forked, start them before the request threads
+        get_routing_pool()
+    started = time.perf_counter()
+    counts = {"ok": 0, "no_route": 0, "error": 0}
+
+    with open(args.input, "rb") as input_file, concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+        lines = _iter_lines(input_file)
+        # keep a bounded number of requests in flight, so huge input files are streamed
+        pending = {
+            executor.submit(_run_request, line, cache, args) for line in itertools.islice(lines, args.workers * 2)
+        }
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                counts[result["status"]] += 1
+                writer.write(result)
+            pending |= {executor.submit(_run_request, line, cache, args) for line in itertools.islice(lines, len(done))}
+
+    writer.close()
+    elapsed_s = time.perf_counter() - started
+    total = sum(counts.values())
+    print(
+        f"Planned {total} trips in {elapsed_s:.1f}s ({total / max(elapsed_s, 1e-9):.2f}/s): {counts}, "
+        f"leg cache hits {cache.leg_hits}, misses {cache.leg_misses}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Plan trips from a JSONL file of requests")
+    parser.add_argument("input", help="JSONL file with one trip request per line")
+    parser.add_argument("output", help="Output file, .parquet for Parquet, JSONL otherwise")
+    parser.add_argument("--workers", type=int, default=4, help="Number of trips planned concurrently")
+    parser.add_argument("--geometry", action="store_true", help="Include GeoJSON geometry of every day")
+    parser.add_argument("--export", choices=list(EXPORT_FORMATS), help="Include the trip exported in this format")
+    parser.add_argument("--profile", choices=list(EXPORT_PROFILES), default="full", help="Export profile")
+    parser.add_argument("--pois", action="store_true", help="Also suggest POIs and sleeping places (uses Overpass)")
+    run_batch(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ import os
 from typing import Generator
 
 from dotenv import find_dotenv, load_dotenv
-from sqlalchemy import URL, Engine, create_engine
+from sqlalchemy import URL, Engine, create_engine, text
 from sqlalchemy.orm import Session, sessionmaker
 
 load_dotenv(find_dotenv())
@@ -19,17 +19,58 @@ def _get_db_url() -> URL:
         username=os.environ["POSTGRES_USER"],
         password=os.environ["POSTGRES_PASSWORD"],
         host=os.environ["POSTGRES_HOST"],
-        port=int(os.getenv("POSTGRES_PORT", 5432)),
+        port=int(os.getenv("POSTGRES_PORT", "5432")),
         database=os.getenv("POSTGRES_DATABASE", "routing"),
     )
 
 
 @functools.lru_cache(maxsize=1)
 def _get_engine() -> Engine:
-    engine = create_engine(_get_db_url(), echo=True)
+    engine = create_engine(
+        _get_db_url(),
+        echo=os.getenv("DB_ECHO", "1") == "1",
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        pool_pre_ping=True,
+    )
     return engine
 
 
+def reset_after_fork() -> None:
+    """Drop connections inherited from the parent process, without closing them under the parent's feet."""
+    if _get_engine.cache_info().currsize:
+        _get_engine().dispose(close=False)
+
+
+def pool_checked_out() -> int:
+    """Number of pooled connections of this process currently in use."""
+    if not _get_engine.cache_info().currsize:
+        return 0
+    return _get_engine().pool.checkedout()  # type: ignore[attr-defined]
+
+
+def open_pool(statements: list[str]) -> int:
+    """
+    Open all DB_POOL_SIZE pooled connections at once and run statements on every one of them.
+
+    Args:
+        statements: SQL statements run on every connection, e.g. to plan the queries of the service
+
+    Returns:
+        Number of connections opened
+    """
+    engine = _get_engine()
+    size = engine.pool.size()  # type: ignore[attr-defined]
+    with contextlib.ExitStack() as stack:
+        # connections are held until all are open, otherwise the pool would hand out the same one again
+        connections = [stack.enter_context(engine.connect()) for _ in range(size)]
+        for connection in connections:
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.commit()
+    return size
+
+
 @contextlib.contextmanager
 def session() -> Generator[Session, None, None]:
     engine = _get_engine()
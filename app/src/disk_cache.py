@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import NamedTuple
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), "spdb_cache.sqlite3")
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    expired: int
+    stores: int
+    evictions: int
+    entries: int
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.entries} entries, {self.hits} hits / {self.misses} misses ({self.hit_ratio:.0%}), "
+            f"{self.expired} expired, {self.stores} stores, {self.evictions} evicted"
+        )
+
+
+class DiskCache:
+    """
+    Small SQLite-backed key-value cache with a TTL per entry and LRU eviction once `max_entries` is exceeded.
+
+    Each cache lives in its own namespace, so several caches can share one database file.
+    The file is opened in WAL mode, which makes it safe to share between threads and worker processes.
+    """
+
+    def __init__(self, namespace: str, ttl_s: float, max_entries: int, path: str | None = None) -> None:
+        self.namespace = namespace
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.path = path or os.getenv("SPDB_CACHE_PATH", DEFAULT_CACHE_PATH)
+
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._conn_pid: int | None = None
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._stores = 0
+        self._evictions = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections must not be shared with forked children, reopen after fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    min_lat REAL,
+                    min_lon REAL,
+                    max_lat REAL,
+                    max_lon REAL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_lru ON cache_entries (namespace, accessed_at)")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> bytes | None:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT value, created_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+
+            if row is None:
+                self._misses += 1
+                return None
+
+            value, created_at = row
+            if now - created_at > self.ttl_s:
+                conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key))
+                self._expired += 1
+                self._misses += 1
+                return None
+
+            conn.execute(
+                "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, self.namespace, key),
+            )
+            self._hits += 1
+            return bytes(value)
+
+    def put(self, key: str, value: bytes, bbox: tuple[float, float, float, float] | None = None) -> None:
+        """
+        Store a value, evicting the least recently used entries if the namespace grows over `max_entries`.
+
+        Args:
+            key: Cache key, unique within the namespace
+            value: Serialized value
+            bbox: Optional area the value covers (min_lat, min_lon, max_lat, max_lon)
+        """
+        now = time.time()
+        min_lat, min_lon, max_lat, max_lon = bbox if bbox is not None else (None, None, None, None)
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO cache_entries
+                    (namespace, key, value, created_at, accessed_at, min_lat, min_lon, max_lat, max_lon)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (self.namespace, key, value, now, now, min_lat, min_lon, max_lat, max_lon),
+            )
+            self._stores += 1
+
+            (entries,) = conn.execute(
+                "SELECT count(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+            ).fetchone()
+            if entries > self.max_entries:
+                evicted = conn.execute(
+                    """
+                    DELETE FROM cache_entries WHERE namespace = ? AND key IN (
+                        SELECT key FROM cache_entries WHERE namespace = ? ORDER BY accessed_at ASC LIMIT ?
+                    )
+                    """,
+                    (self.namespace, self.namespace, entries - self.max_entries),
+                ).rowcount
+                self._evictions += evicted
+
+    def invalidate(self, bboxes: list[tuple[float, float, float, float]]) -> int:
+        """
+        Drop entries whose area overlaps any of the given areas, entries stored without an area are kept.
+
+        Args:
+            bboxes: Areas (min_lat, min_lon, max_lat, max_lon)
+
+        Returns:
+            Number of dropped entries
+        """
+        with self._lock:
+            conn = self._connection()
+            dropped = 0
+            for min_lat, min_lon, max_lat, max_lon in bboxes:
+                dropped += conn.execute(
+                    """
+                    DELETE FROM cache_entries
+                    WHERE namespace = ? AND min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?
+                    """,
+                    (self.namespace, max_lat, min_lat, max_lon, min_lon),
+                ).rowcount
+            return dropped
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            (entries,) = (
+                self._connection()
+                .execute("SELECT count(*) FROM cache_entries WHERE namespace = ?", (self.namespace,))
+                .fetchone()
+            )
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                expired=self._expired,
+                stores=self._stores,
+                evictions=self._evictions,
+                entries=entries,
+            )
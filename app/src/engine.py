@@ -1,20 +1,26 @@
 from __future__ import annotations
 
 import concurrent.futures
+import functools
 import itertools
 import math
-from typing import NamedTuple
+import os
+import time
+from enum import Enum
+from typing import Any, Callable, Iterator, NamedTuple
 
+import orjson
+import shapely
 from sqlalchemy import text
-from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
 
+import tracing
 from db_utils import session
 from enums import BikeType, RoadType
+from leg_stats import LegStats, get_leg_stats_store, summarize_plan
+from single_flight import SingleFlight
 from weights import BIKE_TYPE_WEIGHTS
-from db_utils import session
-from enums import BikeType, RoadType
-from weights import BIKE_TYPE_WEIGHTS
-from enum import Enum
+
 
 class PointTypes(Enum):
     SLEEPING = "sleep"
@@ -26,6 +32,10 @@ class Point(NamedTuple):
     lon: float
     short_desc: str = "Default Point"
     type: PointTypes | None = None
+    # OSM element reference, e.g. "node/123", for points coming from OSM data
+    osm_ref: str | None = None
+    # OSM feature category, e.g. "tourism=museum"
+    category: str | None = None
 
 
 class Line(NamedTuple):
@@ -79,15 +89,48 @@ def get_closest_point(reference_point: Point) -> DbPoint:
     return get_closest_points(reference_point, 1)[0]
 
 
+def snap_points(points: list[Point]) -> list[DbPoint]:
+    """
+    Find the closest graph vertex of every point in a single query.
+
+    Args:
+        points: Points to snap
+
+    Returns:
+        Closest vertex of every point, in the same order
+    """
+    if not points:
+        return []
+
+    stmt = """
+    SELECT p.idx, v.id, v.lat, v.lon, v.the_geom
+    FROM unnest(CAST(:lons AS float8[]), CAST(:lats AS float8[])) WITH ORDINALITY AS p(lon, lat, idx)
+    CROSS JOIN LATERAL (
+        SELECT id, lat, lon, the_geom
+        FROM ways_vertices_pgr "vert"
+        ORDER BY vert.the_geom <-> ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326)::geometry ASC
+        LIMIT 1
+    ) v
+    ORDER BY p.idx
+    """
+
+    with tracing.span("snap", points=len(points)), session() as db_session:
+        result = db_session.execute(
+            text(stmt),
+            {"lons": [float(p.lon) for p in points], "lats": [float(p.lat) for p in points]},
+        ).fetchall()
+    return [DbPoint(id=row[1], lat=row[2], lon=row[3], geom=row[4]) for row in result]
+
+
 def _find_path_astar(
     start_point: Point,
     end_point: Point,
     road_type_weights: dict[RoadType, float],
+    start_vertex_id: int | None = None,
+    end_vertex_id: int | None = None,
 ) -> Route:
     x_a, y_a = float(start_point.lon), float(start_point.lat)
     x_b, y_b = float(end_point.lon), float(end_point.lat)
-    print(x_a, y_a)
-    print(x_b, y_b)
     factor_a = y_b - y_a
     factor_b = x_a - x_b
     factor_c = x_b * y_a - x_a * y_b
@@ -132,8 +175,59 @@ def _find_path_astar(
     #     dist = abs(factor_a * grid_lon + factor_b * grid_lat + factor_c) / sqrt(factor_a ** 2 + factor_b ** 2)
     #  - The rest is just transformations to reduce tha number of computations that postgres has to make when filtering the ways
 
-    stmt = f"""
-SELECT 
+    # edges of the corridor the search runs on
+    edge_set_stmt = f"""
+SELECT sq.id, sq.source, sq.target, sq.cost, sq.sgn * sq.cost "reverse_cost", sq.x1, sq.y1, sq.x2, sq.y2
+FROM (
+    SELECT
+        gid "id",
+        source,
+        target,
+        CASE
+            WHEN road_type = 'roads_paved' THEN :paved_weight * length
+            WHEN road_type = 'roads_unpaved' THEN :unpaved_weight * length
+            WHEN road_type = 'roads_unknown_surface' THEN :unknown_surface_weight * length
+            WHEN road_type = 'roads_primary' THEN :primary_weight * length
+            WHEN road_type = 'roads_secondary' THEN :secondary_weight * length
+            WHEN road_type = 'cycleways' THEN :cycleway_weight * length
+        END AS "cost",
+        SIGN(reverse_cost) AS sgn,
+        x1, y1, x2, y2
+    FROM ways
+    WHERE
+        (grid_lon BETWEEN (:lon_lower_bound - :dist_filter_deg) * {GRID_SCALE} AND (:lon_upper_bound + :dist_filter_deg) * {GRID_SCALE})
+        AND (grid_lat BETWEEN (:lat_lower_bound - :dist_filter_deg) * {GRID_SCALE} AND (:lat_upper_bound + :dist_filter_deg) * {GRID_SCALE})
+        AND (:dist_filter_deg * :factor_bott - (:factor_c)) * {GRID_SCALE} > :factor_a * grid_lon + :factor_b * grid_lat
+        AND (- (:dist_filter_deg * :factor_bott) - (:factor_c)) * {GRID_SCALE} < :factor_a * grid_lon + :factor_b * grid_lat
+) AS sq
+    """
+    edge_set_literal = edge_set_stmt.replace("'", "''")
+
+    # the search only returns the edges of the path, so it can be timed apart from assembling the geometry
+    search_stmt = f"""
+WITH start_point AS (
+    SELECT id
+    FROM ways_vertices_pgr "vert"
+    ORDER BY vert.the_geom <-> ST_SetSRID(ST_MakePoint(:start_lon, :start_lat), 4326)::geometry ASC
+    LIMIT 1
+), end_point AS (
+    SELECT id
+    FROM ways_vertices_pgr "vert"
+    ORDER BY vert.the_geom <-> ST_SetSRID(ST_MakePoint(:end_lon, :end_lat), 4326)::geometry ASC
+    LIMIT 1
+)
+
+SELECT array_agg(waypoints.edge ORDER BY waypoints.seq) "edges" FROM pgr_bdastar(
+    '{edge_set_literal}',
+    COALESCE(CAST(:start_vertex_id AS bigint), (SELECT id FROM start_point)),
+    COALESCE(CAST(:end_vertex_id AS bigint), (SELECT id FROM end_point)),
+    directed => true, heuristic => 4
+) as waypoints
+WHERE waypoints.edge <> -1;
+    """
+
+    geometry_stmt = """
+SELECT
 	ST_AsGeoJSON(ST_LineMerge(ST_Collect(sq.geom))) "geojson",
 	ST_LineMerge(ST_Collect(sq.geom)) "geom",
 	sum(sq.length_m) "length_m",
@@ -146,49 +240,10 @@ SELECT
         'cycleways', sum(CASE WHEN road_type = 'cycleways' THEN length_m ELSE 0 END)
     ) "length_m_road_types"
 FROM (
-    WITH start_point AS (
-        SELECT id
-        FROM ways_vertices_pgr "vert"
-        ORDER BY vert.the_geom <-> ST_SetSRID(ST_MakePoint(:start_lon, :start_lat), 4326)::geometry ASC
-        LIMIT 1
-    ), end_point AS (
-        SELECT id
-        FROM ways_vertices_pgr "vert"
-        ORDER BY vert.the_geom <-> ST_SetSRID(ST_MakePoint(:end_lon, :end_lat), 4326)::geometry ASC
-        LIMIT 1
-    )
-
-	SELECT ST_Length(the_geom::geography) "length_m", ST_AsGeoJSON(the_geom) "geojson", the_geom "geom", road_type "road_type" FROM pgr_bdastar(
-        '
-        SELECT sq.id, sq.source, sq.target, sq.cost, sq.sgn * sq.cost "reverse_cost", sq.x1, sq.y1, sq.x2, sq.y2
-        FROM (
-            SELECT 
-                gid "id",
-                source,
-                target,
-                CASE
-                    WHEN road_type = ''roads_paved'' THEN :paved_weight * length
-                    WHEN road_type = ''roads_unpaved'' THEN :unpaved_weight * length
-                    WHEN road_type = ''roads_unknown_surface'' THEN :unknown_surface_weight * length
-                    WHEN road_type = ''roads_primary'' THEN :primary_weight * length
-                    WHEN road_type = ''roads_secondary'' THEN :secondary_weight * length
-                    WHEN road_type = ''cycleways'' THEN :cycleway_weight * length
-                END AS "cost",
-                SIGN(reverse_cost) AS sgn,
-                x1, y1, x2, y2
-            FROM ways
-            WHERE 
-                (grid_lon BETWEEN (:lon_lower_bound - :dist_filter_deg) * {GRID_SCALE} AND (:lon_upper_bound + :dist_filter_deg) * {GRID_SCALE})
-                AND (grid_lat BETWEEN (:lat_lower_bound - :dist_filter_deg) * {GRID_SCALE} AND (:lat_upper_bound + :dist_filter_deg) * {GRID_SCALE})
-                AND (:dist_filter_deg * :factor_bott - (:factor_c)) * {GRID_SCALE} > :factor_a * grid_lon + :factor_b * grid_lat
-                AND (- (:dist_filter_deg * :factor_bott) - (:factor_c)) * {GRID_SCALE} < :factor_a * grid_lon + :factor_b * grid_lat
-        ) AS sq
-        ',
-        (SELECT id FROM start_point),
-        (SELECT id FROM end_point),
-        directed => true, heuristic => 4
-    ) as waypoints
-    INNER JOIN ways rd ON waypoints.edge = rd.gid
+	SELECT ST_Length(rd.the_geom::geography) "length_m", rd.the_geom "geom", rd.road_type "road_type"
+    FROM unnest(CAST(:edges AS bigint[])) WITH ORDINALITY AS path(edge, seq)
+    INNER JOIN ways rd ON path.edge = rd.gid
+    ORDER BY path.seq
 ) sq;
     """
 
@@ -198,6 +253,8 @@ FROM (
             "start_lon": float(start_point.lon),
             "end_lat": float(end_point.lat),
             "end_lon": float(end_point.lon),
+            "start_vertex_id": start_vertex_id,
+            "end_vertex_id": end_vertex_id,
             "paved_weight": float(road_type_weights.get(RoadType.paved, 1.0)),
             "unpaved_weight": float(road_type_weights.get(RoadType.unpaved, 1.5)),
             "unknown_surface_weight": float(road_type_weights.get(RoadType.unknown_surface, 2.0)),
@@ -215,16 +272,41 @@ FROM (
             "lat_upper_bound": float(lat_upper_bound),
         }
 
-        compiled = (
-            text(stmt)
-            .bindparams(**params)
-            .compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
-        )
-        print(compiled, flush=True)
-
-        result = db_session.execute(text(stmt), params).fetchone()
+        started = time.perf_counter()
+        with tracing.span("leg.search", dist_filter_deg=dist_filter_deg) as search_span:
+            edges = db_session.execute(text(search_stmt), params).scalar()
+            if search_span is not None:
+                search_span.set(edges=len(edges or []))
+        search_ms = (time.perf_counter() - started) * 1000
+
+        geometry_ms = None
+        if edges:
+            started = time.perf_counter()
+            with tracing.span("leg.geometry"):
+                result = db_session.execute(text(geometry_stmt), {"edges": edges}).fetchone()
+            geometry_ms = (time.perf_counter() - started) * 1000
+
+        if os.getenv("LEG_STATS", "1") == "1":
+            stats = LegStats(
+                start_lon=x_a,
+                start_lat=y_a,
+                end_lon=x_b,
+                end_lat=y_b,
+                ab_dist_deg=ab_dist,
+                dist_filter_deg=dist_filter_deg,
+                bbox=(
+                    lon_lower_bound - dist_filter_deg,
+                    lat_lower_bound - dist_filter_deg,
+                    lon_upper_bound + dist_filter_deg,
+                    lat_upper_bound + dist_filter_deg,
+                ),
+                path_edges=len(edges or []),
+                search_ms=search_ms,
+                geometry_ms=geometry_ms,
+            )
+            _record_leg_stats(db_session, stats, edge_set_stmt, params)
 
-    if result is None or result[0] is None:
+    if not edges or result is None or result[0] is None:
         raise NoRouteError(f"No route found between {start_point} and {end_point}")
 
     return Route(
@@ -237,45 +319,154 @@ FROM (
     )
 
 
-def build_route(points: list[Point], bike_type: BikeType) -> list[Route]:
-    # todo compute based on bike type
-    # lower weight <=> higher preference
-    weights = BIKE_TYPE_WEIGHTS[bike_type]["routing_weights"]
+def _record_leg_stats(db_session: Session, stats: LegStats, edge_set_stmt: str, params: dict[str, Any]) -> None:
+    """Record statistics of a leg, explaining the corridor query of sampled slow legs."""
+    store = get_leg_stats_store()
+    explain = store.should_explain(stats.search_ms)
+    count_edges = not explain and os.getenv("LEG_STATS_COUNT_EDGES", "0") == "1"
+    plan = None
+    try:
+        if explain or count_edges:
+            # a savepoint keeps a failing statement from aborting the leg's transaction
+            with (
+                db_session.begin_nested(),
+                tracing.span("leg.explain" if explain else "leg.count_edges") as measure_span,
+            ):
+                if explain:
+                    plan = summarize_plan(
+                        db_session.execute(
+                            text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {edge_set_stmt}"), params
+                        ).scalar()
+                    )
+                    stats = stats._replace(candidate_edges=plan.candidate_edges)
+                else:
+                    count = db_session.execute(text(f"SELECT count(*) FROM ({edge_set_stmt}) edge_set"), params)
+                    stats = stats._replace(candidate_edges=count.scalar())
+                if measure_span is not None:
+                    measure_span.set(scanned_edges=stats.candidate_edges)
+        store.record(stats, plan)
+    except Exception as e:
+        # statistics must never fail the leg
+        print(f"Error recording leg statistics: {e}")
+
+
+@functools.lru_cache(maxsize=1)
+def get_route_flights() -> SingleFlight:
+    return SingleFlight(
+        namespace="route_legs",
+        result_ttl_s=float(os.getenv("ROUTE_COALESCING_TTL_S", "30")),
+        max_entries=int(os.getenv("ROUTE_COALESCING_MAX_ENTRIES", "10000")),
+        area=_leg_area,
+        # only worker processes need to share legs with each other, threads share them in memory
+        shared=os.getenv("ROUTING_EXECUTOR", "thread") == "process",
+    )
 
-    assert len(points) >= 2, f"build_route requires at least 2 points, got {len(points)}"
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        routes_to_futures = {
-            (s_start, s_end): executor.submit(
-                _find_path_astar,
-                start_point=s_start,
-                end_point=s_end,
-                road_type_weights=weights,  # type: ignore[arg-type]
-            )
-            for s_start, s_end in itertools.pairwise(points)
+def _leg_area(value: bytes) -> tuple[float, float, float, float] | None:
+    data = orjson.loads(value)
+    min_lon, min_lat, max_lon, max_lat = shapely.from_geojson(data["geojson"]).bounds
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def _encode_leg(route: Route) -> bytes:
+    return orjson.dumps(
+        {
+            "geojson": route.geojson,
+            "geom": route.geom,
+            "length_m": route.length_m,
+            "length_m_road_types": route.length_m_road_types,
         }
+    )
+
 
-    routes = []
-    for i, ((s_start, s_end), future) in enumerate(routes_to_futures.items(), start=1):
-        try:
-            route = future.result()
-            routes.append(route)
-        except NoRouteError as e:
-            print(f"Error finding route between points {i} -> {i + 1} {s_start} and {s_end}: {e}")
-            raise e
-    return routes
-
-
-def build_routes_multiple(segments: list[list[Point]], bike_type: BikeType) -> list[list[Route]]:
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(build_route, segment, bike_type): segment for segment in segments}
-
-    results = []
-    for future, segment in futures.items():
-        try:
-            route = future.result()
-            results.append(route)
-        except NoRouteError as e:
-            print(f"Error building route for segment {segment}: {e}")
-            raise e
-    return results
+def find_route(
+    start_point: Point, end_point: Point, bike_type: BikeType, vertex_ids: tuple[int, int] | None = None
+) -> Route:
+    """
+    Route a single leg, see `routing_workers.iter_route_legs` for routing many legs at once.
+
+    Identical legs requested at the same time are routed only once: legs are keyed by the vertices their ends were
+    snapped to, or else by the coordinates of their ends, and the bike type, and concurrent requests wait for the
+    running query. With ROUTING_EXECUTOR=process worker processes coalesce too, through a file lock and the shared
+    disk cache.
+
+    Args:
+        start_point: Start of the leg
+        end_point: End of the leg
+        bike_type: Bike type to route for
+        vertex_ids: Vertices the ends were snapped to by `snap_points`, snapped by the routing query if not given
+
+    Returns:
+        Route of the leg
+    """
+    with tracing.span("leg", bike_type=bike_type.value):
+        return _find_route(start_point, end_point, bike_type, vertex_ids)
+
+
+def _find_route(start_point: Point, end_point: Point, bike_type: BikeType, vertex_ids: tuple[int, int] | None) -> Route:
+    weights = BIKE_TYPE_WEIGHTS[bike_type]["routing_weights"]
+    start_vertex_id, end_vertex_id = vertex_ids or (None, None)
+    if os.getenv("ROUTE_COALESCING", "1") != "1":
+        return _find_path_astar(start_point, end_point, weights, start_vertex_id, end_vertex_id)  # type: ignore[arg-type]
+
+    def route_leg() -> bytes:
+        # waiting threads get a NoRouteError too, but it isn't kept for later requests
+        route = _find_path_astar(start_point, end_point, weights, start_vertex_id, end_vertex_id)  # type: ignore[arg-type]
+        return _encode_leg(route)
+
+    if vertex_ids is not None:
+        key = f"{start_vertex_id}:{end_vertex_id}:{bike_type.value}"
+    else:
+        # the ends are snapped by the routing query itself, snapping them first for the key would cost a round trip
+        key = f"{start_point.lat},{start_point.lon}:{end_point.lat},{end_point.lon}:{bike_type.value}"
+    data = orjson.loads(get_route_flights().run(key, route_leg))
+    # a coalesced leg may have been requested with other names of its ends, or other coordinates snapping to them
+    return Route(start=start_point, end=end_point, **data)
+
+
+def iter_route_legs_on(
+    executor: concurrent.futures.Executor,
+    route_leg: Callable[[Point, Point, BikeType, tuple[int, int] | None], Route],
+    segments: list[list[Point]],
+    bike_type: BikeType,
+    vertex_ids: list[list[int]] | None = None,
+) -> Iterator[tuple[int, int, Route]]:
+    """
+    Route every leg of every segment on the given executor, yielding legs as soon as they finish.
+
+    Args:
+        executor: Executor to route the legs on, threads or processes
+        route_leg: Function routing a single leg, has to be picklable for a process executor
+        segments: Lists of points, each routed through in order
+        bike_type: Bike type to route for
+        vertex_ids: Vertices every point of the segments was snapped to, if they were snapped already
+
+    Returns:
+        Iterator of (segment index, leg index within the segment, route), in order of completion
+    """
+    for points in segments:
+        assert len(points) >= 2, f"build_route requires at least 2 points, got {len(points)}"
+
+    # traces can't follow legs into worker processes
+    submit = tracing.submit if isinstance(executor, concurrent.futures.ThreadPoolExecutor) else type(executor).submit
+    future_to_leg = {}
+    for segment_idx, points in enumerate(segments):
+        for leg_idx, (s_start, s_end) in enumerate(itertools.pairwise(points)):
+            leg_vertex_ids = None
+            if vertex_ids is not None:
+                leg_vertex_ids = (vertex_ids[segment_idx][leg_idx], vertex_ids[segment_idx][leg_idx + 1])
+            future = submit(executor, route_leg, s_start, s_end, bike_type, leg_vertex_ids)
+            future_to_leg[future] = (segment_idx, leg_idx, s_start, s_end)
+    try:
+        for future in concurrent.futures.as_completed(future_to_leg):
+            segment_idx, leg_idx, s_start, s_end = future_to_leg[future]
+            try:
+                route = future.result()
+            except NoRouteError as e:
+                print(f"Error finding route between points {leg_idx + 1} -> {leg_idx + 2} {s_start} and {s_end}: {e}")
+                raise e
+            yield segment_idx, leg_idx, route
+    finally:
+        # legs which haven't started are not needed anymore if the caller stopped early or a leg failed
+        for future in future_to_leg:
+            future.cancel()
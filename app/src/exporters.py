@@ -0,0 +1,476 @@
+import datetime
+import struct
+from typing import Callable, Iterable, Iterator, NamedTuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+import numpy.typing as npt
+import orjson
+
+from engine import Point, PointTypes, Route
+from geo_utils import cumulative_distance_m, to_local_m
+from simplify import FULL_PROFILE, ExportProfile, simplify_tracks
+
+# number of track points formatted into a single chunk of output
+_TRACK_POINTS_PER_CHUNK = 10000
+
+# course formats need a timestamp for every point, derived from the distance at a touring pace
+NOMINAL_SPEED_MPS = 5.0
+COURSE_START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class ExportData(NamedTuple):
+    # coordinates of every route as arrays of (lon, lat) rows, grouped into tracks, e.g. one track per day
+    tracks: list[list[npt.NDArray[np.float64]]]
+    waypoints: list[Point]
+    start: Point | None
+    end: Point | None
+    name: str
+    description: str
+
+
+class ExportFormat(NamedTuple):
+    name: str
+    label: str
+    extension: str
+    mime_type: str
+    write: Callable[[ExportData], Iterator[bytes]]
+
+
+class _Course(NamedTuple):
+    coordinates: npt.NDArray[np.float64]
+    distance_m: npt.NDArray[np.float64]
+    # (start, end) vertex index range of every track
+    track_ranges: list[tuple[int, int]]
+
+
+def prepare_export(
+    tracks: list[list[Route]],
+    waypoints: Iterable[Point] = (),
+    name: str = "Bike Route",
+    description: str | None = None,
+    profile: ExportProfile = FULL_PROFILE,
+    keep_points: list[Point] | None = None,
+) -> ExportData:
+    """
+    Collect everything the export writers need from planned routes.
+
+    Args:
+        tracks: Routes grouped into tracks, e.g. one track per day
+        waypoints: POIs and sleeping places to export
+        name: Name of the exported document
+        description: Description of the exported document
+        profile: Export profile used to simplify the track geometry
+        keep_points: Points whose nearest track point survives simplification, e.g. day endpoints
+
+    Returns:
+        Export input shared by all formats
+    """
+    routes = [route for track in tracks for route in track]
+    if description is None:
+        description = f"Generated bike route with {len(routes)} segments"
+    return ExportData(
+        tracks=simplify_tracks(tracks, profile, keep_points),
+        waypoints=list(waypoints),
+        start=routes[0].start if routes else None,
+        end=routes[-1].end if routes else None,
+        name=name,
+        description=description,
+    )
+
+
+def _track_name(data: ExportData, track_idx: int) -> str:
+    return "Bike Route Track" if len(data.tracks) == 1 else f"Day {track_idx + 1}"
+
+
+def _course(data: ExportData) -> _Course:
+    """Concatenate all tracks into one line, with the distance from the start to every vertex."""
+    parts: list[npt.NDArray[np.float64]] = []
+    track_ranges = []
+    n = 0
+    for track in data.tracks:
+        legs = [leg for leg in track if len(leg)]
+        size = sum(len(leg) for leg in legs)
+        parts.extend(legs)
+        track_ranges.append((n, n + size))
+        n += size
+    coordinates = np.concatenate(parts) if parts else np.empty((0, 2))
+    return _Course(coordinates=coordinates, distance_m=cumulative_distance_m(coordinates), track_ranges=track_ranges)
+
+
+def _nearest_vertices(course: _Course, points: list[Point]) -> npt.NDArray[np.int64]:
+    if not points or len(course.coordinates) == 0:
+        return np.zeros(len(points), dtype=np.int64)
+    ref_lat = float(course.coordinates[:, 1].mean())
+    xy = to_local_m(course.coordinates, ref_lat)
+    points_xy = to_local_m(np.array([(p.lon, p.lat) for p in points]), ref_lat)
+    return np.array([np.linalg.norm(xy - point, axis=1).argmin() for point in points_xy], dtype=np.int64)
+
+
+def _waypoint_symbol(point: Point) -> str:
+    # Determine symbol based on POI type
+    if point.type == PointTypes.SLEEPING:
+        return "Lodging"
+    elif point.type == PointTypes.POI:
+        return "Scenic Area"
+    return "Information"
+
+
+def _gpx_waypoint(lat: float, lon: float, name: str, symbol: str) -> str:
+    return f'<wpt lat="{lat}" lon="{lon}"><name>{escape(name)}</name><sym>{escape(symbol)}</sym></wpt>\n'
+
+
+def write_gpx(data: ExportData) -> Iterator[bytes]:
+    """
+    Serialize to GPX 1.1, with one track per day and one track segment per route.
+
+    Track points are formatted straight from the coordinate arrays, without building a document tree,
+    so memory use is bounded by a single chunk regardless of the route length.
+    """
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="SPDB Bike Route Planner">\n'
+        f"<metadata><name>{escape(data.name)}</name><desc>{escape(data.description)}</desc></metadata>\n"
+    ).encode("utf-8")
+
+    # GPX schema requires all waypoints before tracks
+    if data.start is not None and data.end is not None:
+        yield (
+            _gpx_waypoint(data.start.lat, data.start.lon, f"Start: {data.start.short_desc}", "Flag, Green")
+            + _gpx_waypoint(data.end.lat, data.end.lon, f"End: {data.end.short_desc}", "Flag, Red")
+        ).encode("utf-8")
+    yield "".join(
+        _gpx_waypoint(point.lat, point.lon, point.short_desc, _waypoint_symbol(point)) for point in data.waypoints
+    ).encode("utf-8")
+
+    for track_idx, track in enumerate(data.tracks):
+        yield f"<trk><name>{escape(_track_name(data, track_idx))}</name>\n".encode("utf-8")
+        for coordinates in track:
+            if len(coordinates) == 0:
+                continue
+            yield b"<trkseg>\n"
+            for chunk_start in range(0, len(coordinates), _TRACK_POINTS_PER_CHUNK):
+                chunk = coordinates[chunk_start : chunk_start + _TRACK_POINTS_PER_CHUNK].tolist()
+                yield "".join(f'<trkpt lat="{lat}" lon="{lon}"/>\n' for lon, lat in chunk).encode("utf-8")
+            yield b"</trkseg>\n"
+        yield b"</trk>\n"
+
+    yield b"</gpx>\n"
+
+
+def _tcx_position(lon: float, lat: float) -> str:
+    return f"<Position><LatitudeDegrees>{lat}</LatitudeDegrees><LongitudeDegrees>{lon}</LongitudeDegrees></Position>"
+
+
+def _tcx_time(distance_m: float) -> str:
+    return (COURSE_START + datetime.timedelta(seconds=distance_m / NOMINAL_SPEED_MPS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def write_tcx(data: ExportData) -> Iterator[bytes]:
+    """
+    Serialize to a Garmin Training Center course file, with one course per day.
+
+    Every waypoint becomes a course point of the day it is closest to.
+    """
+    course = _course(data)
+    nearest = _nearest_vertices(course, data.waypoints)
+
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">\n<Courses>\n'
+    ).encode("utf-8")
+
+    for track_idx, (start, end) in enumerate(course.track_ranges):
+        if start == end:
+            continue
+        coordinates = course.coordinates[start:end]
+        # every course starts at distance 0
+        distance_m = course.distance_m[start:end] - course.distance_m[start]
+        begin_lon, begin_lat = coordinates[0].tolist()
+        end_lon, end_lat = coordinates[-1].tolist()
+
+        # course names are limited to 15 characters
+        yield (
+            f"<Course><Name>{escape(_track_name(data, track_idx)[:15])}</Name>\n"
+            f"<Lap><TotalTimeSeconds>{distance_m[-1] / NOMINAL_SPEED_MPS:.0f}</TotalTimeSeconds>"
+            f"<DistanceMeters>{distance_m[-1]:.1f}</DistanceMeters>"
+            f"<BeginPosition><LatitudeDegrees>{begin_lat}</LatitudeDegrees><LongitudeDegrees>{begin_lon}</LongitudeDegrees></BeginPosition>"
+            f"<EndPosition><LatitudeDegrees>{end_lat}</LatitudeDegrees><LongitudeDegrees>{end_lon}</LongitudeDegrees></EndPosition>"
+            "<Intensity>Active</Intensity></Lap>\n<Track>\n"
+        ).encode("utf-8")
+        for chunk_start in range(0, len(coordinates), _TRACK_POINTS_PER_CHUNK):
+            chunk = coordinates[chunk_start : chunk_start + _TRACK_POINTS_PER_CHUNK].tolist()
+            chunk_distance = distance_m[chunk_start : chunk_start + _TRACK_POINTS_PER_CHUNK].tolist()
+            yield "".join(
+                f"<Trackpoint><Time>{_tcx_time(distance)}</Time>{_tcx_position(lon, lat)}"
+                f"<DistanceMeters>{distance:.1f}</DistanceMeters></Trackpoint>\n"
+                for (lon, lat), distance in zip(chunk, chunk_distance)
+            ).encode("utf-8")
+        yield b"</Track>\n"
+
+        # course point names are limited to 10 characters
+        yield "".join(
+            f"<CoursePoint><Name>{escape(point.short_desc[:10])}</Name>"
+            f"<Time>{_tcx_time(float(distance_m[vertex - start]))}</Time>{_tcx_position(point.lon, point.lat)}"
+            "<PointType>Generic</PointType></CoursePoint>\n"
+            for point, vertex in zip(data.waypoints, nearest.tolist())
+            if start <= vertex < end
+        ).encode("utf-8")
+        yield b"</Course>\n"
+
+    yield b"</Courses>\n</TrainingCenterDatabase>\n"
+
+
+_FIT_EPOCH = datetime.datetime(1989, 12, 31, tzinfo=datetime.timezone.utc)
+_FIT_PROFILE_VERSION = 2132
+
+# FIT base types
+_FIT_ENUM = 0x00
+_FIT_STRING = 0x07
+_FIT_UINT16 = 0x84
+_FIT_SINT32 = 0x85
+_FIT_UINT32 = 0x86
+
+_FIT_FILE_COURSE = 6
+_FIT_MANUFACTURER_DEVELOPMENT = 255
+_FIT_SPORT_CYCLING = 2
+_FIT_EVENT_TIMER = 0
+_FIT_EVENT_TYPE_START = 0
+_FIT_EVENT_TYPE_STOP_DISABLE_ALL = 9
+_FIT_COURSE_POINT_GENERIC = 0
+
+
+def _fit_crc_byte_table() -> list[int]:
+    # CRC-16/ARC, as specified by the FIT protocol
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_FIT_CRC_TABLE = _fit_crc_byte_table()
+
+
+def _fit_crc(data: bytes, crc: int = 0) -> int:
+    table = _FIT_CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class _FitMessage:
+    """Definition of a FIT message type, with fields given as (field number, base type, struct format)."""
+
+    def __init__(self, local_type: int, global_number: int, fields: list[tuple[int, int, str]]) -> None:
+        self.local_type = local_type
+        self.struct = struct.Struct("<B" + "".join(fmt for _, _, fmt in fields))
+        self.definition = struct.pack("<BBBHB", 0x40 | local_type, 0, 0, global_number, len(fields)) + b"".join(
+            struct.pack("<BBB", number, struct.calcsize("<" + fmt), base_type) for number, base_type, fmt in fields
+        )
+
+    def pack(self, *values: int | bytes) -> bytes:
+        return self.struct.pack(self.local_type, *values)
+
+
+_FIT_FILE_ID = _FitMessage(
+    0, 0, [(0, _FIT_ENUM, "B"), (1, _FIT_UINT16, "H"), (2, _FIT_UINT16, "H"), (4, _FIT_UINT32, "I")]
+)
+_FIT_COURSE = _FitMessage(1, 31, [(4, _FIT_ENUM, "B"), (5, _FIT_STRING, "16s")])
+_FIT_EVENT = _FitMessage(2, 21, [(253, _FIT_UINT32, "I"), (0, _FIT_ENUM, "B"), (1, _FIT_ENUM, "B")])
+_FIT_LAP = _FitMessage(
+    3,
+    19,
+    [
+        (253, _FIT_UINT32, "I"),  # timestamp
+        (2, _FIT_UINT32, "I"),  # start time
+        (3, _FIT_SINT32, "i"),  # start lat
+        (4, _FIT_SINT32, "i"),  # start lon
+        (5, _FIT_SINT32, "i"),  # end lat
+        (6, _FIT_SINT32, "i"),  # end lon
+        (7, _FIT_UINT32, "I"),  # total elapsed time, ms
+        (8, _FIT_UINT32, "I"),  # total timer time, ms
+        (9, _FIT_UINT32, "I"),  # total distance, cm
+    ],
+)
+_FIT_RECORD = _FitMessage(
+    4, 20, [(253, _FIT_UINT32, "I"), (0, _FIT_SINT32, "i"), (1, _FIT_SINT32, "i"), (5, _FIT_UINT32, "I")]
+)
+_FIT_COURSE_POINT = _FitMessage(
+    5,
+    32,
+    [
+        (254, _FIT_UINT16, "H"),  # message index
+        (1, _FIT_UINT32, "I"),  # timestamp
+        (2, _FIT_SINT32, "i"),  # lat
+        (3, _FIT_SINT32, "i"),  # lon
+        (4, _FIT_UINT32, "I"),  # distance, cm
+        (5, _FIT_ENUM, "B"),  # type
+        (6, _FIT_STRING, "16s"),  # name
+    ],
+)
+
+# record data messages, packed straight from the coordinate arrays
+_FIT_RECORD_DTYPE = np.dtype(
+    [("header", "u1"), ("timestamp", "<u4"), ("lat", "<i4"), ("lon", "<i4"), ("distance", "<u4")]
+)
+
+
+def _semicircles(degrees: npt.NDArray[np.float64]) -> npt.NDArray[np.int32]:
+    return np.round(degrees * (2**31 / 180.0)).astype(np.int32)
+
+
+def _fit_string(value: str) -> bytes:
+    # fixed size field, always null terminated, cut on a character boundary
+    return value.encode("utf-8")[:15].decode("utf-8", "ignore").encode("utf-8")
+
+
+def write_fit(data: ExportData) -> Iterator[bytes]:
+    """
+    Serialize to a binary FIT course file, with one lap per day.
+
+    Track points are packed into record messages as a numpy structured array, and waypoints become course points.
+    """
+    course = _course(data)
+    start_ts = int((COURSE_START - _FIT_EPOCH).total_seconds())
+    timestamps = (start_ts + course.distance_m / NOMINAL_SPEED_MPS).astype(np.uint32)
+    lat, lon = _semicircles(course.coordinates[:, 1]), _semicircles(course.coordinates[:, 0])
+    distance_cm = np.round(course.distance_m * 100).astype(np.uint32)
+    end_ts = int(timestamps[-1]) if len(timestamps) else start_ts
+
+    messages = bytearray()
+    messages += _FIT_FILE_ID.definition
+    messages += _FIT_FILE_ID.pack(_FIT_FILE_COURSE, _FIT_MANUFACTURER_DEVELOPMENT, 0, start_ts)
+    messages += _FIT_COURSE.definition
+    messages += _FIT_COURSE.pack(_FIT_SPORT_CYCLING, _fit_string(data.name))
+
+    messages += _FIT_LAP.definition
+    for start, end in course.track_ranges:
+        if start == end:
+            continue
+        elapsed_ms = int(timestamps[end - 1] - timestamps[start]) * 1000
+        messages += _FIT_LAP.pack(
+            int(timestamps[end - 1]),
+            int(timestamps[start]),
+            int(lat[start]),
+            int(lon[start]),
+            int(lat[end - 1]),
+            int(lon[end - 1]),
+            elapsed_ms,
+            elapsed_ms,
+            int(distance_cm[end - 1] - distance_cm[start]),
+        )
+
+    messages += _FIT_EVENT.definition
+    messages += _FIT_EVENT.pack(start_ts, _FIT_EVENT_TIMER, _FIT_EVENT_TYPE_START)
+
+    records = np.empty(len(course.coordinates), dtype=_FIT_RECORD_DTYPE)
+    records["header"] = _FIT_RECORD.local_type
+    records["timestamp"] = timestamps
+    records["lat"] = lat
+    records["lon"] = lon
+    records["distance"] = distance_cm
+    messages += _FIT_RECORD.definition
+    messages += records.tobytes()
+
+    messages += _FIT_EVENT.pack(end_ts, _FIT_EVENT_TIMER, _FIT_EVENT_TYPE_STOP_DISABLE_ALL)
+
+    # course points have to be ordered by distance
+    nearest = _nearest_vertices(course, data.waypoints)
+    messages += _FIT_COURSE_POINT.definition
+    for index, (vertex, point) in enumerate(sorted(zip(nearest.tolist(), data.waypoints), key=lambda item: item[0])):
+        messages += _FIT_COURSE_POINT.pack(
+            index,
+            int(timestamps[vertex]) if len(timestamps) else start_ts,
+            int(_semicircles(np.array(point.lat))),
+            int(_semicircles(np.array(point.lon))),
+            int(distance_cm[vertex]) if len(distance_cm) else 0,
+            _FIT_COURSE_POINT_GENERIC,
+            _fit_string(point.short_desc),
+        )
+
+    header = struct.pack("<BBHI4s", 14, 0x20, _FIT_PROFILE_VERSION, len(messages), b".FIT")
+    header += struct.pack("<H", _fit_crc(header))
+    yield header
+    yield bytes(messages)
+    # file CRC covers the header too
+    yield struct.pack("<H", _fit_crc(messages, _fit_crc(header)))
+
+
+def encode_polyline(lonlat: npt.NDArray[np.float64], precision: int = 5) -> str:
+    """
+    Encode a line with the Google encoded polyline algorithm, vectorised over all coordinates.
+
+    Args:
+        lonlat: Array of shape (n, 2) with (lon, lat) rows
+        precision: Number of decimal places kept
+
+    Returns:
+        Encoded polyline of (lat, lon) pairs
+    """
+    if len(lonlat) == 0:
+        return ""
+    values = np.round(lonlat[:, ::-1] * 10**precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    # split every value into 5 bit groups, least significant first; 7 groups cover any coordinate
+    shifts = np.arange(0, 35, 5)
+    groups = (zigzag[:, None] >> shifts) & 0x1F
+    group_count = 1 + ((zigzag[:, None] >> shifts[1:]) > 0).sum(axis=1)
+    group_idx = np.arange(len(shifts))[None, :]
+    # all groups but the last one of a value have the continuation bit set
+    chars = (groups | np.where(group_idx < group_count[:, None] - 1, 0x20, 0)) + 63
+    return chars[group_idx < group_count[:, None]].astype(np.uint8).tobytes().decode("ascii")
+
+
+def write_polyline(data: ExportData) -> Iterator[bytes]:
+    """Serialize to encoded polylines, one line per day."""
+    course = _course(data)
+    for start, end in course.track_ranges:
+        yield (encode_polyline(course.coordinates[start:end]) + "\n").encode("ascii")
+
+
+def write_geojson(data: ExportData) -> Iterator[bytes]:
+    """Serialize to a GeoJSON FeatureCollection with a LineString per day and a Point per waypoint."""
+    course = _course(data)
+    features: list[bytes] = []
+    for track_idx, (start, end) in enumerate(course.track_ranges):
+        length_m = float(course.distance_m[end - 1] - course.distance_m[start]) if end > start else 0.0
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": course.coordinates[start:end]},
+            "properties": {"name": _track_name(data, track_idx), "length_m": length_m},
+        }
+        features.append(orjson.dumps(feature, option=orjson.OPT_SERIALIZE_NUMPY))
+    for point in data.waypoints:
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(point.lon), float(point.lat)]},
+            "properties": {
+                "name": point.short_desc,
+                "type": point.type.value if point.type is not None else None,
+                "category": point.category,
+                "osm_ref": point.osm_ref,
+            },
+        }
+        features.append(orjson.dumps(feature))
+
+    yield orjson.dumps({"type": "FeatureCollection", "name": data.name})[:-1] + b',"features":['
+    for i, feature in enumerate(features):
+        yield (b"," if i else b"") + feature
+    yield b"]}\n"
+
+
+EXPORT_FORMATS: dict[str, ExportFormat] = {
+    export_format.name: export_format
+    for export_format in [
+        ExportFormat("gpx", "GPX", "gpx", "application/gpx+xml", write_gpx),
+        ExportFormat("tcx", "TCX course", "tcx", "application/vnd.garmin.tcx+xml", write_tcx),
+        ExportFormat("fit", "FIT course", "fit", "application/vnd.ant.fit", write_fit),
+        ExportFormat("polyline", "Encoded polyline", "txt", "text/plain", write_polyline),
+        ExportFormat("geojson", "GeoJSON", "geojson", "application/geo+json", write_geojson),
+    ]
+}
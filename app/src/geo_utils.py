@@ -0,0 +1,144 @@
+import math
+
+import numpy as np
+import numpy.typing as npt
+import orjson
+
+from engine import Point, Route
+
+EARTH_RADIUS_M = 6371000.0
+
+# upper bound for the size of the points x segments matrices, keeps memory use at a few dozen MB
+_MAX_PAIRS_PER_CHUNK = 2_000_000
+
+
+def coordinates_from_geojson(geojson: str | bytes) -> npt.NDArray[np.float64]:
+    """
+    Extract coordinates of a (Multi)LineString GeoJSON geometry.
+
+    Args:
+        geojson: GeoJSON geometry
+
+    Returns:
+        Array of shape (n, 2) with (lon, lat) rows, MultiLineString parts are concatenated
+    """
+    geometry = orjson.loads(geojson)
+    if geometry.get("type") == "LineString":
+        coordinates = geometry["coordinates"]
+    elif geometry.get("type") == "MultiLineString":
+        coordinates = [coord for linestring in geometry["coordinates"] for coord in linestring]
+    else:
+        raise ValueError(f"Unsupported geometry type: {geometry.get('type')}")
+    return np.asarray([coord[:2] for coord in coordinates], dtype=np.float64).reshape(-1, 2)
+
+
+def route_coordinates(route: Route) -> npt.NDArray[np.float64]:
+    return coordinates_from_geojson(route.geojson)
+
+
+def to_local_m(lonlat: npt.NDArray[np.float64], ref_lat: float) -> npt.NDArray[np.float64]:
+    """Equirectangular projection to meters, accurate enough over the extent of a trip."""
+    scale = np.array([np.cos(np.radians(ref_lat)), 1.0]) * np.radians(1.0) * EARTH_RADIUS_M
+    return lonlat * scale
+
+
+def distance_to_polyline_m(points: list[Point], line: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    Distance from every point to the nearest segment of a polyline, vectorised over points and segments.
+
+    Args:
+        points: Points to measure
+        line: Array of shape (n, 2) with (lon, lat) rows
+
+    Returns:
+        Array with the distance in meters for each point
+    """
+    if not points:
+        return np.empty(0)
+
+    lonlat = np.array([(p.lon, p.lat) for p in points], dtype=np.float64)
+    ref_lat = float(line[:, 1].mean()) if len(line) else float(lonlat[:, 1].mean())
+    xy = to_local_m(lonlat, ref_lat)
+    line_xy = to_local_m(line, ref_lat)
+
+    if len(line_xy) == 1:
+        return np.linalg.norm(xy - line_xy[0], axis=1)
+
+    seg_start = line_xy[:-1]
+    seg_vec = line_xy[1:] - seg_start
+    seg_len_sq = np.maximum((seg_vec**2).sum(axis=1), 1e-12)
+
+    distances = np.empty(len(xy))
+    chunk = max(1, _MAX_PAIRS_PER_CHUNK // len(seg_start))
+    for i in range(0, len(xy), chunk):
+        # (points, segments, 2): offset of every point from every segment start
+        offset = xy[i : i + chunk, None, :] - seg_start[None, :, :]
+        t = np.clip((offset * seg_vec[None, :, :]).sum(axis=2) / seg_len_sq[None, :], 0.0, 1.0)
+        nearest = t[:, :, None] * seg_vec[None, :, :]
+        distances[i : i + chunk] = np.sqrt(((offset - nearest) ** 2).sum(axis=2).min(axis=1))
+    return distances
+
+
+def cumulative_distance_m(lonlat: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    Distance along a polyline from its first vertex to every vertex.
+
+    Args:
+        lonlat: Array of shape (n, 2) with (lon, lat) rows
+
+    Returns:
+        Array of shape (n,) with distances in meters, starting at 0
+    """
+    if len(lonlat) == 0:
+        return np.empty(0)
+    lon, lat = np.radians(lonlat[:, 0]), np.radians(lonlat[:, 1])
+    # haversine of every step
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    steps = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    return np.concatenate([[0.0], np.cumsum(steps)])
+
+
+def hilbert_index(x: npt.NDArray[np.int64], y: npt.NDArray[np.int64], order: int) -> npt.NDArray[np.int64]:
+    """
+    Position of grid cells along a Hilbert curve, cells close on the curve are close on the grid.
+
+    Args:
+        x: Column of every cell, from 0 to 2^order - 1
+        y: Row of every cell, from 0 to 2^order - 1
+        order: The curve fills a 2^order x 2^order grid
+
+    Returns:
+        Distance of every cell from the start of the curve
+    """
+    x, y = x.astype(np.int64), y.astype(np.int64)
+    side = 1 << order
+    distance = np.zeros(len(x), dtype=np.int64)
+    s = side >> 1
+    while s > 0:
+        rx, ry = (x & s) > 0, (y & s) > 0
+        distance += s * s * ((3 * rx) ^ ry)
+        flip = ~ry & rx
+        x, y = np.where(flip, side - 1 - x, x), np.where(flip, side - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return distance
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """
+    Area of a web map (slippy map) tile.
+
+    Args:
+        z: Zoom level, the world is 2^z x 2^z tiles
+        x: Column of the tile, from the antimeridian eastwards
+        y: Row of the tile, from the north southwards
+
+    Returns:
+        (min_lon, min_lat, max_lon, max_lat) of the tile
+    """
+    tiles = 1 << z
+
+    def lat(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / tiles))))
+
+    return x / tiles * 360 - 180, lat(y + 1), (x + 1) / tiles * 360 - 180, lat(y)
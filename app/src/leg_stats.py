@@ -0,0 +1,250 @@
+"""
+Statistics of routed legs: corridor parameters, edge counts and timings, with query plans of slow legs.
+
+Every leg routed with the database is recorded in a local SQLite file. Legs whose search takes longer than
+LEG_EXPLAIN_THRESHOLD_MS are sampled at LEG_EXPLAIN_SAMPLE_RATE, and the corridor edge query of sampled legs is run
+again with EXPLAIN (ANALYZE, BUFFERS), so slow legs can be traced back to sequential scans or oversized corridors.
+
+Usage:
+    python leg_stats.py report [--top 20]
+    python leg_stats.py explain <leg id>
+"""
+
+import argparse
+import functools
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, NamedTuple
+
+import orjson
+
+DEFAULT_STATS_PATH = os.path.join(tempfile.gettempdir(), "spdb_leg_stats.sqlite3")
+
+
+class LegStats(NamedTuple):
+    start_lon: float
+    start_lat: float
+    end_lon: float
+    end_lat: float
+    # straight distance between the ends, in degrees
+    ab_dist_deg: float
+    dist_filter_deg: float
+    # bounding box of the corridor (min_lon, min_lat, max_lon, max_lat)
+    bbox: tuple[float, float, float, float]
+    path_edges: int
+    search_ms: float
+    geometry_ms: float | None = None
+    # edges returned by the corridor query, only known when counted or explained
+    candidate_edges: int | None = None
+
+
+class PlanSummary(NamedTuple):
+    plan: Any
+    execution_ms: float
+    candidate_edges: int
+    seq_scan: bool
+    shared_hit_blocks: int
+    shared_read_blocks: int
+
+
+def _plan_nodes(node: dict[str, Any]) -> list[dict[str, Any]]:
+    return [node] + [child for sub in node.get("Plans", []) for child in _plan_nodes(sub)]
+
+
+def _scans_ways(node: dict[str, Any]) -> bool:
+    # `ways` itself, or one of its longitude band partitions
+    name = node.get("Relation Name", "")
+    return name == "ways" or name.startswith("ways_lon_")
+
+
+def summarize_plan(plan: Any) -> PlanSummary:
+    """Key numbers of an EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) result of the corridor edge query."""
+    root = plan[0]["Plan"]
+    return PlanSummary(
+        plan=plan,
+        execution_ms=float(plan[0].get("Execution Time", 0.0)),
+        candidate_edges=int(root.get("Actual Rows", 0) * root.get("Actual Loops", 1)),
+        seq_scan=any(node.get("Node Type") == "Seq Scan" and _scans_ways(node) for node in _plan_nodes(root)),
+        shared_hit_blocks=int(root.get("Shared Hit Blocks", 0)),
+        shared_read_blocks=int(root.get("Shared Read Blocks", 0)),
+    )
+
+
+class LegStatsStore:
+    """Leg statistics in a SQLite file, safe to share between threads and worker processes."""
+
+    def __init__(self, path: str | None = None) -> None:
+        self.path = path or os.getenv("LEG_STATS_PATH", DEFAULT_STATS_PATH)
+        self.explain_threshold_ms = float(os.getenv("LEG_EXPLAIN_THRESHOLD_MS", "2000"))
+        self.explain_sample_rate = float(os.getenv("LEG_EXPLAIN_SAMPLE_RATE", "0.1"))
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._conn_pid: int | None = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections must not be shared with forked children, reopen after fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS leg_stats (
+                    id INTEGER PRIMARY KEY,
+                    recorded_at REAL NOT NULL,
+                    start_lon REAL NOT NULL,
+                    start_lat REAL NOT NULL,
+                    end_lon REAL NOT NULL,
+                    end_lat REAL NOT NULL,
+                    ab_dist_deg REAL NOT NULL,
+                    dist_filter_deg REAL NOT NULL,
+                    min_lon REAL NOT NULL,
+                    min_lat REAL NOT NULL,
+                    max_lon REAL NOT NULL,
+                    max_lat REAL NOT NULL,
+                    path_edges INTEGER NOT NULL,
+                    candidate_edges INTEGER,
+                    search_ms REAL NOT NULL,
+                    geometry_ms REAL,
+                    explain_ms REAL,
+                    seq_scan INTEGER,
+                    shared_hit_blocks INTEGER,
+                    shared_read_blocks INTEGER,
+                    plan BLOB
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS leg_stats_search_ms ON leg_stats (search_ms)")
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def should_explain(self, search_ms: float) -> bool:
+        return search_ms >= self.explain_threshold_ms and random.random() < self.explain_sample_rate
+
+    def record(self, stats: LegStats, plan: PlanSummary | None = None) -> None:
+        candidate_edges = plan.candidate_edges if plan is not None else stats.candidate_edges
+        with self._lock:
+            self._connection().execute(
+                """
+                INSERT INTO leg_stats (
+                    recorded_at, start_lon, start_lat, end_lon, end_lat, ab_dist_deg, dist_filter_deg,
+                    min_lon, min_lat, max_lon, max_lat, path_edges, candidate_edges, search_ms, geometry_ms,
+                    explain_ms, seq_scan, shared_hit_blocks, shared_read_blocks, plan
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    time.time(),
+                    stats.start_lon,
+                    stats.start_lat,
+                    stats.end_lon,
+                    stats.end_lat,
+                    stats.ab_dist_deg,
+                    stats.dist_filter_deg,
+                    *stats.bbox,
+                    stats.path_edges,
+                    candidate_edges,
+                    stats.search_ms,
+                    stats.geometry_ms,
+                    plan.execution_ms if plan is not None else None,
+                    plan.seq_scan if plan is not None else None,
+                    plan.shared_hit_blocks if plan is not None else None,
+                    plan.shared_read_blocks if plan is not None else None,
+                    orjson.dumps(plan.plan) if plan is not None else None,
+                ),
+            )
+
+    def query(self, sql: str, params: tuple[Any, ...] = ()) -> list[tuple[Any, ...]]:
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+
+@functools.lru_cache(maxsize=1)
+def get_leg_stats_store() -> LegStatsStore:
+    return LegStatsStore()
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+
+def report(store: LegStatsStore, top: int) -> None:
+    rows = store.query("SELECT search_ms, dist_filter_deg, path_edges, candidate_edges, seq_scan FROM leg_stats")
+    if not rows:
+        print(f"No legs recorded in {store.path}")
+        return
+
+    search_ms = [row[0] for row in rows]
+    explained = [row for row in rows if row[4] is not None]
+    print(f"{len(rows)} legs recorded in {store.path}, {len(explained)} explained")
+    print(
+        f"Search time p50 {_percentile(search_ms, 0.5):.0f} ms, p95 {_percentile(search_ms, 0.95):.0f} ms, "
+        f"p99 {_percentile(search_ms, 0.99):.0f} ms, max {max(search_ms):.0f} ms"
+    )
+    if explained:
+        seq_scans = sum(1 for row in explained if row[4])
+        print(f"Sequential scans over ways in {seq_scans} of {len(explained)} explained legs")
+
+    print("\nBy corridor width:")
+    print(f"{'dist_filter_deg':>16} {'legs':>6} {'p50 ms':>8} {'p95 ms':>8} {'candidate edges':>16}")
+    buckets: dict[float, list[tuple[Any, ...]]] = {}
+    for row in rows:
+        buckets.setdefault(round(row[1] * 2) / 2, []).append(row)
+    for width, bucket in sorted(buckets.items()):
+        counted = [row[3] for row in bucket if row[3] is not None]
+        candidates = f"{sum(counted) / len(counted):.0f}" if counted else "-"
+        times = [row[0] for row in bucket]
+        print(
+            f"{width:>16.1f} {len(bucket):>6} {_percentile(times, 0.5):>8.0f} {_percentile(times, 0.95):>8.0f} "
+            f"{candidates:>16}"
+        )
+
+    print(f"\nSlowest {top} legs:")
+    print(f"{'id':>6} {'search ms':>10} {'dist_filter':>11} {'path':>6} {'candidates':>10} {'seq scan':>8}  corridor")
+    for row in store.query(
+        """
+        SELECT id, search_ms, dist_filter_deg, path_edges, candidate_edges, seq_scan, min_lon, min_lat, max_lon, max_lat
+        FROM leg_stats ORDER BY search_ms DESC LIMIT ?
+        """,
+        (top,),
+    ):
+        leg_id, ms, width, path_edges, candidates, seq_scan, *bbox = row
+        print(
+            f"{leg_id:>6} {ms:>10.0f} {width:>11.2f} {path_edges:>6} {candidates if candidates is not None else '-':>10} "
+            f"{'-' if seq_scan is None else 'yes' if seq_scan else 'no':>8}  "
+            + ",".join(f"{value:.3f}" for value in bbox)
+        )
+
+
+def explain(store: LegStatsStore, leg_id: int) -> None:
+    rows = store.query("SELECT plan FROM leg_stats WHERE id = ?", (leg_id,))
+    if not rows:
+        print(f"No leg {leg_id}")
+    elif rows[0][0] is None:
+        print(f"Leg {leg_id} was not explained")
+    else:
+        print(orjson.dumps(orjson.loads(rows[0][0]), option=orjson.OPT_INDENT_2).decode())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Report statistics of routed legs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_parser = commands.add_parser("report", help="Summarize recorded legs")
+    report_parser.add_argument("--top", type=int, default=20, help="Number of slowest legs listed")
+    explain_parser = commands.add_parser("explain", help="Print the captured query plan of a leg")
+    explain_parser.add_argument("leg_id", type=int)
+    args = parser.parse_args()
+
+    store = get_leg_stats_store()
+    if args.command == "report":
+        report(store, args.top)
+    else:
+        explain(store, args.leg_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+"""
+Load test of the full planning flow with many simultaneous planners.
+
+Every virtual user plans trips back to back, like a user of the visualizer: routing with POI and sleeping place
+lookup, then a GPX export. Trips are drawn from a mix of day rides, weekends and multi-day tours with sleeping
+points, or read from a JSONL file in the batch_plan.py format.
+
+The flow runs either in this process against the engine, with a local Overpass stand-in unless --real-overpass is
+given, or against a running routing API over HTTP (/route, /pois and /export/gpx). Start the API with OVERPASS_URL
+pointing to overpass_stub.py to keep the real Overpass API out of it, and with its own SPDB_CACHE_PATH to keep the
+POIs of the stand-in out of the shared cache. The engine target keeps its caches in a temporary directory with the
+stand-in.
+
+The report covers throughput, latency percentiles of every stage, error rates and database connection usage,
+sampled from pg_stat_activity and, for the engine target, the connection pool of this process.
+
+Usage:
+    python load_test.py engine --users 16 --duration 120
+    python load_test.py http --url http://localhost:8000 --users 64 --duration 300 --output report.json
+"""
+
+import argparse
+import collections
+import itertools
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import traceback
+from typing import Any, Callable, NamedTuple
+
+import numpy as np
+import orjson
+import requests
+from sqlalchemy import text
+
+import tracing
+from batch_plan import TripRequest
+from db_utils import pool_checked_out, session
+from enums import BikeType
+from exporters import EXPORT_FORMATS, prepare_export
+from helper import split_route_by_sleeping_points
+from overpass_stub import start_overpass_stub
+from pipeline import plan_trip
+from routing_workers import get_routing_pool
+from simplify import EXPORT_PROFILES
+
+DEFAULT_BBOX = (14.5, 49.3, 23.8, 54.6)
+# database connections are sampled this often
+SAMPLE_INTERVAL_S = 1.0
+HTTP_TIMEOUT_S = 600
+
+Json = dict[str, Any]
+
+
+class TripTemplate(NamedTuple):
+    name: str
+    # share of generated trips
+    weight: float
+    days: int
+    # intermediate points of every day
+    stops_per_day: int
+    # straight distance covered every day, in degrees
+    day_distance_deg: float
+
+
+TRIP_MIX = [
+    TripTemplate("day_ride", 0.5, 1, 1, 0.5),
+    TripTemplate("weekend", 0.3, 2, 1, 0.7),
+    TripTemplate("tour", 0.2, 5, 2, 0.8),
+]
+
+
+def generate_trips(count: int, seed: int, bbox: tuple[float, float, float, float] = DEFAULT_BBOX) -> list[Json]:
+    """
+    Generate a mix of trips in the batch_plan.py request format.
+
+    Args:
+        count: Number of trips
+        seed: Random seed, the same seed always gives the same trips
+        bbox: Extent the trips stay in (min_lon, min_lat, max_lon, max_lat)
+
+    Returns:
+        Trip requests, multi-day trips have a sleeping point at the end of every day but the last
+    """
+    rng = random.Random(seed)
+    min_lon, min_lat, max_lon, max_lat = bbox
+    trips = []
+    for i in range(count):
+        template = rng.choices(TRIP_MIX, weights=[t.weight for t in TRIP_MIX])[0]
+        lon, lat = rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+        heading = rng.uniform(0, 2 * math.pi)
+        points = [{"lat": lat, "lon": lon}]
+        for day in range(template.days):
+            step = template.day_distance_deg / (template.stops_per_day + 1)
+            for stop in range(template.stops_per_day + 1):
+                heading += rng.gauss(0, 0.4)
+                # turn back into the extent instead of leaving it
+                next_lon, next_lat = lon + step * math.cos(heading), lat + step * math.sin(heading) * 0.65
+                if not (min_lon <= next_lon <= max_lon and min_lat <= next_lat <= max_lat):
+                    heading += math.pi
+                    next_lon, next_lat = lon + step * math.cos(heading), lat + step * math.sin(heading) * 0.65
+                lon, lat = next_lon, next_lat
+                sleeps = stop == template.stops_per_day and day < template.days - 1
+                points.append({"lat": lat, "lon": lon, "type": "sleep"} if sleeps else {"lat": lat, "lon": lon})
+        trips.append(
+            {
+                "id": f"{template.name}-{i}",
+                "points": points,
+                "bike_type": rng.choice([bike_type.value for bike_type in BikeType]),
+                "daily_distance_km": template.day_distance_deg * 111 * 1.4,
+            }
+        )
+    return trips
+
+
+class LoadRecorder:
+    """Latencies and errors of every stage, shared by all virtual users."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latencies_ms: dict[str, list[float]] = collections.defaultdict(list)
+        self.errors: collections.Counter[tuple[str, str]] = collections.Counter()
+        self.span_ms: dict[str, list[float]] = collections.defaultdict(list)
+        self.db_samples: list[dict[str, int]] = []
+
+    def record(self, stage: str, started: float, error: str | None = None) -> None:
+        with self._lock:
+            if error is None:
+                self.latencies_ms[stage].append((time.perf_counter() - started) * 1000)
+            else:
+                self.errors[(stage, error)] += 1
+
+    def record_spans(self, trace: tracing.Trace) -> None:
+        with self._lock:
+            for span in trace.spans:
+                self.span_ms[span.name].append(span.duration_ms)
+
+    def record_db_sample(self, sample: dict[str, int]) -> None:
+        with self._lock:
+            self.db_samples.append(sample)
+
+
+def _timed(recorder: LoadRecorder, stage: str, fn: Callable[[], Any]) -> Any:
+    started = time.perf_counter()
+    try:
+        result = fn()
+    except Exception as e:
+        recorder.record(stage, started, error=type(e).__name__)
+        raise
+    recorder.record(stage, started)
+    return result
+
+
+def _point_json(point: Any) -> Json:
+    return {"lat": point.lat, "lon": point.lon, "type": point.type.value if point.type is not None else None}
+
+
+class EngineTarget:
+    """Runs the planning flow of the visualizer in this process."""
+
+    def __init__(self, export_profile: str) -> None:
+        self.export_profile = export_profile
+
+    def plan(self, trip: TripRequest, recorder: LoadRecorder) -> None:
+        with tracing.trace("load_test.trip") as trip_trace:
+            segments = split_route_by_sleeping_points(trip.points)
+            plan = _timed(recorder, "plan", lambda: plan_trip(segments, trip.bike_type, trip.daily_distance_m))
+            waypoints = [point for point in trip.points if point.type is not None]
+            _timed(
+                recorder,
+                "export",
+                lambda: b"".join(
+                    EXPORT_FORMATS["gpx"].write(
+                        prepare_export(
+                            plan.segment_routes,
+                            waypoints,
+                            profile=EXPORT_PROFILES[self.export_profile],
+                            keep_points=waypoints,
+                        )
+                    )
+                ),
+            )
+        recorder.record_spans(trip_trace)
+
+
+class HttpTarget:
+    """Runs the planning flow against the routing API, with a keep-alive session per virtual user."""
+
+    def __init__(self, url: str, export_profile: str) -> None:
+        self.url = url.rstrip("/")
+        self.export_profile = export_profile
+        self._local = threading.local()
+
+    def _post(self, path: str, body: Json) -> requests.Response:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        response = self._local.session.post(f"{self.url}{path}", data=orjson.dumps(body), timeout=HTTP_TIMEOUT_S)
+        if response.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+        return response
+
+    def plan(self, trip: TripRequest, recorder: LoadRecorder) -> None:
+        segments = [
+            [_point_json(point) for point in segment] for segment in split_route_by_sleeping_points(trip.points)
+        ]
+        routed = _timed(
+            recorder,
+            "route",
+            lambda: self._post("/route", {"segments": segments, "bike_type": trip.bike_type.value}).json(),
+        )
+        tracks = routed["segments"]
+        _timed(
+            recorder, "pois", lambda: self._post("/pois", {"routes": [route for track in tracks for route in track]})
+        )
+        waypoints = [_point_json(point) for point in trip.points if point.type is not None]
+        _timed(
+            recorder,
+            "export",
+            lambda: (
+                self._post(
+                    f"/export/gpx?profile={self.export_profile}", {"tracks": tracks, "waypoints": waypoints}
+                ).content
+            ),
+        )
+
+
+def _error_name(e: Exception) -> str:
+    if isinstance(e, requests.HTTPError):
+        return str(e)
+    return type(e).__name__
+
+
+def _virtual_user(
+    target: EngineTarget | HttpTarget,
+    trips: Callable[[], TripRequest],
+    recorder: LoadRecorder,
+    deadline: float,
+    think_time_s: float,
+) -> None:
+    while time.monotonic() < deadline:
+        trip = trips()
+        started = time.perf_counter()
+        try:
+            target.plan(trip, recorder)
+            recorder.record("trip", started)
+        except Exception as e:
+            recorder.record("trip", started, error=_error_name(e))
+            if not isinstance(e, (requests.RequestException, ValueError)):
+                print(f"Trip {trip.id} failed: {e}")
+                print(traceback.format_exc())
+        if think_time_s:
+            time.sleep(random.expovariate(1 / think_time_s))
+
+
+def _sample_connections(recorder: LoadRecorder, stop: threading.Event) -> None:
+    """Sample connections to the database by state, leaving out the sampling connection itself."""
+    stmt = """
+    SELECT coalesce(state, 'unknown'), count(*)
+    FROM pg_stat_activity
+    WHERE datname = current_database() AND pid <> pg_backend_pid()
+    GROUP BY 1
+    """
+    while not stop.wait(SAMPLE_INTERVAL_S):
+        try:
+            with session() as db_session:
+                sample = {state: int(count) for state, count in db_session.execute(text(stmt))}
+        except Exception as e:
+            print(f"Sampling database connections failed, giving up: {e}")
+            return
+        sample["total"] = sum(sample.values())
+        # taken after the sampling connection went back to the pool
+        sample["pool_checked_out"] = pool_checked_out()
+        recorder.record_db_sample(sample)
+
+
+def _max_connections() -> int | None:
+    try:
+        with session() as db_session:
+            return int(db_session.execute(text("SHOW max_connections")).scalar())  # type: ignore[arg-type]
+    except Exception:
+        return None
+
+
+def _percentiles(values: list[float]) -> Json:
+    if not values:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]).tolist()
+    return {"count": len(values), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "max_ms": max(values)}
+
+
+def summarize(recorder: LoadRecorder, elapsed_s: float, users: int, max_connections: int | None) -> Json:
+    stages = sorted(set(recorder.latencies_ms) | {stage for stage, _ in recorder.errors})
+    summary: Json = {"users": users, "elapsed_s": elapsed_s, "stages": {}, "spans": {}, "connections": {}}
+    for stage in stages:
+        errors = {error: count for (name, error), count in recorder.errors.items() if name == stage}
+        done = len(recorder.latencies_ms[stage])
+        summary["stages"][stage] = {
+            **_percentiles(recorder.latencies_ms[stage]),
+            "per_s": done / elapsed_s if elapsed_s else 0.0,
+            "errors": errors,
+            "error_rate": sum(errors.values()) / (done + sum(errors.values())) if done or errors else 0.0,
+        }
+    for name, values in sorted(recorder.span_ms.items()):
+        summary["spans"][name] = _percentiles(values)
+    if recorder.db_samples:
+        for key in sorted({key for sample in recorder.db_samples for key in sample}):
+            values = [sample.get(key, 0) for sample in recorder.db_samples]
+            summary["connections"][key] = {"mean": sum(values) / len(values), "max": max(values)}
+    summary["max_connections"] = max_connections
+    return summary
+
+
+def print_summary(summary: Json) -> None:
+    print(f"\n{summary['users']} users for {summary['elapsed_s']:.0f}s")
+    print(f"{'stage':>24} {'done':>7} {'per s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}  top errors")
+    for stage, stats in summary["stages"].items():
+        top = ", ".join(
+            f"{error} x{count}" for error, count in sorted(stats["errors"].items(), key=lambda e: -e[1])[:3]
+        )
+        print(
+            f"{stage:>24} {stats['count']:>7} {stats['per_s']:>7.2f} {stats.get('p50_ms', 0):>8.0f} "
+            f"{stats.get('p95_ms', 0):>8.0f} {stats.get('p99_ms', 0):>8.0f} {stats['error_rate']:>7.1%}  {top}"
+        )
+    if summary["spans"]:
+        print("\nTraced stages of the engine:")
+        for name, stats in summary["spans"].items():
+            print(
+                f"{name:>24} {stats['count']:>7} {'':>7} {stats.get('p50_ms', 0):>8.0f} {stats.get('p95_ms', 0):>8.0f} "
+                f"{stats.get('p99_ms', 0):>8.0f}"
+            )
+    if summary["connections"]:
+        print(f"\nDatabase connections (max_connections {summary['max_connections']}):")
+        for key, stats in summary["connections"].items():
+            print(f"{key:>24} mean {stats['mean']:>7.1f} max {stats['max']:>5}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the planning flow with concurrent users")
+    parser.add_argument("target", choices=["engine", "http"])
+    parser.add_argument("--url", default="http://localhost:8000", help="Routing API, for the http target")
+    parser.add_argument("--users", type=int, default=8, help="Number of concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds after which users stop starting trips")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Seconds over which users are started")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause of a user between trips, seconds")
+    parser.add_argument("--trips-file", help="JSONL file of trip requests in the batch_plan.py format")
+    parser.add_argument("--trips", type=int, default=500, help="Number of generated trips")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--profile", default="full", help="Export profile of the GPX export")
+    parser.add_argument("--real-overpass", action="store_true", help="Use OVERPASS_URL instead of the local stand-in")
+    parser.add_argument("--overpass-latency-ms", type=float, default=100.0, help="Mean latency of the stand-in")
+    parser.add_argument("--overpass-error-rate", type=float, default=0.0, help="Share of stand-in queries rejected")
+    parser.add_argument("--output", help="Write the summary to this JSON file")
+    args = parser.parse_args()
+
+    if args.trips_file:
+        with open(args.trips_file, "rb") as file:
+            trip_data = [orjson.loads(line) for line in file if line.strip()]
+    else:
+        trip_data = generate_trips(args.trips, args.seed)
+    trip_requests = [TripRequest(data) for data in trip_data]
+    trip_cycle = itertools.cycle(trip_requests)
+    trip_lock = threading.Lock()
+
+    def next_trip() -> TripRequest:
+        with trip_lock:
+            return next(trip_cycle)
+
+    target: EngineTarget | HttpTarget
+    if args.target == "engine":
+        if not args.real_overpass:
+            stub = start_overpass_stub(latency_ms=args.overpass_latency_ms, error_rate=args.overpass_error_rate)
+            # the client is created on first use, after this
+            os.environ["OVERPASS_URL"] = stub.url
+            os.environ.setdefault("OVERPASS_MIN_INTERVAL_S", "0")
+            # made up POIs of the stand-in mustn't end up in the caches of real runs
+            cache_dir = tempfile.mkdtemp(prefix="spdb_load_test_")
+            os.environ["SPDB_CACHE_PATH"] = os.path.join(cache_dir, "cache.sqlite3")
+            os.environ["LEG_STATS_PATH"] = os.path.join(cache_dir, "leg_stats.sqlite3")
+            print(f"Overpass stand-in listening on {stub.url}, caches in {cache_dir}")
+        os.environ.setdefault("DB_ECHO", "0")
+        if os.getenv("ROUTING_EXECUTOR", "thread") == "process":
+            # workers are forked, start them before any threads
+            get_routing_pool()
+        target = EngineTarget(args.profile)
+    else:
+        os.environ.setdefault("DB_ECHO", "0")
+        target = HttpTarget(args.url, args.profile)
+
+    recorder = LoadRecorder()
+    max_connections = _max_connections()
+    stop_sampling = threading.Event()
+    sampler = threading.Thread(target=_sample_connections, args=(recorder, stop_sampling), daemon=True)
+    sampler.start()
+
+    started = time.monotonic()
+    deadline = started + args.ramp_up + args.duration
+    users = []
+    for i in range(args.users):
+        user = threading.Thread(
+            target=_virtual_user,
+            args=(target, next_trip, recorder, deadline, args.think_time),
+            name=f"user-{i}",
+            daemon=True,
+        )
+        user.start()
+        users.append(user)
+        if args.ramp_up:
+            time.sleep(args.ramp_up / args.users)
+    for user in users:
+        user.join()
+    elapsed_s = time.monotonic() - started
+    stop_sampling.set()
+    sampler.join()
+
+    summary = summarize(recorder, elapsed_s, args.users, max_connections)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "wb") as file:
+            file.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == "__main__":
+    main()
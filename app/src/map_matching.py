@@ -0,0 +1,398 @@
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Iterator, NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+import orjson
+from sqlalchemy import text
+
+from db_utils import session
+from engine import NoRouteError, Point, Route
+from enums import RoadType
+from geo_utils import cumulative_distance_m, to_local_m
+
+# track points closer than this to the previous kept point add nothing but work
+SAMPLE_SPACING_M = 20.0
+# edges further than this from a track point are not considered as its position
+SEARCH_RADIUS_M = 50.0
+MAX_CANDIDATES = 8
+# standard deviation of the GPS error
+GPS_SIGMA_M = 10.0
+# scale of the allowed difference between the distance along the roads and the straight distance of two samples
+TRANSITION_BETA_M = 20.0
+# extra cost of a transition between edges which aren't connected directly, in units of TRANSITION_BETA_M
+JUMP_PENALTY = 5.0
+# the track is split into separately matched parts at gaps longer than this
+MAX_GAP_M = 2000.0
+# number of track points looked up in a single query
+CANDIDATE_BATCH_SIZE = 5000
+
+_ROAD_TYPES = [road_type.value for road_type in RoadType]
+
+
+class _Candidates(NamedTuple):
+    """Candidate edges of every sample, padded to (samples, MAX_CANDIDATES) arrays."""
+
+    valid: npt.NDArray[np.bool_]
+    gid: npt.NDArray[np.int64]
+    source: npt.NDArray[np.int64]
+    target: npt.NDArray[np.int64]
+    road_type: npt.NDArray[np.int64]
+    length_m: npt.NDArray[np.float64]
+    # position along the edge, 0 at source, 1 at target
+    fraction: npt.NDArray[np.float64]
+    distance_m: npt.NDArray[np.float64]
+    # (lon, lat) of the track point projected onto the edge, and of the edge source and target
+    snapped: npt.NDArray[np.float64]
+    source_coords: npt.NDArray[np.float64]
+    target_coords: npt.NDArray[np.float64]
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def iter_track_points(file: BinaryIO) -> Iterator[tuple[float, float]]:
+    """
+    Stream track points out of a GPX or TCX file, without loading the whole document.
+
+    Args:
+        file: GPX or TCX file
+
+    Returns:
+        Iterator of (lon, lat) pairs, in file order
+    """
+    lat: float | None = None
+    lon: float | None = None
+    for event, elem in ET.iterparse(file, events=("start", "end")):
+        tag = _local_name(elem.tag)
+        if event == "start":
+            if tag == "Trackpoint":
+                lat = lon = None
+            continue
+
+        if tag in ("trkpt", "rtept"):
+            yield float(elem.attrib["lon"]), float(elem.attrib["lat"])
+            elem.clear()
+        elif tag == "LatitudeDegrees":
+            lat = float(elem.text or "nan")
+        elif tag == "LongitudeDegrees":
+            lon = float(elem.text or "nan")
+        elif tag == "Trackpoint":
+            # course points and lap positions have coordinates too, only track points belong to the track
+            if lat is not None and lon is not None:
+                yield lon, lat
+            elem.clear()
+
+
+def read_track(file: BinaryIO) -> npt.NDArray[np.float64]:
+    """
+    Read all track points of a GPX or TCX file.
+
+    Returns:
+        Array of shape (n, 2) with (lon, lat) rows
+    """
+    points = np.fromiter(iter_track_points(file), dtype=np.dtype((np.float64, 2)))
+    return points[np.isfinite(points).all(axis=1)]
+
+
+def _downsample(lonlat: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    Drop points closer than SAMPLE_SPACING_M to the previous kept point, always keeping the last point.
+
+    Spacing is measured straight from the kept point rather than along the track, so GPS jitter of a dense
+    recording doesn't keep points which would only make the matched position go back and forth.
+    """
+    if len(lonlat) <= 2:
+        return lonlat
+    xy = to_local_m(lonlat, float(lonlat[:, 1].mean())).tolist()
+    keep = [0]
+    last_x, last_y = xy[0]
+    for i, (x, y) in enumerate(xy):
+        if (x - last_x) ** 2 + (y - last_y) ** 2 >= SAMPLE_SPACING_M**2:
+            keep.append(i)
+            last_x, last_y = x, y
+    if keep[-1] != len(lonlat) - 1:
+        keep.append(len(lonlat) - 1)
+    return lonlat[keep]
+
+
+def _split_at_gaps(lonlat: npt.NDArray[np.float64]) -> list[npt.NDArray[np.float64]]:
+    steps = np.diff(cumulative_distance_m(lonlat))
+    parts = np.split(lonlat, np.flatnonzero(steps > MAX_GAP_M) + 1)
+    return [part for part in parts if len(part) >= 2]
+
+
+def _fetch_candidates(lonlat: npt.NDArray[np.float64]) -> _Candidates:
+    """Look up the closest edges of every point in batches, using the spatial index on ways."""
+    # the bounding box prefilter is in degrees, widen it enough for the northernmost point
+    max_lat = float(np.abs(lonlat[:, 1]).max())
+    radius_deg = SEARCH_RADIUS_M / (111320.0 * np.cos(np.radians(min(max_lat, 85.0))))
+
+    stmt = """
+    SELECT
+        p.idx - 1, c.gid, c.source, c.target, c.road_type::text, c.length_m, c.fraction, c.distance_m,
+        ST_X(c.snapped), ST_Y(c.snapped), c.x1, c.y1, c.x2, c.y2
+    FROM unnest(CAST(:lons AS float8[]), CAST(:lats AS float8[])) WITH ORDINALITY AS p(lon, lat, idx)
+    CROSS JOIN LATERAL (
+        SELECT
+            gid, source, target, road_type, length_m, x1, y1, x2, y2,
+            ST_LineLocatePoint(the_geom, pt.geom) "fraction",
+            ST_ClosestPoint(the_geom, pt.geom) "snapped",
+            ST_Distance(the_geom::geography, pt.geom::geography) "distance_m"
+        FROM ways, (SELECT ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326) "geom") pt
+        WHERE ways.the_geom && ST_Expand(pt.geom, :radius_deg)
+        ORDER BY ways.the_geom <-> pt.geom
+        LIMIT :k
+    ) c
+    """
+
+    rows = []
+    with session() as db_session:
+        for batch_start in range(0, len(lonlat), CANDIDATE_BATCH_SIZE):
+            batch = lonlat[batch_start : batch_start + CANDIDATE_BATCH_SIZE]
+            result = db_session.execute(
+                text(stmt),
+                {
+                    "lons": batch[:, 0].tolist(),
+                    "lats": batch[:, 1].tolist(),
+                    "radius_deg": radius_deg,
+                    "k": MAX_CANDIDATES,
+                },
+            )
+            rows.extend((row[0] + batch_start, *row[1:]) for row in result)
+
+    n = len(lonlat)
+    shape = (n, MAX_CANDIDATES)
+    candidates = _Candidates(
+        valid=np.zeros(shape, dtype=bool),
+        gid=np.full(shape, -1, dtype=np.int64),
+        source=np.full(shape, -1, dtype=np.int64),
+        target=np.full(shape, -1, dtype=np.int64),
+        road_type=np.zeros(shape, dtype=np.int64),
+        length_m=np.zeros(shape),
+        fraction=np.zeros(shape),
+        distance_m=np.full(shape, np.inf),
+        # padding slots sit at the track point, so distances computed for them stay finite and meaningful
+        snapped=np.repeat(lonlat[:, None, :], MAX_CANDIDATES, axis=1),
+        source_coords=np.repeat(lonlat[:, None, :], MAX_CANDIDATES, axis=1),
+        target_coords=np.repeat(lonlat[:, None, :], MAX_CANDIDATES, axis=1),
+    )
+    if not rows:
+        return candidates
+
+    idx = np.array([row[0] for row in rows], dtype=np.int64)
+    distance_m = np.array([row[7] for row in rows], dtype=np.float64)
+    # rows of every point come ordered by distance, so the slot is the rank within the point
+    order = np.lexsort((distance_m, idx))
+    idx, distance_m = idx[order], distance_m[order]
+    group_start = np.r_[0, np.flatnonzero(np.diff(idx)) + 1]
+    slot = np.arange(len(idx)) - np.repeat(group_start, np.diff(np.r_[group_start, len(idx)]))
+    rows = [rows[i] for i in order.tolist()]
+    within_radius = distance_m <= SEARCH_RADIUS_M
+    at = (idx[within_radius], slot[within_radius])
+
+    def column(i: int, dtype: type) -> npt.NDArray:  # type: ignore[type-arg]
+        return np.array([row[i] for row in rows], dtype=dtype)[within_radius]
+
+    candidates.valid[at] = True
+    candidates.gid[at] = column(1, np.int64)
+    candidates.source[at] = column(2, np.int64)
+    candidates.target[at] = column(3, np.int64)
+    # NULL and unknown road types count as roads of unknown surface
+    road_type_index = {road_type: i for i, road_type in enumerate(_ROAD_TYPES)}
+    unknown = road_type_index[RoadType.unknown_surface.value]
+    candidates.road_type[at] = [road_type_index.get(road_type, unknown) for road_type in column(4, object)]
+    candidates.length_m[at] = column(5, np.float64)
+    candidates.fraction[at] = column(6, np.float64)
+    candidates.distance_m[at] = distance_m[within_radius]
+    candidates.snapped[at] = np.stack([column(8, np.float64), column(9, np.float64)], axis=1)
+    candidates.source_coords[at] = np.stack([column(10, np.float64), column(11, np.float64)], axis=1)
+    candidates.target_coords[at] = np.stack([column(12, np.float64), column(13, np.float64)], axis=1)
+    return candidates
+
+
+def _take(candidates: _Candidates, index: npt.NDArray[np.int64] | slice) -> _Candidates:
+    return _Candidates(*(field[index] for field in candidates))
+
+
+def _along_roads_m(
+    a: _Candidates, b: _Candidates
+) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_], npt.NDArray[np.float64]]:
+    """
+    Distance along the roads between positions on edges, for broadcastable candidate arrays.
+
+    Exact for positions on the same edge or on edges sharing a vertex, otherwise the straight distance.
+
+    Returns:
+        Distance in meters, whether the edges aren't directly connected, and the part of the distance on edge `a`
+    """
+    same_edge = a.gid == b.gid
+    # distance from the position on a to its end at the shared vertex, plus from that vertex to the position on b
+    to_source_a, to_target_a = a.fraction * a.length_m, (1 - a.fraction) * a.length_m
+    from_source_b, from_target_b = b.fraction * b.length_m, (1 - b.fraction) * b.length_m
+    options = [
+        (a.source == b.source, to_source_a, from_source_b),
+        (a.source == b.target, to_source_a, from_target_b),
+        (a.target == b.source, to_target_a, from_source_b),
+        (a.target == b.target, to_target_a, from_target_b),
+    ]
+    via_vertex = np.full(np.broadcast_shapes(a.gid.shape, b.gid.shape), np.inf)
+    on_a = np.zeros_like(via_vertex)
+    for shared, part_a, part_b in options:
+        total = np.where(shared, part_a + part_b, np.inf)
+        better = total < via_vertex
+        via_vertex = np.where(better, total, via_vertex)
+        on_a = np.where(better, part_a, on_a)
+
+    ref_lat = float(np.mean(a.snapped[..., 1]))
+    straight = np.linalg.norm(to_local_m(a.snapped, ref_lat) - to_local_m(b.snapped, ref_lat), axis=-1)
+
+    distance = np.where(same_edge, np.abs(b.fraction - a.fraction) * a.length_m, via_vertex)
+    jump = ~same_edge & np.isinf(via_vertex)
+    distance = np.where(jump, straight, distance)
+    on_a = np.where(same_edge, distance, np.where(jump, 0.0, on_a))
+    return distance, jump, on_a
+
+
+def _viterbi(lonlat: npt.NDArray[np.float64], candidates: _Candidates) -> npt.NDArray[np.int64]:
+    """
+    Most likely candidate of every sample under a hidden Markov model (Newson & Krumm).
+
+    Emission and transition scores of all steps are computed upfront as whole-array operations,
+    the sequential pass only takes maxima of small (candidates x candidates) matrices.
+    """
+    emission = np.where(candidates.valid, -0.5 * (candidates.distance_m / GPS_SIGMA_M) ** 2, -np.inf)
+
+    prev, nxt = _take(candidates, slice(None, -1)), _take(candidates, slice(1, None))
+    # (steps, K, 1) against (steps, 1, K)
+    along, jump, _ = _along_roads_m(
+        _Candidates(*(field[:, :, None] if field.ndim == 2 else field[:, :, None, :] for field in prev)),
+        _Candidates(*(field[:, None, :] if field.ndim == 2 else field[:, None, :, :] for field in nxt)),
+    )
+    observed = np.diff(cumulative_distance_m(lonlat))
+    transition = -np.abs(along - observed[:, None, None]) / TRANSITION_BETA_M - JUMP_PENALTY * jump
+
+    n = len(lonlat)
+    backpointer = np.zeros((n, MAX_CANDIDATES), dtype=np.int64)
+    score = emission[0]
+    for i in range(1, n):
+        total = score[:, None] + transition[i - 1]
+        backpointer[i] = total.argmax(axis=0)
+        score = total.max(axis=0) + emission[i]
+
+    states = np.zeros(n, dtype=np.int64)
+    states[-1] = int(score.argmax())
+    for i in range(n - 1, 0, -1):
+        states[i - 1] = backpointer[i, states[i]]
+    return states
+
+
+def _route_from_states(matched: _Candidates) -> Route:
+    """
+    Build a route through the matched positions.
+
+    The path is a sequence of runs of positions on one edge. Every run is traversed once from where it was entered
+    (the shared vertex with the previous edge) to where it was left, and positions going backwards within a run
+    are dropped, so GPS jitter along an edge adds neither length nor zigzags to the geometry.
+
+    Raises:
+        NoRouteError: If the positions don't move along any edge
+    """
+    n = len(matched.gid)
+    run_start = np.r_[0, np.flatnonzero(matched.gid[1:] != matched.gid[:-1]) + 1]
+    run_end = np.r_[run_start[1:] - 1, n - 1]
+    prev, nxt = _take(matched, run_end[:-1]), _take(matched, run_start[1:])
+    _, jump, _ = _along_roads_m(prev, nxt)
+
+    # fractions at which every run is entered and left: the shared vertex, or the matched position after a jump
+    at_source_prev = (prev.source == nxt.source) | (prev.source == nxt.target)
+    at_source_nxt = (nxt.source == prev.source) | (nxt.source == prev.target)
+    exit_fraction = np.r_[np.where(jump, prev.fraction, np.where(at_source_prev, 0.0, 1.0)), matched.fraction[-1]]
+    entry_fraction = np.r_[matched.fraction[0], np.where(jump, nxt.fraction, np.where(at_source_nxt, 0.0, 1.0))]
+    run_length = np.abs(exit_fraction - entry_fraction) * matched.length_m[run_start]
+
+    ref_lat = float(matched.snapped[:, 1].mean())
+    jump_length = np.where(
+        jump, np.linalg.norm(to_local_m(prev.snapped, ref_lat) - to_local_m(nxt.snapped, ref_lat), axis=1), 0.0
+    )
+    lengths = np.bincount(matched.road_type[run_start], weights=run_length, minlength=len(_ROAD_TYPES))
+    lengths += np.bincount(nxt.road_type, weights=jump_length, minlength=len(_ROAD_TYPES))
+
+    # keep positions which progress in the direction of their run; runs are offset so the running maximum resets
+    run_idx = np.repeat(np.arange(len(run_start)), run_end - run_start + 1)
+    direction = np.where(exit_fraction >= entry_fraction, 1.0, -1.0)[run_idx]
+    progress = run_idx * 10.0 + 2.0 + matched.fraction * direction
+    progressing = progress >= np.maximum.accumulate(progress)
+    # runs entered and left at the same vertex are just jitter around an intersection
+    progressing &= (run_length > 0)[run_idx]
+
+    # shared vertex after every run except after a jump and the last one
+    vertex = np.where(at_source_prev[:, None], prev.source_coords, prev.target_coords)
+    vertex[jump] = np.nan
+    points = np.where(progressing[:, None], matched.snapped, np.nan)
+    # interleave positions with the vertex closing their run
+    closing = np.full((n, 2), np.nan)
+    closing[run_end[:-1]] = vertex
+    coordinates = np.stack([points, closing], axis=1).reshape(-1, 2)
+    coordinates = coordinates[~np.isnan(coordinates).any(axis=1)]
+    if len(coordinates) < 2:
+        # every position is jitter around one place, e.g. a track recorded while standing still
+        raise NoRouteError("Track doesn't move along the road network")
+
+    start_lon, start_lat = coordinates[0].tolist()
+    end_lon, end_lat = coordinates[-1].tolist()
+    return Route(
+        start=Point(start_lat, start_lon, "Track start"),
+        end=Point(end_lat, end_lon, "Track end"),
+        geojson=orjson.dumps({"type": "LineString", "coordinates": coordinates.tolist()}).decode(),
+        geom="",
+        length_m=float(lengths.sum()),
+        length_m_road_types=dict(zip(_ROAD_TYPES, lengths.tolist())),
+    )
+
+
+def match_track(lonlat: npt.NDArray[np.float64]) -> list[Route]:
+    """
+    Snap a recorded track onto the routing graph.
+
+    Args:
+        lonlat: Array of shape (n, 2) with (lon, lat) rows
+
+    Returns:
+        Matched routes, one for every part of the track between gaps or stretches far from any road
+    """
+    routes = []
+    for part in _split_at_gaps(_downsample(lonlat)):
+        candidates = _fetch_candidates(part)
+        # stretches without any road nearby split the track too
+        has_candidates = candidates.valid.any(axis=1)
+        breaks = np.flatnonzero(np.diff(has_candidates.astype(np.int8)) != 0) + 1
+        for piece in np.split(np.arange(len(part)), breaks):
+            if len(piece) < 2 or not has_candidates[piece[0]]:
+                continue
+            piece_candidates = _take(candidates, piece)
+            states = _viterbi(part[piece], piece_candidates)
+            matched = _Candidates(*(field[np.arange(len(piece)), states] for field in piece_candidates))
+            try:
+                routes.append(_route_from_states(matched))
+            except NoRouteError as e:
+                print(f"Skipping {len(piece)} track points: {e}")
+
+    print(
+        f"Matched track of {len(lonlat)} points into {len(routes)} routes, {sum(r.length_m for r in routes) / 1000:.1f} km"
+    )
+    return routes
+
+
+def import_track(file: BinaryIO) -> list[Route]:
+    """
+    Read a GPX or TCX file and snap its track onto the routing graph.
+
+    Args:
+        file: GPX or TCX file
+
+    Returns:
+        Matched routes, see `match_track`
+    """
+    return match_track(read_track(file))
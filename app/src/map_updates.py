@@ -0,0 +1,95 @@
+"""
+Invalidation of cached results in areas changed by map updates.
+
+The OSM updater (db/osm_imports/update_osm.py) records the area of every changed part of the routing graph in
+`map_update_areas`. Processes using the caches poll for updates they haven't seen yet and drop routed legs, road
+tiles and Overpass tiles overlapping the changed areas, so the service keeps running while the map is updated underneath it.
+
+Usage:
+    python map_updates.py
+"""
+
+import functools
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+from db_utils import session
+from disk_cache import DiskCache
+from engine import get_route_flights
+from poi_suggester import get_overpass_cache
+from tiles import get_tile_cache
+
+LAST_UPDATE_KEY = "last_update_id"
+
+
+@functools.lru_cache(maxsize=1)
+def _get_state() -> DiskCache:
+    # shares the file of the caches it invalidates, so every process using them sees the same progress
+    return DiskCache(namespace="map_updates", ttl_s=float("inf"), max_entries=1)
+
+
+def invalidate_updated_areas() -> int:
+    """
+    Drop cached results overlapping areas of map updates applied since the last call.
+
+    Returns:
+        Number of map updates applied since the last call
+    """
+    state = _get_state()
+    last_update_id = int(state.get(LAST_UPDATE_KEY) or 0)
+    with session() as db_session:
+        if db_session.execute(text("SELECT to_regclass('map_update_areas')")).scalar() is None:
+            # no updates were ever applied to this database
+            return 0
+        rows = db_session.execute(
+            text(
+                """
+                SELECT update_id, min_lat, min_lon, max_lat, max_lon
+                FROM map_update_areas
+                WHERE update_id > :last_update_id
+                ORDER BY update_id
+                """
+            ),
+            {"last_update_id": last_update_id},
+        ).fetchall()
+    if not rows:
+        return 0
+
+    bboxes = [(row[1], row[2], row[3], row[4]) for row in rows]
+    updates = len({row[0] for row in rows})
+    tiles = get_overpass_cache().invalidate(bboxes)
+    legs = get_route_flights().invalidate(bboxes)
+    road_tiles = get_tile_cache().invalidate(bboxes)
+    state.put(LAST_UPDATE_KEY, str(rows[-1][0]).encode())
+    print(
+        f"Map updates: {updates} applied, dropped {tiles} cached Overpass tiles, {legs} routed legs "
+        f"and {road_tiles} road tiles"
+    )
+    if os.getenv("ROUTING_GRAPH", "database") == "memory":
+        print("Map updates: the in-memory routing graph keeps the map it was loaded with until the service restarts")
+    return updates
+
+
+def _watch(interval_s: float) -> None:
+    while True:
+        time.sleep(interval_s)
+        try:
+            invalidate_updated_areas()
+        except Exception as e:
+            # the database may be restarting, try again on the next poll
+            print(f"Error checking for map updates: {e}")
+
+
+@functools.lru_cache(maxsize=1)
+def start_update_watcher() -> None:
+    """Poll for map updates every MAP_UPDATES_POLL_S seconds in a background thread, once per process."""
+    interval_s = float(os.getenv("MAP_UPDATES_POLL_S", "60"))
+    if interval_s > 0:
+        threading.Thread(target=_watch, args=(interval_s,), name="map-updates", daemon=True).start()
+
+
+if __name__ == "__main__":
+    invalidate_updated_areas()
@@ -0,0 +1,246 @@
+import functools
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Iterable, Iterator
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+
+# a complete JSON string, or a lone quote if the string continues in the next chunk, or a structural character
+_JSON_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|["{}\]]')
+# runtime errors (timeout, out of memory) are reported after a partial elements array of a successful response
+_REMARK = re.compile(rb'"remark"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+# 429 is returned when we exceed our slot quota, 504 when the server is overloaded
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+
+class OverpassError(Exception):
+    pass
+
+
+class OverpassUnavailableError(OverpassError):
+    """Raised without contacting the server while the circuit breaker is open."""
+
+
+class OverpassClient:
+    """
+    Shared Overpass API client.
+
+    All requests go through one pooled HTTP session and are limited both in concurrency and in rate,
+    so parallel POI lookups don't get us banned. Requests failing with a retryable status or a connection
+    error are retried with jittered exponential backoff. After `breaker_threshold` consecutive failed requests
+    the circuit opens and further requests fail immediately for `breaker_cooldown_s` seconds.
+    """
+
+    def __init__(
+        self,
+        url: str = DEFAULT_OVERPASS_URL,
+        max_concurrency: int = 2,
+        min_interval_s: float = 1.0,
+        max_retries: int = 4,
+        backoff_base_s: float = 1.0,
+        backoff_max_s: float = 30.0,
+        breaker_threshold: int = 5,
+        breaker_cooldown_s: float = 60.0,
+        timeout_s: float = 60.0,
+    ) -> None:
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.min_interval_s = min_interval_s
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown_s = breaker_cooldown_s
+        self.timeout_s = timeout_s
+
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency))
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency))
+
+        self._concurrency = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+
+    def _wait_for_slot(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval_s
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _check_breaker(self) -> None:
+        with self._lock:
+            if time.monotonic() < self._open_until:
+                raise OverpassUnavailableError(
+                    f"Overpass circuit open after {self._consecutive_failures} consecutive failures"
+                )
+
+    def _record_result(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                self._consecutive_failures = 0
+                return
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.breaker_threshold:
+                self._open_until = time.monotonic() + self.breaker_cooldown_s
+                print(f"Overpass circuit opened for {self.breaker_cooldown_s}s")
+
+    def _backoff_s(self, attempt: int, response: requests.Response | None) -> float:
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), self.backoff_max_s)
+        # full jitter: spread retries of parallel requests so they don't hit the server at once
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * 2**attempt))
+
+    def _release_on_close(self, response: requests.Response) -> None:
+        # the body of a streamed response is still being downloaded from the server, keep its slot until it's closed
+        close = response.close
+        once = threading.Lock()
+
+        def close_and_release() -> None:
+            try:
+                close()
+            finally:
+                if once.acquire(blocking=False):
+                    self._concurrency.release()
+
+        response.close = close_and_release  # type: ignore[method-assign]
+
+    def query(self, query: str, stream: bool = False) -> requests.Response:
+        """
+        Run an Overpass QL query.
+
+        Args:
+            query: Overpass QL query
+            stream: Don't read the response body upfront. The request counts against `max_concurrency` until the
+                response is closed, so use it as a context manager.
+
+        Returns:
+            Successful response
+
+        Raises:
+            OverpassUnavailableError: The circuit breaker is open
+            OverpassError: The query failed after all retries
+        """
+        self._check_breaker()
+
+        last_error: Exception | None = None
+        for attempt in range(self.max_retries + 1):
+            response: requests.Response | None = None
+            self._concurrency.acquire()
+            holds_slot = True
+            try:
+                self._wait_for_slot()
+                response = self._session.post(self.url, data={"data": query}, timeout=self.timeout_s, stream=stream)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    response.raise_for_status()
+                    self._record_result(success=True)
+                    if stream:
+                        self._release_on_close(response)
+                        holds_slot = False
+                    return response
+                last_error = OverpassError(f"Overpass returned HTTP {response.status_code}")
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = e
+            except requests.HTTPError as e:
+                # non-retryable status, e.g. 400 for a malformed query
+                response.close()  # type: ignore[union-attr]
+                self._record_result(success=False)
+                raise OverpassError(str(e)) from e
+            finally:
+                if holds_slot:
+                    self._concurrency.release()
+
+            if attempt < self.max_retries:
+                delay = self._backoff_s(attempt, response)
+                print(f"Overpass request failed ({last_error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+        self._record_result(success=False)
+        raise OverpassError(f"Overpass request failed after {self.max_retries + 1} attempts: {last_error}")
+
+
+def iter_elements(chunks: Iterable[bytes]) -> Iterator[dict[str, Any]]:
+    """
+    Incrementally parse the "elements" array of an Overpass JSON response.
+
+    Only the byte range of one element is buffered at a time and each element is decoded with orjson
+    as soon as it is complete, so memory use is bounded by the chunk and element size, not the response size.
+
+    Args:
+        chunks: Response body chunks, e.g. `response.iter_content(...)`
+
+    Returns:
+        Iterator of decoded elements
+
+    Raises:
+        OverpassError: The query failed after some elements were sent, or the response is truncated.
+            Elements yielded before are valid, but not all of them.
+    """
+    chunks = iter(chunks)
+    buf = b""
+    pos = 0  # position up to which buf was scanned
+    start = 0  # start of the element currently being read
+    depth = 0
+    in_array = False
+
+    for chunk in chunks:
+        # drop everything that was already consumed
+        cut = start if depth > 0 else pos
+        buf = buf[cut:] + chunk
+        pos -= cut
+        start -= cut
+
+        if not in_array:
+            key_idx = buf.find(b'"elements"')
+            array_idx = buf.find(b"[", key_idx) if key_idx != -1 else -1
+            if array_idx == -1:
+                # keep the key, or a tail in case the key is split between chunks
+                pos = key_idx if key_idx != -1 else max(len(buf) - len(b'"elements"'), 0)
+                continue
+            in_array = True
+            pos = array_idx + 1
+
+        for match in _JSON_TOKEN.finditer(buf, pos):
+            token = match.group()
+            if token == b'"':
+                # string continues in the next chunk, rescan it once more data arrives
+                break
+            pos = match.end()
+            if token == b"{":
+                if depth == 0:
+                    start = match.start()
+                depth += 1
+            elif token == b"}":
+                depth -= 1
+                if depth == 0:
+                    yield orjson.loads(buf[start : match.end()])
+            elif token == b"]" and depth == 0:
+                # the rest of the response is a few bytes, unless the query failed
+                remark = _REMARK.search(buf[pos:] + b"".join(chunks))
+                if remark is not None:
+                    raise OverpassError(f"Overpass query failed: {orjson.loads(remark[1])}")
+                return
+
+    raise OverpassError("Overpass response ended before the end of the elements array")
+
+
+@functools.lru_cache(maxsize=1)
+def get_overpass_client() -> OverpassClient:
+    return OverpassClient(
+        url=os.getenv("OVERPASS_URL", DEFAULT_OVERPASS_URL),
+        max_concurrency=int(os.getenv("OVERPASS_MAX_CONCURRENCY", "2")),
+        min_interval_s=float(os.getenv("OVERPASS_MIN_INTERVAL_S", "1.0")),
+        max_retries=int(os.getenv("OVERPASS_MAX_RETRIES", "4")),
+    )
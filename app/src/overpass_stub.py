@@ -0,0 +1,184 @@
+"""
+Local stand-in for the Overpass API, for load tests and offline development.
+
+Queries built by the POI suggester are answered with made-up elements: for every clause of the query, nodes or ways
+matching its tag selector are scattered over its bounding box at a fixed density. Elements are derived from the
+clause, so the same query always gets the same answer. Response latency and a share of rate-limited responses can be
+configured to see how the client copes with a slow or overloaded server.
+
+Usage:
+    python overpass_stub.py --port 8010 --latency-ms 200 --error-rate 0.05
+    OVERPASS_URL=http://localhost:8010/api/interpreter python api.py
+"""
+
+import argparse
+import hashlib
+import http.server
+import random
+import re
+import threading
+import time
+from typing import Any
+from urllib.parse import parse_qs
+
+import numpy as np
+import orjson
+
+# elements of every selector per square degree, about 2 per 0.1 degree tile
+DEFAULT_DENSITY = 200.0
+
+# node["tourism"="museum"](50.0,19.9,50.1,20.0);
+_CLAUSE = re.compile(r"(node|way)((?:\[[^\]]*\])+)\(([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\);")
+# ["key"="value"] or ["key"~"^(a|b)$"]
+_SELECTOR = re.compile(r'\["([^"]+)"(=|~)"([^"]*)"\]')
+
+
+def _tags(selector: str, rng: np.random.Generator) -> dict[str, str]:
+    tags = {}
+    for key, operator, pattern in _SELECTOR.findall(selector):
+        if operator == "~":
+            options = pattern.strip("^$()").split("|")
+            tags[key] = options[rng.integers(len(options))]
+        else:
+            tags[key] = pattern
+    return tags
+
+
+def _clause_elements(element: str, selector: str, bbox: tuple[float, float, float, float], density: float) -> list[Any]:
+    """Elements answering a single clause, always the same for the same clause."""
+    seed = hashlib.blake2b(f"{element}{selector}{bbox}".encode(), digest_size=8).digest()
+    rng = np.random.default_rng(int.from_bytes(seed, "big"))
+    min_lat, min_lon, max_lat, max_lon = bbox
+    count = rng.poisson(density * max(max_lat - min_lat, 0) * max(max_lon - min_lon, 0))
+
+    elements = []
+    for _ in range(count):
+        lat, lon = float(rng.uniform(min_lat, max_lat)), float(rng.uniform(min_lon, max_lon))
+        tags = _tags(selector, rng)
+        element_id = int(rng.integers(1, 2**40))
+        tags["name"] = f"{next(iter(tags.values()), element).replace('_', ' ').title()} {element_id % 10000}"
+        if element == "node":
+            elements.append({"type": "node", "id": element_id, "lat": lat, "lon": lon, "tags": tags})
+        else:
+            elements.append({"type": "way", "id": element_id, "center": {"lat": lat, "lon": lon}, "tags": tags})
+    return elements
+
+
+def answer_query(query: str, density: float = DEFAULT_DENSITY) -> bytes:
+    """
+    Overpass JSON response to an Overpass QL query.
+
+    Args:
+        query: Query with `element[selectors](south,west,north,east);` clauses
+        density: Elements of every clause per square degree
+
+    Returns:
+        Response body
+    """
+    elements = []
+    for element, selector, *bbox in _CLAUSE.findall(query):
+        elements.extend(_clause_elements(element, selector, tuple(float(value) for value in bbox), density))  # type: ignore[arg-type]
+    return orjson.dumps({"version": 0.6, "generator": "spdb overpass stub", "elements": elements})
+
+
+class OverpassStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status: int, body: bytes, headers: dict[str, str] | None = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        server: OverpassStubServer = self.server  # type: ignore[assignment]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server.lock:
+            server.queries += 1
+        if server.latency_s:
+            time.sleep(random.expovariate(1 / server.latency_s))
+        if random.random() < server.error_rate:
+            with server.lock:
+                server.rejected += 1
+            self._send(429, b'{"remark": "rate limited by stub"}', {"Retry-After": "1"})
+            return
+        query = parse_qs(body.decode()).get("data", [""])[0]
+        self._send(200, answer_query(query, server.density))
+
+    def log_message(self, message_format: str, *args: Any) -> None:
+        # one line per query would drown the output of a load test
+        pass
+
+
+class OverpassStubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        density: float = DEFAULT_DENSITY,
+        latency_ms: float = 0.0,
+        error_rate: float = 0.0,
+    ) -> None:
+        super().__init__(address, OverpassStubHandler)
+        self.density = density
+        self.latency_s = latency_ms / 1000
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.rejected = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/interpreter"
+
+
+def start_overpass_stub(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    density: float = DEFAULT_DENSITY,
+    latency_ms: float = 0.0,
+    error_rate: float = 0.0,
+) -> OverpassStubServer:
+    """
+    Serve the stand-in from a background thread.
+
+    Args:
+        host: Address to listen on
+        port: Port to listen on, any free port if 0
+        density: Elements of every clause per square degree
+        latency_ms: Mean response latency, exponentially distributed
+        error_rate: Share of queries answered with HTTP 429
+
+    Returns:
+        Running server, its endpoint is `server.url`
+    """
+    server = OverpassStubServer((host, port), density=density, latency_ms=latency_ms, error_rate=error_rate)
+    threading.Thread(target=server.serve_forever, name="overpass-stub", daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Overpass API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument(
+        "--density", type=float, default=DEFAULT_DENSITY, help="Elements per selector per square degree"
+    )
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Mean response latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of queries answered with HTTP 429")
+    args = parser.parse_args()
+
+    server = OverpassStubServer(
+        (args.host, args.port), density=args.density, latency_ms=args.latency_ms, error_rate=args.error_rate
+    )
+    print(f"Overpass stand-in listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import concurrent.futures
+import traceback
+from typing import NamedTuple
+
+import tracing
+from engine import Point, Route
+from enums import BikeType
+from helper import calculate_day_endpoints, merge_routes
+from poi_suggester import (
+    deduplicate_points,
+    poi_candidates,
+    rank_by_detour,
+    routes_line,
+    suggest_sleeping_places_for_endpoints,
+    target_poi_count,
+)
+from routing_workers import iter_route_legs
+
+SLEEP_SEARCH_RADIUS_DEG = 0.1
+
+
+class TripPlan(NamedTuple):
+    segment_routes: list[list[Route]]
+    pois: list[Point]
+    sleeping_places: list[Point]
+
+
+def _segment_sleeping_places(routes: list[Route], daily_distance_m: float) -> list[Point]:
+    """Split a finished segment into days and look up sleeping places around every day endpoint."""
+    day_endpoints = calculate_day_endpoints(merge_routes(routes), daily_distance_m)
+    places_by_endpoint = suggest_sleeping_places_for_endpoints(day_endpoints, radius_deg=SLEEP_SEARCH_RADIUS_DEG)
+    return [place for places in places_by_endpoint for place in places]
+
+
+def _collect(futures: list[concurrent.futures.Future[list[Point]]], stage: str) -> list[Point]:
+    points: list[Point] = []
+    for future in futures:
+        try:
+            points.extend(future.result())
+        except Exception as e:
+            # a failed lookup shouldn't throw away the routes
+            print(f"Error in {stage} stage: {str(e)}")
+            print(traceback.format_exc())
+    return points
+
+
+def plan_trip(segments: list[list[Point]], bike_type: BikeType, daily_distance_m: float) -> TripPlan:
+    """
+    Route a trip and suggest POIs and sleeping places for it, overlapping all stages.
+
+    Legs are streamed out of routing as they finish. Corridor POI lookup starts for every leg right away,
+    and day splitting with sleeping place lookup starts for every segment as soon as all its legs are routed.
+    At the end POIs from all legs are deduplicated and ranked together, and sleeping places are deduplicated.
+
+    Args:
+        segments: Lists of points, each routed through in order, e.g. from `split_route_by_sleeping_points`
+        bike_type: Bike type to route for
+        daily_distance_m: Daily distance limit in meters
+
+    Returns:
+        Routes for every segment with suggested POIs and sleeping places
+    """
+    segment_legs: list[list[Route | None]] = [[None] * (len(segment) - 1) for segment in segments]
+    poi_futures: list[concurrent.futures.Future[list[Point]]] = []
+    sleeping_futures: list[concurrent.futures.Future[list[Point]]] = []
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for segment_idx, leg_idx, route in iter_route_legs(segments, bike_type):
+            legs = segment_legs[segment_idx]
+            legs[leg_idx] = route
+            poi_futures.append(tracing.submit(executor, poi_candidates, [route]))
+
+            if all(leg is not None for leg in legs):
+                sleeping_futures.append(
+                    tracing.submit(executor, _segment_sleeping_places, legs, daily_distance_m)  # type: ignore[arg-type]
+                )
+
+        segment_routes: list[list[Route]] = segment_legs  # type: ignore[assignment]
+        all_routes = [route for routes in segment_routes for route in routes]
+
+        candidates = deduplicate_points(_collect(poi_futures, "POI"))
+        pois = rank_by_detour(candidates, routes_line(all_routes), target_poi_count(all_routes))
+        sleeping_places = deduplicate_points(_collect(sleeping_futures, "sleeping place"))
+
+    print(
+        f"Trip planned: {len(all_routes)} legs, {len(pois)} of {len(candidates)} POIs, {len(sleeping_places)} sleeping places"
+    )
+    return TripPlan(segment_routes=segment_routes, pois=pois, sleeping_places=sleeping_places)
+
+
+def suggest_places(segment_routes: list[list[Route]], daily_distance_m: float) -> TripPlan:
+    """
+    Suggest POIs and sleeping places for a trip routed beforehand, e.g. with legs from a cache.
+
+    Args:
+        segment_routes: Routes of the legs of every segment
+        daily_distance_m: Daily distance limit in meters
+
+    Returns:
+        The routes with suggested POIs and sleeping places
+    """
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        poi_futures = [
+            tracing.submit(executor, poi_candidates, [route]) for routes in segment_routes for route in routes
+        ]
+        sleeping_futures = [
+            tracing.submit(executor, _segment_sleeping_places, routes, daily_distance_m)
+            for routes in segment_routes
+            if routes
+        ]
+        all_routes = [route for routes in segment_routes for route in routes]
+
+        candidates = deduplicate_points(_collect(poi_futures, "POI"))
+        pois = rank_by_detour(candidates, routes_line(all_routes), target_poi_count(all_routes))
+        sleeping_places = deduplicate_points(_collect(sleeping_futures, "sleeping place"))
+
+    return TripPlan(segment_routes=segment_routes, pois=pois, sleeping_places=sleeping_places)
@@ -1,16 +1,46 @@
 # poi_suggester.py
 # poi_suggester.py
+import functools
 import json
-import random
-from typing import Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import math
-
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterator, NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+import orjson
 import requests
 from geojson.utils import coords  # type: ignore[import-untyped]
 from shapely.geometry import LineString  # type: ignore[import-untyped]
 
-from engine import Point, Route, PointTypes
+import tracing
+from disk_cache import DiskCache
+from engine import Point, PointTypes, Route
+from geo_utils import EARTH_RADIUS_M, distance_to_polyline_m, route_coordinates
+from overpass import OverpassError, get_overpass_client, iter_elements
+
+# POIs further away from the route than this are not worth the detour
+MAX_POI_DISTANCE_M = 10000
+# detour equivalent of suggesting yet another POI of an already suggested category
+CATEGORY_REPEAT_PENALTY_M = 2000
+
+# (lat index, lon index) of a cell in a fixed grid of tile_deg x tile_deg degrees
+Tile = tuple[int, int]
+
+# tiles being fetched by any thread of the process, by cache key, so lookups of neighbouring legs fetch them once
+_tiles_in_flight: dict[str, Future[list[Point]]] = {}
+_tiles_in_flight_lock = threading.Lock()
+
+
+class OverpassKind(NamedTuple):
+    name: str
+    tile_deg: float
+    selectors: list[str]
+    parse: Callable[[dict[str, Any]], Point | None]
+    point_type: PointTypes
 
 
 def _calculate_bbox_area(bbox: tuple[float, float, float, float]) -> float:
@@ -19,307 +49,619 @@ def _calculate_bbox_area(bbox: tuple[float, float, float, float]) -> float:
     return (max_lat - min_lat) * (max_lon - min_lon)
 
 
-def _split_bbox(bbox: tuple[float, float, float, float], max_area: float = 0.01) -> list[tuple[float, float, float, float]]:
+def _in_bbox(point: Point, bbox: tuple[float, float, float, float]) -> bool:
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return min_lat <= point.lat <= max_lat and min_lon <= point.lon <= max_lon
+
+
+def _pad_bbox(bbox: tuple[float, float, float, float], distance_m: float) -> tuple[float, float, float, float]:
+    """Grow a bounding box by `distance_m` on every side."""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    pad_lat = math.degrees(distance_m / EARTH_RADIUS_M)
+    pad_lon = pad_lat / max(math.cos(math.radians(max(abs(min_lat), abs(max_lat)))), 0.01)
+    return min_lat - pad_lat, min_lon - pad_lon, max_lat + pad_lat, max_lon + pad_lon
+
+
+def _tiles_for_bbox(bbox: tuple[float, float, float, float], tile_deg: float) -> list[Tile]:
     """
-    Split a large bounding box into smaller chunks if it exceeds max_area.
-    
+    List the grid tiles covering a bounding box.
+
+    Tiles are aligned to a fixed grid, so overlapping bounding boxes of different routes map to the same tiles
+    and can be answered from the cache.
+
     Args:
-        bbox: Original bounding box (min_lat, min_lon, max_lat, max_lon)
-        max_area: Maximum area per chunk in square degrees (default: 0.01)
-    
+        bbox: Bounding box (min_lat, min_lon, max_lat, max_lon)
+        tile_deg: Tile edge length in degrees
+
     Returns:
-        List of smaller bounding boxes
+        List of tiles intersecting the bounding box
     """
     min_lat, min_lon, max_lat, max_lon = bbox
-    area = _calculate_bbox_area(bbox)
-    
-    if area <= max_area:
-        return [bbox]
-    
-    # Calculate how many splits we need in each dimension
-    splits_needed = math.ceil(area / max_area)
-    splits_per_dim = math.ceil(math.sqrt(splits_needed))
-    
-    lat_step = (max_lat - min_lat) / splits_per_dim
-    lon_step = (max_lon - min_lon) / splits_per_dim
-    
-    chunks = []
-    for i in range(splits_per_dim):
-        for j in range(splits_per_dim):
-            chunk_min_lat = min_lat + i * lat_step
-            chunk_max_lat = min(min_lat + (i + 1) * lat_step, max_lat)
-            chunk_min_lon = min_lon + j * lon_step
-            chunk_max_lon = min(min_lon + (j + 1) * lon_step, max_lon)
-            
-            chunks.append((chunk_min_lat, chunk_min_lon, chunk_max_lat, chunk_max_lon))
-    
-    return chunks
-
-
-def _query_overpass_chunk(bbox: tuple[float, float, float, float]) -> list[Point]:
+    return [
+        (lat_idx, lon_idx)
+        for lat_idx in range(math.floor(min_lat / tile_deg), math.floor(max_lat / tile_deg) + 1)
+        for lon_idx in range(math.floor(min_lon / tile_deg), math.floor(max_lon / tile_deg) + 1)
+    ]
+
+
+def _tile_bbox(tile: Tile, tile_deg: float) -> tuple[float, float, float, float]:
+    lat_idx, lon_idx = tile
+    return (
+        round(lat_idx * tile_deg, 6),
+        round(lon_idx * tile_deg, 6),
+        round((lat_idx + 1) * tile_deg, 6),
+        round((lon_idx + 1) * tile_deg, 6),
+    )
+
+
+def _tile_of(point: Point, tile_deg: float) -> Tile:
+    return math.floor(point.lat / tile_deg), math.floor(point.lon / tile_deg)
+
+
+def _element_coords(element: dict[str, Any]) -> tuple[float, float] | None:
+    # Get coordinates (handle both nodes and ways)
+    if element["type"] == "node":
+        return element["lat"], element["lon"]
+    elif element["type"] == "way" and "center" in element:
+        return element["center"]["lat"], element["center"]["lon"]
+    return None
+
+
+def _element_ref(element: dict[str, Any]) -> str:
+    return f"{element['type']}/{element['id']}"
+
+
+def _element_to_poi(element: dict[str, Any]) -> Point | None:
+    latlon = _element_coords(element)
+    if latlon is None:
+        return None
+
+    # Extract name and create description
+    tags = element.get("tags", {})
+    name = tags.get("name", "Unknown POI")
+
+    # shorten name to max 20 characters
+    description = f"{name[:20]}..." if len(name) > 20 else name
+
+    category = next((f"{key}={tags[key]}" for key in ("tourism", "historic", "natural") if key in tags), None)
+
+    return Point(
+        latlon[0], latlon[1], description, type=PointTypes.POI, osm_ref=_element_ref(element), category=category
+    )
+
+
+def _element_to_sleeping_place(element: dict[str, Any]) -> Point | None:
+    latlon = _element_coords(element)
+    if latlon is None:
+        return None
+
+    # Extract name and create description
+    tags = element.get("tags", {})
+    name = tags.get("name", "Unnamed Accommodation")
+
+    # Determine accommodation type
+    accommodation_type = _determine_accommodation_type(tags)
+    description = f"{name} ({accommodation_type})"
+
+    return Point(
+        latlon[0],
+        latlon[1],
+        description,
+        type=PointTypes.SLEEPING,
+        osm_ref=_element_ref(element),
+        category=f"tourism={tags.get('tourism')}",
+    )
+
+
+POI_KIND = OverpassKind(
+    name="poi",
+    tile_deg=0.5,
+    selectors=[
+        # Tourist attractions
+        '["tourism"="attraction"]',
+        '["tourism"="museum"]',
+        '["tourism"="castle"]',
+        '["tourism"="monument"]',
+        '["tourism"="viewpoint"]',
+        '["tourism"="zoo"]',
+        '["tourism"="aquarium"]',
+        '["tourism"="theme_park"]',
+        # Historic sites
+        '["historic"="castle"]',
+        '["historic"="monument"]',
+        '["historic"="memorial"]',
+        '["historic"="archaeological_site"]',
+        '["historic"="ruins"]',
+        '["historic"="fort"]',
+        # Natural features
+        '["natural"="peak"]',
+        '["natural"="volcano"]',
+        '["natural"="cave_entrance"]',
+        '["natural"="hot_spring"]',
+        '["natural"="geyser"]',
+    ],
+    parse=_element_to_poi,
+    point_type=PointTypes.POI,
+)
+
+SLEEPING_KIND = OverpassKind(
+    name="sleeping",
+    tile_deg=0.2,
+    selectors=[
+        # Hotels and accommodations
+        '["tourism"~"^(hotel|motel|hostel|guest_house|bed_and_breakfast|apartment|chalet)$"]',
+        # Camping
+        '["tourism"~"^(camp_site|caravan_site|alpine_hut|wilderness_hut)$"]',
+    ],
+    parse=_element_to_sleeping_place,
+    point_type=PointTypes.SLEEPING,
+)
+
+
+@functools.lru_cache(maxsize=1)
+def get_overpass_cache() -> DiskCache:
+    return DiskCache(
+        namespace="overpass",
+        ttl_s=float(os.getenv("OVERPASS_CACHE_TTL_S", "604800")),
+        max_entries=int(os.getenv("OVERPASS_CACHE_MAX_ENTRIES", "20000")),
+    )
+
+
+def _tile_cache_key(kind: OverpassKind, tile: Tile) -> str:
+    return f"{kind.name}:{kind.tile_deg}:{tile[0]}:{tile[1]}"
+
+
+def _encode_points(points: list[Point]) -> bytes:
+    return orjson.dumps([{k: v for k, v in p._asdict().items() if k != "type"} for p in points])
+
+
+def _decode_points(data: bytes, kind: OverpassKind) -> list[Point]:
+    return [Point(**row, type=kind.point_type) for row in orjson.loads(data)]
+
+
+def _build_overpass_query(kind: OverpassKind, bboxes: list[tuple[float, float, float, float]]) -> str:
+    def clauses(element: str) -> str:
+        return "\n".join(
+            f"  {element}{selector}({min_lat},{min_lon},{max_lat},{max_lon});"
+            for min_lat, min_lon, max_lat, max_lon in bboxes
+            for selector in kind.selectors
+        )
+
+    # only request what we parse: coordinates and tags of nodes, center and tags of ways, no metadata or way members
+    return f"""
+[out:json][timeout:25];
+(
+{clauses("node")}
+)->.nodes;
+(
+{clauses("way")}
+)->.ways;
+.nodes out qt;
+.ways out tags center qt;
+"""
+
+
+def _iter_overpass_points(kind: OverpassKind, bboxes: list[tuple[float, float, float, float]]) -> Iterator[Point]:
     """
-    Query Overpass API for a single bounding box chunk.
-    
+    Query Overpass API for all elements of a kind within the given bounding boxes, using a single request.
+    The response is parsed as it is downloaded.
+
     Args:
-        bbox: Bounding box (min_lat, min_lon, max_lat, max_lon)
-        max_results: Maximum number of results to return for this chunk
-    
+        kind: What to query for
+        bboxes: List of bounding boxes (min_lat, min_lon, max_lat, max_lon)
+
     Returns:
-        List of Point objects from this chunk
+        Iterator of Point objects found in any of the bounding boxes
     """
-    min_lat, min_lon, max_lat, max_lon = bbox
-    
-    # Optimized Overpass query with exact matches instead of regex
-    overpass_query = f"""
-    [out:json][timeout:25];
-    (
-      // Tourist attractions
-      node["tourism"="attraction"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["tourism"="museum"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["tourism"="castle"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["tourism"="monument"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["tourism"="viewpoint"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["tourism"="zoo"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["tourism"="aquarium"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["tourism"="theme_park"]({min_lat},{min_lon},{max_lat},{max_lon});
-      
-      way["tourism"="attraction"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"="museum"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"="castle"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"="monument"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"="viewpoint"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"="zoo"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"="aquarium"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"="theme_park"]({min_lat},{min_lon},{max_lat},{max_lon});
-      
-      // Historic sites
-      node["historic"="castle"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["historic"="monument"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["historic"="memorial"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["historic"="archaeological_site"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["historic"="ruins"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["historic"="fort"]({min_lat},{min_lon},{max_lat},{max_lon});
-      
-      way["historic"="castle"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["historic"="monument"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["historic"="memorial"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["historic"="archaeological_site"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["historic"="ruins"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["historic"="fort"]({min_lat},{min_lon},{max_lat},{max_lon});
-      
-      // Natural features
-      node["natural"="peak"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["natural"="volcano"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["natural"="cave_entrance"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["natural"="hot_spring"]({min_lat},{min_lon},{max_lat},{max_lon});
-      node["natural"="geyser"]({min_lat},{min_lon},{max_lat},{max_lon});
-      
-      way["natural"="peak"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["natural"="volcano"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["natural"="cave_entrance"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["natural"="hot_spring"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["natural"="geyser"]({min_lat},{min_lon},{max_lat},{max_lon});
-    );
-    out center meta;
+    response = get_overpass_client().query(_build_overpass_query(kind, bboxes), stream=True)
+
+    print(
+        f"Overpass {kind.name} response for {len(bboxes)} tiles started after {response.elapsed.total_seconds()} seconds"
+    )
+
+    with response:
+        for element in iter_elements(response.iter_content(chunk_size=64 * 1024)):
+            point = kind.parse(element)
+            if point is not None:
+                yield point
+
+
+def _claim_tiles(kind: OverpassKind, tiles: list[Tile]) -> tuple[list[Tile], list[Future[list[Point]]]]:
+    """Split tiles into the ones to fetch and the futures of the ones already being fetched by other threads."""
+    claimed, in_flight = [], []
+    with _tiles_in_flight_lock:
+        for tile in tiles:
+            key = _tile_cache_key(kind, tile)
+            if key in _tiles_in_flight:
+                in_flight.append(_tiles_in_flight[key])
+            else:
+                _tiles_in_flight[key] = Future()
+                claimed.append(tile)
+    return claimed, in_flight
+
+
+def _finish_tiles(
+    kind: OverpassKind, tiles: list[Tile], points_by_tile: dict[Tile, list[Point]] | None, error: Exception | None
+) -> None:
+    """Hand the points of claimed tiles, or the error fetching them, to threads waiting for them."""
+    with _tiles_in_flight_lock:
+        futures = [_tiles_in_flight.pop(_tile_cache_key(kind, tile), None) for tile in tiles]
+    for tile, future in zip(tiles, futures):
+        if future is None:
+            continue
+        if points_by_tile is None:
+            future.set_exception(error or OverpassError(f"Fetching {kind.name} tile {tile} was cancelled"))
+        else:
+            future.set_result(points_by_tile[tile])
+
+
+def _fetch_batch(kind: OverpassKind, batch: list[Tile], results: queue.Queue[Point | Exception | None]) -> None:
+    """
+    Stream points of a batch of tiles into `results`, then cache every tile of the batch.
+    Finishes by putting None on success or the exception on failure.
     """
+    # way centers may fall outside of the requested tiles, these are dropped and picked up with their own tile
+    points_by_tile: dict[Tile, list[Point]] = {tile: [] for tile in batch}
+    with tracing.span("overpass.chunk", kind=kind.name, tiles=len(batch)) as chunk_span:
+        try:
+            for point in _iter_overpass_points(kind, [_tile_bbox(tile, kind.tile_deg) for tile in batch]):
+                tile = _tile_of(point, kind.tile_deg)
+                if tile in points_by_tile:
+                    points_by_tile[tile].append(point)
+                    results.put(point)
+        except (OverpassError, requests.RequestException, orjson.JSONDecodeError, KeyError) as e:
+            print(f"Error fetching {kind.name} tiles {batch}: {e}")
+            if chunk_span is not None:
+                chunk_span.set(error=str(e))
+            _finish_tiles(kind, batch, None, e)
+            results.put(e)
+            return
+        if chunk_span is not None:
+            chunk_span.set(points=sum(len(points) for points in points_by_tile.values()))
+
+    cache = get_overpass_cache()
+    for tile, tile_points in points_by_tile.items():
+        cache.put(_tile_cache_key(kind, tile), _encode_points(tile_points), bbox=_tile_bbox(tile, kind.tile_deg))
+    _finish_tiles(kind, batch, points_by_tile, None)
+    results.put(None)
+
+
+def _iter_tiles(kind: OverpassKind, tiles: list[Tile], batch_size: int) -> Iterator[Point]:
+    """
+    Get all points of a kind within the given tiles, answering from the tile cache where possible.
+
+    Tiles missing from the cache are fetched in batches of `batch_size` tiles per Overpass request,
+    with batches queried in parallel through the shared Overpass client. Points are yielded as soon
+    as they are parsed, cached tiles first. Each fetched tile is cached separately, including empty ones.
+    Tiles which other threads are fetching at the same time are waited for rather than fetched again.
+    Failed batches are skipped and not cached.
 
+    Args:
+        kind: What to query for
+        tiles: Tiles to fetch
+        batch_size: Maximum number of tiles fetched by a single Overpass request
+
+    Returns:
+        Iterator of Point objects located in the tiles
+
+    Raises:
+        OverpassError: Every Overpass request failed and nothing was cached
+    """
+    cache = get_overpass_cache()
+    missing: list[Tile] = []
+    cached_points: list[Point] = []
+    with tracing.span("overpass.cache", kind=kind.name, tiles=len(tiles)) as cache_span:
+        for tile in tiles:
+            cached = cache.get(_tile_cache_key(kind, tile))
+            if cached is None:
+                missing.append(tile)
+            else:
+                cached_points.extend(_decode_points(cached, kind))
+        if cache_span is not None:
+            cache_span.set(missing=len(missing), points=len(cached_points))
+    found = len(cached_points)
+    yield from cached_points
+
+    claimed, in_flight = _claim_tiles(kind, missing)
+    batches = [claimed[i : i + batch_size] for i in range(0, len(claimed), max(batch_size, 1))]
+    if not batches and not in_flight:
+        return
+
+    client = get_overpass_client()
+    results: queue.Queue[Point | Exception | None] = queue.Queue()
+    errors: list[Exception] = []
+    remaining = len(batches)
+
+    executor = ThreadPoolExecutor(max_workers=client.max_concurrency)
+    submitted: dict[Future[None], list[Tile]] = {}
     try:
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        response = requests.post(overpass_url, data=overpass_query, timeout=30)
-        response.raise_for_status()
-        
-        data = response.json()
-        elements = data.get("elements", [])
-        
-        pois: list[Point] = []
-        
-        for element in elements:
-            # Get coordinates (handle both nodes and ways)
-            if element["type"] == "node":
-                lat, lon = element["lat"], element["lon"]
-            elif element["type"] == "way" and "center" in element:
-                lat, lon = element["center"]["lat"], element["center"]["lon"]
+        for batch in batches:
+            submitted[tracing.submit(executor, _fetch_batch, kind, batch, results)] = batch
+
+        while remaining:
+            item = results.get()
+            if isinstance(item, Point):
+                found += 1
+                yield item
             else:
+                remaining -= 1
+                if item is not None:
+                    errors.append(item)
+
+        for future in in_flight:
+            try:
+                points = future.result()
+            except Exception as e:
+                errors.append(e)
                 continue
+            found += len(points)
+            yield from points
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # batches which never started release their tiles, running ones finish them on their own
+        for future, batch in submitted.items():
+            if future.cancelled():
+                _finish_tiles(kind, batch, None, None)
+    # partial results are still useful, but don't pretend nothing was found if every request failed
+    if len(errors) == len(batches) + len(in_flight) and not found:
+        raise OverpassError(f"All {len(errors)} Overpass requests for {kind.name} failed") from errors[-1]
+
+
+def iter_pois(bbox: tuple[float, float, float, float], line: npt.NDArray[np.float64] | None = None) -> Iterator[Point]:
+    """
+    Stream unique Points of Interest within the given bounding box as they are fetched.
 
-            # Extract name and create description
-            tags = element.get("tags", {})
-            name = tags.get("name", "Unknown POI")
+    Args:
+        bbox: Tuple of (min_lat, min_lon, max_lat, max_lon)
+        line: Optional route polyline as (lon, lat) rows, the bbox is grown by MAX_POI_DISTANCE_M around it and tiles
+            further than that from it are skipped
+
+    Returns:
+        Iterator of Point objects representing interesting places
+    """
+    if line is not None and len(line):
+        # the bbox of a leg heading east or north is flat, POIs next to the route lie outside of it
+        bbox = _pad_bbox(bbox, MAX_POI_DISTANCE_M)
+        tiles = _tiles_near_line(_tiles_for_bbox(bbox, POI_KIND.tile_deg), POI_KIND.tile_deg, line, MAX_POI_DISTANCE_M)
+    else:
+        tiles = _tiles_for_bbox(bbox, POI_KIND.tile_deg)
+
+    # Remove duplicates (POIs that might appear in multiple tiles)
+    deduplicator = _PointDeduplicator()
+    for poi in _iter_tiles(POI_KIND, tiles, batch_size=1):
+        if _in_bbox(poi, bbox) and deduplicator.add(poi):
+            yield poi
+
+
+def _tiles_near_line(
+    tiles: list[Tile], tile_deg: float, line: npt.NDArray[np.float64], max_distance_m: float
+) -> list[Tile]:
+    """Keep tiles which may contain points within `max_distance_m` of the line."""
+    centers = [Point((lat_idx + 0.5) * tile_deg, (lon_idx + 0.5) * tile_deg) for lat_idx, lon_idx in tiles]
+    # half of the tile diagonal, measured along the meridian as an upper bound
+    half_diagonal_m = math.sqrt(2) * tile_deg / 2 * math.radians(1) * EARTH_RADIUS_M
+    distances = distance_to_polyline_m(centers, line)
+    return [tile for tile, distance in zip(tiles, distances) if distance <= max_distance_m + half_diagonal_m]
+
+
+@tracing.traced("poi.rank")
+def rank_by_detour(candidates: list[Point], line: npt.NDArray[np.float64], n: int) -> list[Point]:
+    """
+    Pick the `n` candidates which are cheapest to visit from the route, preferring a mix of categories.
 
-            # shorten name to max 20 characters
-            description = f"{name[:20]}..." if len(name) > 20 else name
+    The detour cost of a candidate is the out-and-back distance from the nearest point of the route.
+    Each further candidate of the same category is penalised by CATEGORY_REPEAT_PENALTY_M,
+    so a cheap but uniform set (e.g. only memorials) doesn't push out everything else.
 
-            poi = Point(lat, lon, description, type=PointTypes.POI)
-            pois.append(poi)
+    Args:
+        candidates: Candidate points
+        line: Route polyline as (lon, lat) rows
+        n: Number of points to return
 
-        return pois
-        
-    except (requests.RequestException, json.JSONDecodeError, KeyError) as e:
-        print(f"Error fetching POIs from chunk {bbox}: {e}")
+    Returns:
+        Up to `n` points, best first
+    """
+    if not candidates or n <= 0:
         return []
 
+    detour_m = 2 * distance_to_polyline_m(candidates, line)
+
+    # rank of every candidate within its category, by detour
+    category_rank = np.zeros(len(candidates))
+    seen_per_category: dict[str | None, int] = {}
+    for idx in np.argsort(detour_m, kind="stable"):
+        category = candidates[idx].category
+        category_rank[idx] = seen_per_category.get(category, 0)
+        seen_per_category[category] = seen_per_category.get(category, 0) + 1
+
+    score = detour_m + category_rank * CATEGORY_REPEAT_PENALTY_M
+    return [candidates[idx] for idx in np.argsort(score, kind="stable")[:n]]
 
-def suggest_pois(bbox: tuple[float, float, float, float]) -> list[Point]:
+
+def target_poi_count(routes: list[Route]) -> int:
+    """Number of POIs worth suggesting for the given routes, based on the area they span."""
+    bbox_area = _calculate_bbox_area(get_max_bounds_from_routes(routes))
+    return min(max(round(bbox_area * 50), 10), 100)
+
+
+def routes_line(routes: list[Route]) -> npt.NDArray[np.float64]:
+    return np.concatenate([route_coordinates(route) for route in routes])
+
+
+@tracing.traced("poi.candidates")
+def poi_candidates(routes: list[Route]) -> list[Point]:
     """
-    Suggest Points of Interest using the Overpass API within the given bounding box.
-    Large bounding boxes are split into smaller chunks and queried in parallel.
+    Get all unique Points of Interest near the given routes, unranked.
+    Candidates are fetched for grid tiles near the routes, served from the tile cache or queried in parallel.
 
     Args:
-        bbox: Tuple of (min_lat, min_lon, max_lat, max_lon)
+        routes: Routes to find POIs for
 
     Returns:
         List of Point objects representing interesting places
     """
-    min_lat, min_lon, max_lat, max_lon = bbox
-    bbox_area = _calculate_bbox_area(bbox)
-    
-    # Calculate target number of POIs based on area
-    n = min(round(bbox_area * 50), 100)
-    print(f"Target POIs: {n}, Bbox area: {bbox_area:.4f} sq degrees")
-    
-    # Split large bounding boxes into smaller chunks
-    chunks = _split_bbox(bbox, max_area=max(0.8, bbox_area / 9))
-    print(f"Split bbox into {len(chunks)} chunks for parallel processing")
-    
-    # Calculate max results per chunk
-    
-    # Query chunks in parallel using ThreadPoolExecutor
-    all_pois: list[Point] = []
-    
-    with ThreadPoolExecutor() as executor:
-        # Submit all chunk queries
-        future_to_chunk = {
-            executor.submit(_query_overpass_chunk, chunk): chunk 
-            for chunk in chunks
-        }
-        
-        print("Waiting for Overpass API responses...")
-        
-        # Collect results as they complete
-    for future in as_completed(future_to_chunk):
-        chunk = future_to_chunk[future]
-        try:
-            chunk_pois = future.result()
-            all_pois.extend(chunk_pois)
-            print(f"Chunk {chunk} returned {len(chunk_pois)} POIs")
-        except Exception as e:
-            print(f"Error processing chunk {chunk}: {e}")
-    
-    # Remove duplicates (POIs that might appear in multiple chunks)
-    unique_pois = _deduplicate_pois(all_pois)
-    
-    # Randomly sample to target number if we have too many
-    if len(unique_pois) > n:
-        unique_pois = random.sample(unique_pois, n)
-    
-    print(f"Total unique POIs found: {len(unique_pois)}")
-    return unique_pois
-
-
-def _deduplicate_pois(pois: list[Point]) -> list[Point]:
+    if not routes:
+        return []
+    return list(iter_pois(get_max_bounds_from_routes(routes), routes_line(routes)))
+
+
+def suggest_pois(routes: list[Route]) -> list[Point]:
     """
-    Remove duplicate POIs based on proximity (within ~50 meters).
-    
+    Suggest Points of Interest along the given routes using the Overpass API,
+    ranked by the detour needed to visit them.
+
     Args:
-        pois: List of POI points
-        
+        routes: Routes to suggest POIs for
+
     Returns:
-        List of unique POI points
+        List of Point objects representing interesting places, best first
     """
-    if not pois:
+    if not routes:
         return []
-    
-    unique_pois = []
+
+    n = target_poi_count(routes)
+    candidates = poi_candidates(routes)
+    pois = rank_by_detour(candidates, routes_line(routes), n)
+
+    print(f"Total unique POIs found: {len(candidates)}, suggesting {len(pois)}")
+    return pois
+
+
+class _PointDeduplicator:
+    """
+    Incrementally filters out duplicate points: repeated OSM elements and points within ~50 meters of an already kept one.
+
+    Kept points are hashed into grid cells of the duplicate distance, so each point is only compared
+    with points kept in its own and the 8 neighbouring cells, which keeps this linear in the number of points.
+    """
+
     min_distance_deg = 0.0005  # Approximately 50 meters
-    
-    for poi in pois:
-        is_duplicate = False
-        for unique_poi in unique_pois:
-            # Simple distance check (Euclidean distance in degrees)
-            lat_diff = abs(poi.lat - unique_poi.lat)
-            lon_diff = abs(poi.lon - unique_poi.lon)
-            if lat_diff < min_distance_deg and lon_diff < min_distance_deg:
-                is_duplicate = True
-                break
-        
-        if not is_duplicate:
-            unique_pois.append(poi)
-    
-    return unique_pois
 
+    def __init__(self) -> None:
+        self._seen_refs: set[str] = set()
+        self._cells: dict[tuple[int, int], list[Point]] = {}
+
+    def add(self, point: Point) -> bool:
+        """Returns True if the point is not a duplicate of any point added before."""
+        # the same OSM element may be returned by several overlapping queries
+        if point.osm_ref is not None:
+            if point.osm_ref in self._seen_refs:
+                return False
+            self._seen_refs.add(point.osm_ref)
+
+        cell_lat, cell_lon = (
+            math.floor(point.lat / self.min_distance_deg),
+            math.floor(point.lon / self.min_distance_deg),
+        )
+        is_duplicate = any(
+            abs(point.lat - kept.lat) < self.min_distance_deg and abs(point.lon - kept.lon) < self.min_distance_deg
+            for d_lat in (-1, 0, 1)
+            for d_lon in (-1, 0, 1)
+            for kept in self._cells.get((cell_lat + d_lat, cell_lon + d_lon), ())
+        )
+        if is_duplicate:
+            return False
+
+        self._cells.setdefault((cell_lat, cell_lon), []).append(point)
+        return True
+
+
+def deduplicate_points(pois: list[Point]) -> list[Point]:
+    """
+    Remove duplicate POIs based on OSM element and proximity (within ~50 meters).
+
+    Args:
+        pois: List of POI points
 
+    Returns:
+        List of unique POI points, in input order
+    """
+    deduplicator = _PointDeduplicator()
+    return [poi for poi in pois if deduplicator.add(poi)]
 
 
 def suggest_sleeping_places(bbox: tuple[float, float, float, float]) -> list[Point]:
     """
     Suggest sleeping places using the Overpass API within the given bounding box.
+    All tiles missing from the tile cache are fetched with a single request.
 
     Args:
         bbox: Tuple of (min_lat, min_lon, max_lat, max_lon)
-        n: Number of sleeping places to return (default: 5)
 
     Returns:
         List of Point objects representing accommodation options
     """
-    min_lat, min_lon, max_lat, max_lon = bbox
-
-    # Overpass API query to find accommodation
-    overpass_query = f"""
-    [out:json][timeout:25];
-    (
-      // Hotels and accommodations
-      node["tourism"~"^(hotel|motel|hostel|guest_house|bed_and_breakfast|apartment|chalet)$"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"~"^(hotel|motel|hostel|guest_house|bed_and_breakfast|apartment|chalet)$"]({min_lat},{min_lon},{max_lat},{max_lon});
-      
-      // Camping
-      node["tourism"~"^(camp_site|caravan_site|alpine_hut|wilderness_hut)$"]({min_lat},{min_lon},{max_lat},{max_lon});
-      way["tourism"~"^(camp_site|caravan_site|alpine_hut|wilderness_hut)$"]({min_lat},{min_lon},{max_lat},{max_lon});
-    );
-    out center meta;
-    """
-    print(overpass_query)
-
-    try:
-        # Make request to Overpass API
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        response = requests.post(overpass_url, data=overpass_query, timeout=30)
-        response.raise_for_status()
+    tiles = _tiles_for_bbox(bbox, SLEEPING_KIND.tile_deg)
+    sleep_points = [p for p in _iter_tiles(SLEEPING_KIND, tiles, batch_size=len(tiles)) if _in_bbox(p, bbox)]
+    sleep_points = deduplicate_points(sleep_points)
 
-        print("Sleeping places: Overpass API response received, req took", response.elapsed.total_seconds(), "seconds")
+    # Keep at most 20 results closest to the center of the area
+    center = Point((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+    return sorted(sleep_points, key=lambda point: _approx_distance_m(point, center))[:20]
 
-        data = response.json()
-        elements = data.get("elements", [])
 
-        sleep_points: list[Point] = []
-
-        for element in elements:
-            # Get coordinates (handle both nodes and ways)
-            if element["type"] == "node":
-                lat, lon = element["lat"], element["lon"]
-            elif element["type"] == "way" and "center" in element:
-                lat, lon = element["center"]["lat"], element["center"]["lon"]
-            else:
-                continue
-
-            # Extract name and create description
-            tags = element.get("tags", {})
-            name = tags.get("name", "Unnamed Accommodation")
-
-            # Determine accommodation type
-            accommodation_type = _determine_accommodation_type(tags)
-            description = f"{name} ({accommodation_type})"
+@tracing.traced("sleeping.lookup")
+def suggest_sleeping_places_for_endpoints(
+    endpoints: list[Point],
+    radius_deg: float = 0.1,
+    max_per_endpoint: int = 20,
+) -> list[list[Point]]:
+    """
+    Suggest sleeping places around every day endpoint of a trip at once.
 
-            point = Point(lat, lon, description, type=PointTypes.SLEEPING)
-            sleep_points.append(point)
+    The union of all search areas is covered with tiles, and every tile missing from the tile cache
+    is fetched with a single Overpass request. Each place is assigned to the nearest endpoint
+    whose search area contains it, and places are ranked by distance to their endpoint.
 
+    Args:
+        endpoints: Day endpoints to search around
+        radius_deg: Half of the search area edge length around each endpoint, in degrees
+        max_per_endpoint: Maximum number of places returned per endpoint
 
-        # Randomly sample at most 20 results
-        if len(sleep_points) > 20:
-            sleep_points = random.sample(sleep_points, 20)
-        return sleep_points
+    Returns:
+        List with one list of sleeping places per endpoint, closest first
+    """
+    if not endpoints:
+        return []
 
-    except (requests.RequestException, json.JSONDecodeError, KeyError) as e:
-        print(f"Error fetching sleeping places from Overpass API: {e}")
+    endpoint_bboxes = [
+        (
+            float(endpoint.lat) - radius_deg,
+            float(endpoint.lon) - radius_deg,
+            float(endpoint.lat) + radius_deg,
+            float(endpoint.lon) + radius_deg,
+        )
+        for endpoint in endpoints
+    ]
+    tiles = list(
+        dict.fromkeys(tile for bbox in endpoint_bboxes for tile in _tiles_for_bbox(bbox, SLEEPING_KIND.tile_deg))
+    )
+    sleep_points = deduplicate_points(list(_iter_tiles(SLEEPING_KIND, tiles, batch_size=len(tiles))))
+
+    places_by_endpoint: list[list[tuple[float, Point]]] = [[] for _ in endpoints]
+    for point in sleep_points:
+        candidates = [
+            (_approx_distance_m(point, endpoint), idx)
+            for idx, (endpoint, bbox) in enumerate(zip(endpoints, endpoint_bboxes))
+            if _in_bbox(point, bbox)
+        ]
+        if candidates:
+            distance, idx = min(candidates)
+            places_by_endpoint[idx].append((distance, point))
+
+    print(f"Found {len(sleep_points)} sleeping places for {len(endpoints)} endpoints in {len(tiles)} tiles")
+    return [
+        [point for _, point in sorted(places, key=lambda place: place[0])[:max_per_endpoint]]
+        for places in places_by_endpoint
+    ]
+
+
+def _approx_distance_m(a: Point, b: Point) -> float:
+    """Equirectangular distance approximation, accurate enough at the scale of a day endpoint search area."""
+    mean_lat = math.radians((a.lat + b.lat) / 2)
+    d_lat = math.radians(b.lat - a.lat)
+    d_lon = math.radians(b.lon - a.lon) * math.cos(mean_lat)
+    return 6371000 * math.sqrt(d_lat**2 + d_lon**2)
 
 
 def _determine_accommodation_type(tags: dict[str, Any]) -> str:
@@ -337,7 +679,7 @@ def _determine_accommodation_type(tags: dict[str, Any]) -> str:
         "camp_site": "Campsite",
         "caravan_site": "Caravan Site",
         "alpine_hut": "Alpine Hut",
-        "wilderness_hut": "Wilderness Hut"
+        "wilderness_hut": "Wilderness Hut",
     }
 
     return type_mapping.get(tourism_type, "Accommodation")
@@ -0,0 +1,606 @@
+"""
+Reproducible routing benchmark on a synthetic road graph.
+
+The synthetic graph has the schema of the imported `ways` and `ways_vertices_pgr` tables: a jittered grid of
+vertices with primary and secondary corridors every few rows and columns, minor roads of the remaining road types,
+one-way and missing edges, and grid columns computed as by the import script. It is generated from a seed, so the
+same parameters always give the same graph, at any scale up to millions of edges.
+
+The graph is either loaded into a schema of the local PostGIS/pgRouting database, which leaves the imported tables
+alone, or built directly in memory for the in-memory routing backend. Every run routes a fixed set of short, medium
+and cross-country legs, reports latency percentiles and scanned edges per workload and appends the results to a
+JSONL file, so runs can be compared over time.
+
+Usage:
+    python routing_benchmark.py load --edges 1000000 --seed 1 --schema benchmark
+    python routing_benchmark.py run --backend database --schema benchmark --label "grid index"
+    python routing_benchmark.py run --backend database
+    python routing_benchmark.py run --backend memory --edges 1000000 --seed 1
+    python routing_benchmark.py compare --last 10
+"""
+
+import argparse
+import datetime
+import io
+import math
+import os
+import re
+import secrets
+import subprocess
+import tempfile
+import time
+from typing import Any, Callable, NamedTuple
+
+import numpy as np
+import orjson
+from sqlalchemy import text
+
+import shared_graph
+import tracing
+from db_utils import session
+from engine import NoRouteError, Point, Route, find_route
+from enums import BikeType, RoadType
+from geo_utils import EARTH_RADIUS_M, hilbert_index
+from weights import BIKE_TYPE_WEIGHTS
+
+DEFAULT_BBOX = (14.1, 49.0, 24.2, 54.9)
+DEFAULT_RESULTS_PATH = "benchmark_results.jsonl"
+# rows sent to the database in one COPY
+COPY_BATCH_SIZE = 200_000
+
+# every n-th row and column of the grid is a primary or secondary road, the rest are minor roads
+PRIMARY_EVERY = 24
+SECONDARY_EVERY = 6
+MINOR_ROAD_TYPE_SHARES = {
+    RoadType.paved: 0.45,
+    RoadType.unpaved: 0.3,
+    RoadType.unknown_surface: 0.18,
+    RoadType.cycleway: 0.07,
+}
+ONEWAY_SHARE = 0.05
+# share of minor roads left out, so the grid isn't perfectly regular
+MISSING_SHARE = 0.1
+# cell size of the grid columns, as in the import script
+GRID_CELL_LON, GRID_CELL_LAT = 0.2, 0.16
+# width of the longitude band partitions of the clustered layout, as in the import script
+PARTITION_WIDTH_DEG = 1.0
+# row orders of the synthetic `ways` table: clustered along the grid and partitioned as by the import script, or
+# scattered over the heap as by an import appending extract after extract
+LAYOUTS = ["clustered", "scattered"]
+
+
+class SyntheticGraph(NamedTuple):
+    # vertex ids are indices + 1, vertices without ways are left out of the database
+    vertex_lon: np.ndarray
+    vertex_lat: np.ndarray
+    # columns of the ways table, road types as indices into shared_graph.ROAD_TYPES
+    ways: dict[str, np.ndarray]
+    # every way is a line of three points, the middle one slightly off the straight line
+    way_coordinates: np.ndarray
+
+
+class Workload(NamedTuple):
+    name: str
+    # straight distance between the ends of a leg, in degrees
+    min_deg: float
+    max_deg: float
+    legs: int
+
+
+WORKLOADS = [
+    Workload("short", 0.02, 0.08, 40),
+    Workload("medium", 0.3, 0.8, 20),
+    Workload("cross_country", 3.0, 6.0, 6),
+]
+
+
+class LegMeasurement(NamedTuple):
+    # search and geometry time, without snapping and statistics
+    latency_ms: float
+    scanned_edges: int | None
+    routed: bool
+
+
+def generate_graph(edges: int, seed: int, bbox: tuple[float, float, float, float] = DEFAULT_BBOX) -> SyntheticGraph:
+    """
+    Generate a synthetic road graph.
+
+    Args:
+        edges: Approximate number of ways
+        seed: Random seed, the same seed and parameters always give the same graph
+        bbox: Extent of the graph (min_lon, min_lat, max_lon, max_lat)
+
+    Returns:
+        Synthetic graph
+    """
+    rng = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = bbox
+    width, height = max_lon - min_lon, max_lat - min_lat
+    # a grid has about two ways per vertex
+    columns = max(round(math.sqrt(edges / 2 * width / height)), 2)
+    rows = max(round(edges / 2 / columns), 2)
+    step_lon, step_lat = width / (columns - 1), height / (rows - 1)
+
+    row, column = np.divmod(np.arange(rows * columns), columns)
+    vertex_lon = min_lon + (column + rng.uniform(-0.3, 0.3, len(row))) * step_lon
+    vertex_lat = min_lat + (row + rng.uniform(-0.3, 0.3, len(row))) * step_lat
+
+    # horizontal ways follow their row, vertical ways their column
+    horizontal = np.flatnonzero(column < columns - 1)
+    vertical = np.flatnonzero(row < rows - 1)
+    source = np.concatenate([horizontal, vertical])
+    target = np.concatenate([horizontal + 1, vertical + columns])
+    line = np.concatenate([row[horizontal], column[vertical]])
+
+    codes = {road_type: code for code, road_type in enumerate(shared_graph.ROAD_TYPES)}
+    minor_types = list(MINOR_ROAD_TYPE_SHARES)
+    road_type = np.array([codes[rt] for rt in minor_types], dtype=np.int8)[
+        rng.choice(len(minor_types), size=len(source), p=list(MINOR_ROAD_TYPE_SHARES.values()))
+    ]
+    road_type[line % SECONDARY_EVERY == 0] = codes[RoadType.secondary]
+    road_type[line % PRIMARY_EVERY == 0] = codes[RoadType.primary]
+
+    minor = road_type != codes[RoadType.primary]
+    minor &= road_type != codes[RoadType.secondary]
+    keep = ~(minor & (rng.random(len(source)) < MISSING_SHARE))
+    source, target, road_type = source[keep], target[keep], road_type[keep]
+
+    x1, y1, x2, y2 = vertex_lon[source], vertex_lat[source], vertex_lon[target], vertex_lat[target]
+    mid_lon = (x1 + x2) / 2 + rng.normal(0, 0.1 * step_lon, len(source))
+    mid_lat = (y1 + y2) / 2 + rng.normal(0, 0.1 * step_lat, len(source))
+    lon_scale = np.cos(np.radians(mid_lat))
+    length = np.hypot(mid_lon - x1, mid_lat - y1) + np.hypot(x2 - mid_lon, y2 - mid_lat)
+    length_m = (
+        np.radians(
+            np.hypot((mid_lon - x1) * lon_scale, mid_lat - y1) + np.hypot((x2 - mid_lon) * lon_scale, y2 - mid_lat)
+        )
+        * EARTH_RADIUS_M
+    )
+    reverse_cost = np.where(rng.random(len(source)) < ONEWAY_SHARE, -length, length)
+
+    way_coordinates = np.empty((len(source) * 3, 2))
+    way_coordinates[0::3] = np.column_stack([x1, y1])
+    way_coordinates[1::3] = np.column_stack([mid_lon, mid_lat])
+    way_coordinates[2::3] = np.column_stack([x2, y2])
+
+    # the middle point stands in for the centroid of the way
+    ways = {
+        "gid": np.arange(1, len(source) + 1, dtype=np.int64),
+        "source": source.astype(np.int64) + 1,
+        "target": target.astype(np.int64) + 1,
+        "length": length,
+        "length_m": length_m,
+        "reverse_cost": reverse_cost,
+        "x1": x1,
+        "y1": y1,
+        "x2": x2,
+        "y2": y2,
+        "road_type": road_type,
+        "grid_lon": np.round(np.round(mid_lon / GRID_CELL_LON) * GRID_CELL_LON * 100),
+        "grid_lat": np.round(np.round(mid_lat / GRID_CELL_LAT) * GRID_CELL_LAT * 100),
+    }
+    return SyntheticGraph(vertex_lon=vertex_lon, vertex_lat=vertex_lat, ways=ways, way_coordinates=way_coordinates)
+
+
+def build_memory_graph(graph: SyntheticGraph) -> shared_graph.GraphArrays:
+    """Graph arrays of the in-memory routing backend for a synthetic graph."""
+    way_offsets = np.arange(0, len(graph.way_coordinates) + 1, 3)
+    return shared_graph.build_graph(graph.ways, way_offsets, graph.way_coordinates)
+
+
+def _check_schema(schema: str) -> str:
+    if not re.fullmatch(r"[a-z_][a-z0-9_]*", schema):
+        raise ValueError(f"Invalid schema name: {schema}")
+    return schema
+
+
+def _copy_binary(cursor: Any, table: str, columns: dict[str, np.ndarray]) -> None:
+    """COPY columns of 64-bit integers and floats into a table in the binary format, without formatting any values."""
+    fields = [("count", ">i2")]
+    for i, (name, values) in enumerate(columns.items()):
+        fields += [(f"size_{i}", ">i4"), (name, ">i8" if values.dtype.kind in "iu" else ">f8")]
+    rows = np.empty(len(next(iter(columns.values()))), dtype=fields)
+    rows["count"] = len(columns)
+    for i, (name, values) in enumerate(columns.items()):
+        rows[f"size_{i}"] = 8
+        rows[name] = values
+    # signature, flags and header extension length, tuples, end marker
+    data = b"PGCOPY\n\xff\r\n\x00" + bytes(8) + rows.tobytes() + b"\xff\xff"
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)", io.BytesIO(data))
+
+
+def _row_order(graph: SyntheticGraph, layout: str, seed: int) -> np.ndarray:
+    """Order the ways are written in: along a Hilbert curve through the grid cells and within cells, or random."""
+    ways = graph.ways
+    if layout == "scattered":
+        return np.random.default_rng(seed).permutation(len(ways["gid"]))
+    cell_x = np.round(ways["grid_lon"] / (GRID_CELL_LON * 100)).astype(np.int64)
+    cell_y = np.round(ways["grid_lat"] / (GRID_CELL_LAT * 100)).astype(np.int64)
+    middle = graph.way_coordinates[1::3]
+    in_x = np.clip((middle[:, 0] / GRID_CELL_LON - cell_x + 0.5) * 1024, 0, 1023).astype(np.int64)
+    in_y = np.clip((middle[:, 1] / GRID_CELL_LAT - cell_y + 0.5) * 1024, 0, 1023).astype(np.int64)
+    keys = (hilbert_index(cell_x + (1 << 15), cell_y + (1 << 15), 16) << 20) | hilbert_index(in_x, in_y, 10)
+    return np.argsort(keys, kind="stable")
+
+
+def _ways_ddl(schema: str, layout: str, grid_lon: np.ndarray) -> list[str]:
+    columns = """
+        gid bigint, source bigint, target bigint, length double precision, length_m double precision,
+        cost double precision, reverse_cost double precision, x1 double precision, y1 double precision,
+        x2 double precision, y2 double precision, road_type public.road_type_enum, grid_lon numeric NOT NULL,
+        grid_lat numeric NOT NULL, the_geom geometry(LineString, 4326)
+    """
+    if layout == "scattered":
+        return [f"CREATE TABLE {schema}.ways ({columns})"]
+    width = round(PARTITION_WIDTH_DEG * 100)
+    lowest = int(grid_lon.min()) // width * width
+    return [
+        f"CREATE TABLE {schema}.ways ({columns}) PARTITION BY RANGE (grid_lon)",
+        *(
+            f"CREATE TABLE {schema}.ways_lon_{str(lower).replace('-', 'm')} PARTITION OF {schema}.ways "
+            f"FOR VALUES FROM ({lower}) TO ({lower + width})"
+            for lower in range(lowest, int(grid_lon.max()) + 1, width)
+        ),
+    ]
+
+
+def load_graph_into_database(
+    graph: SyntheticGraph, schema: str, params: dict[str, Any], layout: str = "clustered"
+) -> None:
+    """
+    Load a synthetic graph into its own schema, replacing the tables of a previous load.
+
+    Args:
+        graph: Synthetic graph
+        schema: Schema of the `ways` and `ways_vertices_pgr` tables
+        params: Generation parameters, kept as the comment of the schema
+        layout: Physical order of the `ways` table, see LAYOUTS
+    """
+    schema = _check_schema(schema)
+    road_types = [road_type.value for road_type in shared_graph.ROAD_TYPES]
+    enum_labels = ", ".join(f"'{value}'" for value in road_types)
+    ways = graph.ways
+    used = np.zeros(len(graph.vertex_lon) + 1, dtype=bool)
+    used[ways["source"]] = True
+    used[ways["target"]] = True
+    vertex_ids = np.flatnonzero(used)
+
+    with session() as db_session:
+        for stmt in [
+            "CREATE EXTENSION IF NOT EXISTS postgis",
+            "CREATE EXTENSION IF NOT EXISTS pgrouting",
+            f"""
+            DO $$ BEGIN
+                CREATE TYPE public.road_type_enum AS ENUM ({enum_labels});
+            EXCEPTION WHEN duplicate_object THEN NULL;
+            END $$
+            """,
+            f"CREATE SCHEMA IF NOT EXISTS {schema}",
+            f"DROP TABLE IF EXISTS {schema}.ways, {schema}.ways_vertices_pgr",
+            f"""
+            CREATE TABLE {schema}.ways_vertices_pgr (
+                id bigint, lon double precision, lat double precision, the_geom geometry(Point, 4326)
+            )
+            """,
+            *_ways_ddl(schema, layout, ways["grid_lon"]),
+            # plain numbers are copied in, geometries and road types are built by the database
+            "CREATE TEMP TABLE vertices_load (id bigint, lon float8, lat float8) ON COMMIT DROP",
+            """
+            CREATE TEMP TABLE ways_load (
+                gid bigint, source bigint, target bigint, length float8, length_m float8, reverse_cost float8,
+                x1 float8, y1 float8, x2 float8, y2 float8, mid_lon float8, mid_lat float8, road_type bigint,
+                grid_lon float8, grid_lat float8, position bigint
+            ) ON COMMIT DROP
+            """,
+        ]:
+            db_session.execute(text(stmt))
+
+        cursor = db_session.connection().connection.cursor()
+        for begin in range(0, len(vertex_ids), COPY_BATCH_SIZE):
+            ids = vertex_ids[begin : begin + COPY_BATCH_SIZE]
+            _copy_binary(
+                cursor, "vertices_load", {"id": ids, "lon": graph.vertex_lon[ids - 1], "lat": graph.vertex_lat[ids - 1]}
+            )
+        db_session.execute(
+            text(
+                f"""
+                INSERT INTO {schema}.ways_vertices_pgr (id, lon, lat, the_geom)
+                SELECT id, lon, lat, ST_SetSRID(ST_MakePoint(lon, lat), 4326) FROM vertices_load
+                """
+            )
+        )
+
+        middle = graph.way_coordinates[1::3]
+        position = np.empty(len(ways["gid"]), dtype=np.int64)
+        position[_row_order(graph, layout, params.get("seed", 0))] = np.arange(len(position))
+        for begin in range(0, len(ways["gid"]), COPY_BATCH_SIZE):
+            batch = slice(begin, begin + COPY_BATCH_SIZE)
+            columns = {name: values[batch] for name, values in ways.items()}
+            columns.update(mid_lon=middle[batch, 0], mid_lat=middle[batch, 1], position=position[batch])
+            _copy_binary(cursor, "ways_load", columns)
+            print(f"Copied {min(begin + COPY_BATCH_SIZE, len(ways['gid']))} of {len(ways['gid'])} ways")
+        db_session.execute(
+            text(
+                f"""
+                INSERT INTO {schema}.ways (
+                    gid, source, target, length, length_m, cost, reverse_cost, x1, y1, x2, y2, road_type, grid_lon,
+                    grid_lat, the_geom
+                )
+                SELECT
+                    gid, source, target, length, length_m, length, reverse_cost, x1, y1, x2, y2,
+                    CAST((CAST(:road_types AS text[]))[road_type + 1] AS public.road_type_enum), grid_lon, grid_lat,
+                    ST_SetSRID(ST_MakeLine(ARRAY[
+                        ST_MakePoint(x1, y1), ST_MakePoint(mid_lon, mid_lat), ST_MakePoint(x2, y2)
+                    ]), 4326)
+                FROM ways_load
+                ORDER BY position
+                """
+            ),
+            {"road_types": road_types},
+        )
+
+        # same indices as the import script
+        clustered = layout == "clustered"
+        for stmt in [
+            f"ALTER TABLE {schema}.ways ADD PRIMARY KEY {'(gid, grid_lon)' if clustered else '(gid)'}",
+            f"ALTER TABLE {schema}.ways_vertices_pgr ADD PRIMARY KEY (id)",
+            f"CREATE INDEX ON {schema}.ways USING gist (the_geom)",
+            f"CREATE INDEX ON {schema}.ways_vertices_pgr USING gist (the_geom)",
+            f"CREATE INDEX ON {schema}.ways (source)",
+            f"CREATE INDEX ON {schema}.ways (target)",
+            f"CREATE INDEX ON {schema}.ways (gid, road_type)",
+            *(
+                [
+                    f"CREATE INDEX ON {schema}.ways USING brin (grid_lon, grid_lat) "
+                    "WITH (pages_per_range = 16, autosummarize = on)"
+                ]
+                if clustered
+                else [f"CREATE INDEX ON {schema}.ways (grid_lon)", f"CREATE INDEX ON {schema}.ways (grid_lat)"]
+            ),
+            f"ANALYZE {schema}.ways",
+            f"ANALYZE {schema}.ways_vertices_pgr",
+        ]:
+            db_session.execute(text(stmt))
+        db_session.execute(
+            text(f"COMMENT ON SCHEMA {schema} IS :params").bindparams(params=orjson.dumps(params).decode())
+        )
+
+
+def _schema_params(schema: str) -> dict[str, Any]:
+    with session() as db_session:
+        comment = db_session.execute(
+            text("SELECT obj_description(CAST(:schema AS regnamespace), 'pg_namespace')"), {"schema": schema}
+        ).scalar()
+    return orjson.loads(comment) if comment else {}
+
+
+def _database_extent() -> tuple[float, float, float, float]:
+    with session() as db_session:
+        row = db_session.execute(text("SELECT min(lon), min(lat), max(lon), max(lat) FROM ways_vertices_pgr")).one()
+    return tuple(float(value) for value in row)  # type: ignore[return-value]
+
+
+def workload_legs(workload: Workload, bbox: tuple[float, float, float, float], seed: int) -> list[tuple[Point, Point]]:
+    """
+    Legs of a workload, the same for the same extent and seed.
+
+    Args:
+        workload: Workload
+        bbox: Extent the legs have to stay in (min_lon, min_lat, max_lon, max_lat)
+        seed: Random seed
+
+    Returns:
+        Start and end of every leg
+    """
+    rng = np.random.default_rng([seed, WORKLOADS.index(workload)])
+    min_lon, min_lat, max_lon, max_lat = bbox
+    legs: list[tuple[Point, Point]] = []
+    attempts = 0
+    while len(legs) < workload.legs and attempts < workload.legs * 1000:
+        attempts += 1
+        start_lon, start_lat = rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+        distance, angle = rng.uniform(workload.min_deg, workload.max_deg), rng.uniform(0, 2 * math.pi)
+        end_lon, end_lat = start_lon + distance * math.cos(angle), start_lat + distance * math.sin(angle)
+        if min_lon <= end_lon <= max_lon and min_lat <= end_lat <= max_lat:
+            legs.append(
+                (Point(lat=float(start_lat), lon=float(start_lon)), Point(lat=float(end_lat), lon=float(end_lon)))
+            )
+    if len(legs) < workload.legs:
+        print(f"Only {len(legs)} of {workload.legs} {workload.name} legs fit in {bbox}")
+    return legs
+
+
+def measure_leg(route_leg: Callable[[Point, Point], Route], start: Point, end: Point) -> LegMeasurement:
+    """Route a leg, timing it with the spans of the routing backend."""
+    with tracing.trace("benchmark.leg") as leg_trace:
+        try:
+            route_leg(start, end)
+            routed = True
+        except NoRouteError:
+            routed = False
+    spans = [span for span in leg_trace.spans if span.name in ("leg.search", "leg.geometry")]
+    scanned = [span.attributes["scanned_edges"] for span in leg_trace.spans if "scanned_edges" in span.attributes]
+    return LegMeasurement(
+        latency_ms=sum(span.duration_ms for span in spans),
+        scanned_edges=sum(scanned) if scanned else None,
+        routed=routed,
+    )
+
+
+def run_workloads(
+    route_leg: Callable[[Point, Point], Route], bbox: tuple[float, float, float, float], seed: int, repeat: int
+) -> dict[str, dict[str, Any]]:
+    """
+    Route all workloads and summarize them.
+
+    Args:
+        route_leg: Function routing a single leg
+        bbox: Extent of the graph
+        seed: Random seed of the legs
+        repeat: Number of times every leg is routed
+
+    Returns:
+        Summary of every workload
+    """
+    summaries = {}
+    for workload in WORKLOADS:
+        measurements = [
+            measure_leg(route_leg, start, end)
+            for _ in range(repeat)
+            for start, end in workload_legs(workload, bbox, seed)
+        ]
+        latencies = [m.latency_ms for m in measurements if m.routed]
+        scanned = [m.scanned_edges for m in measurements if m.routed and m.scanned_edges is not None]
+        summary: dict[str, Any] = {"legs": len(measurements), "failed": len(measurements) - len(latencies)}
+        if latencies:
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+            summary.update(p50_ms=p50, p95_ms=p95, p99_ms=p99)
+        if scanned:
+            summary.update(
+                mean_scanned_edges=float(np.mean(scanned)), p95_scanned_edges=float(np.percentile(scanned, 95))
+            )
+        summaries[workload.name] = summary
+        print(
+            f"{workload.name:>14}: {summary['legs']} legs, {summary['failed']} failed, "
+            f"p50 {summary.get('p50_ms', 0):.0f} ms, p95 {summary.get('p95_ms', 0):.0f} ms, "
+            f"p99 {summary.get('p99_ms', 0):.0f} ms, scanned edges {summary.get('mean_scanned_edges', 0):.0f}"
+        )
+    return summaries
+
+
+def _git_commit() -> str | None:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def run(args: argparse.Namespace) -> None:
+    weights = BIKE_TYPE_WEIGHTS[BikeType(args.bike_type)]["routing_weights"]
+    if args.backend == "memory":
+        params = {"edges": args.edges, "seed": args.seed, "bbox": list(args.bbox)}
+        started = time.perf_counter()
+        graph = build_memory_graph(generate_graph(args.edges, args.seed, args.bbox))
+        print(f"Generated {len(graph.way_gid)} ways in {time.perf_counter() - started:.1f}s")
+        bbox = args.bbox
+
+        def route_leg(start: Point, end: Point) -> Route:
+            return shared_graph.find_route(graph, start, end, weights)  # type: ignore[arg-type]
+    else:
+        params = _schema_params(args.schema) if args.schema else {}
+        bbox = tuple(params["bbox"]) if "bbox" in params else _database_extent()
+
+        def route_leg(start: Point, end: Point) -> Route:
+            return find_route(start, end, BikeType(args.bike_type))
+
+    workloads = run_workloads(route_leg, bbox, args.seed, args.repeat)  # type: ignore[arg-type]
+    record = {
+        "run_id": secrets.token_hex(4),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "label": args.label,
+        "backend": args.backend,
+        "schema": args.schema,
+        "graph": params,
+        "bike_type": args.bike_type,
+        "repeat": args.repeat,
+        "workloads": workloads,
+    }
+    with open(args.results, "ab") as file:
+        file.write(orjson.dumps(record) + b"\n")
+    print(f"Run {record['run_id']} appended to {args.results}")
+
+
+def compare(args: argparse.Namespace) -> None:
+    if not os.path.exists(args.results):
+        print(f"No runs in {args.results}")
+        return
+    with open(args.results, "rb") as file:
+        runs = [orjson.loads(line) for line in file if line.strip()]
+    if args.backend:
+        runs = [record for record in runs if record["backend"] == args.backend]
+    runs = runs[-args.last :]
+    if not runs:
+        print(f"No runs in {args.results}")
+        return
+
+    # changes are relative to the oldest listed run
+    baseline = runs[0]["workloads"]
+    for workload in WORKLOADS:
+        print(f"\n{workload.name}:")
+        print(
+            f"{'run':>8} {'started':>25} {'commit':>8} {'backend':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+            f"{'scanned':>10} {'p95 change':>10}  label"
+        )
+        for record in runs:
+            summary = record["workloads"].get(workload.name, {})
+            base_p95 = baseline.get(workload.name, {}).get("p95_ms")
+            change = f"{(summary['p95_ms'] / base_p95 - 1) * 100:+.0f}%" if base_p95 and "p95_ms" in summary else "-"
+            print(
+                f"{record['run_id']:>8} {record['started_at']:>25} {record.get('commit') or '-':>8} "
+                f"{record['backend']:>8} {summary.get('p50_ms', 0):>8.0f} {summary.get('p95_ms', 0):>8.0f} "
+                f"{summary.get('p99_ms', 0):>8.0f} {summary.get('mean_scanned_edges', 0):>10.0f} {change:>10}  "
+                f"{record.get('label') or ''}"
+            )
+
+
+def _parse_bbox(value: str) -> tuple[float, float, float, float]:
+    min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(","))
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark routing on a synthetic road graph")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    graph_parser = argparse.ArgumentParser(add_help=False)
+    graph_parser.add_argument("--edges", type=int, default=200_000, help="Approximate number of ways")
+    graph_parser.add_argument("--seed", type=int, default=1)
+    graph_parser.add_argument(
+        "--bbox", type=_parse_bbox, default=DEFAULT_BBOX, help="Extent as min_lon,min_lat,max_lon,max_lat"
+    )
+
+    load_parser = commands.add_parser("load", parents=[graph_parser], help="Load a synthetic graph into the database")
+    load_parser.add_argument("--schema", default="benchmark", help="Schema of the synthetic tables")
+    load_parser.add_argument("--layout", choices=LAYOUTS, default="clustered", help="Physical order of ways")
+
+    run_parser = commands.add_parser("run", parents=[graph_parser], help="Run the workloads and store the results")
+    run_parser.add_argument("--backend", choices=["database", "memory"], default="database")
+    run_parser.add_argument(
+        "--schema", help="Route on the synthetic graph loaded into this schema (default: the imported graph)"
+    )
+    run_parser.add_argument("--bike-type", choices=[bike_type.value for bike_type in BikeType], default="trekking")
+    run_parser.add_argument("--repeat", type=int, default=1, help="Number of times every leg is routed")
+    run_parser.add_argument("--label", help="Description of the run, e.g. the change being measured")
+    run_parser.add_argument("--results", default=DEFAULT_RESULTS_PATH)
+
+    compare_parser = commands.add_parser("compare", help="Compare stored runs")
+    compare_parser.add_argument("--last", type=int, default=10, help="Number of most recent runs compared")
+    compare_parser.add_argument("--backend", choices=["database", "memory"])
+    compare_parser.add_argument("--results", default=DEFAULT_RESULTS_PATH)
+    args = parser.parse_args()
+
+    if args.command == "load":
+        started = time.perf_counter()
+        graph = generate_graph(args.edges, args.seed, args.bbox)
+        print(f"Generated {len(graph.ways['gid'])} ways in {time.perf_counter() - started:.1f}s")
+        params = {"edges": args.edges, "seed": args.seed, "bbox": list(args.bbox), "layout": args.layout}
+        load_graph_into_database(graph, args.schema, params, args.layout)
+        print(f"Loaded into schema {args.schema} in {time.perf_counter() - started:.1f}s")
+    elif args.command == "run":
+        if args.schema:
+            # unqualified table names of the routing queries resolve to the synthetic tables
+            os.environ["PGOPTIONS"] = f"-c search_path={_check_schema(args.schema)},public"
+        # every leg is routed on its own, counted, and kept out of the statistics of the service
+        os.environ["ROUTE_COALESCING"] = "0"
+        os.environ["LEG_STATS_COUNT_EDGES"] = "1"
+        os.environ["LEG_STATS_PATH"] = os.path.join(tempfile.gettempdir(), "spdb_benchmark_leg_stats.sqlite3")
+        os.environ.setdefault("DB_ECHO", "0")
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
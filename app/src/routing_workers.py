@@ -0,0 +1,160 @@
+"""
+Routing of many legs at once, on threads or on a process pool using all cores for the parts of routing done in
+Python rather than in PostgreSQL.
+
+Workers are forked where possible, so they share the loaded modules with the parent copy-on-write. A pool created
+once other threads run, e.g. from a Streamlit script, starts them from a fork server instead, since forking a
+multithreaded process may copy locks held by other threads. With
+ROUTING_GRAPH=memory the routing graph is loaded once into shared memory and every worker searches it in place,
+otherwise workers route legs with the database query, each through its own connection pool.
+"""
+
+import atexit
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from multiprocessing import shared_memory
+from typing import Iterator
+
+import shared_graph
+from db_utils import reset_after_fork
+from engine import Point, Route, find_route, iter_route_legs_on
+from enums import BikeType
+from shared_graph import GraphArrays, GraphHandle, attach_graph, load_graph, publish_graph
+from weights import BIKE_TYPE_WEIGHTS
+
+# graph attached by a worker process, empty when routing with the database
+_worker_graph: list[GraphArrays] = []
+# routing pool of the process, created on first use
+_pool: list["RoutingPool"] = []
+_pool_lock = threading.Lock()
+
+
+def _init_worker(handle: GraphHandle | None) -> None:
+    reset_after_fork()
+    if handle is not None:
+        _worker_graph.append(attach_graph(handle))
+
+
+def _route_leg(start_point: Point, end_point: Point, bike_type: BikeType, vertex_ids: tuple[int, int] | None) -> Route:
+    if not _worker_graph:
+        return find_route(start_point, end_point, bike_type, vertex_ids)
+    # the graph in memory has vertices of its own, it snaps the ends itself
+    weights = BIKE_TYPE_WEIGHTS[bike_type]["routing_weights"]
+    return shared_graph.find_route(_worker_graph[0], start_point, end_point, weights)  # type: ignore[arg-type]
+
+
+def _start_method() -> str:
+    methods = multiprocessing.get_all_start_methods()
+    if "fork" in methods and threading.active_count() == 1:
+        return "fork"
+    return "forkserver" if "forkserver" in methods else "spawn"
+
+
+class RoutingPool:
+    """
+    Worker processes taking leg jobs from a shared queue.
+
+    Workers are forked if the pool is created before the program starts other threads, which is faster to start
+    and shares the loaded modules. Otherwise they are started from a fork server.
+    """
+
+    def __init__(self, processes: int | None = None, graph: GraphArrays | None = None) -> None:
+        self._blocks: list[shared_memory.SharedMemory] = []
+        handle = None
+        if graph is not None:
+            handle, self._blocks = publish_graph(graph)
+
+        start_method = _start_method()
+        print(f"Starting routing workers with {start_method}")
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_worker,
+            initargs=(handle,),
+        )
+        # start the workers right away rather than on the first request
+        self._executor.submit(int).result()
+
+    def iter_route_legs(
+        self, segments: list[list[Point]], bike_type: BikeType, vertex_ids: list[list[int]] | None = None
+    ) -> Iterator[tuple[int, int, Route]]:
+        """Same as `iter_route_legs`, with legs routed by the worker processes."""
+        return iter_route_legs_on(self._executor, _route_leg, segments, bike_type, vertex_ids)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+def _parse_bbox(value: str | None) -> tuple[float, float, float, float] | None:
+    if not value:
+        return None
+    min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(","))
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def get_routing_pool() -> RoutingPool:
+    """Routing pool shared by the whole process, configured by environment variables."""
+    if _pool:
+        return _pool[0]
+    # concurrent first calls, e.g. from two sessions, must not start two pools
+    with _pool_lock:
+        if not _pool:
+            _pool.append(_create_routing_pool())
+    return _pool[0]
+
+
+def _create_routing_pool() -> RoutingPool:
+    graph = None
+    if os.getenv("ROUTING_GRAPH", "database") == "memory":
+        bbox = _parse_bbox(os.getenv("ROUTING_GRAPH_BBOX"))
+        print(f"Loading routing graph into shared memory, bbox {bbox}")
+        graph = load_graph(bbox)
+        print(f"Loaded {len(graph.vertex_id)} vertices, {len(graph.edge_target)} edges")
+
+    pool = RoutingPool(int(os.getenv("ROUTING_PROCESSES", "0")) or None, graph)
+    atexit.register(pool.close)
+    return pool
+
+
+def iter_route_legs(
+    segments: list[list[Point]], bike_type: BikeType, vertex_ids: list[list[int]] | None = None
+) -> Iterator[tuple[int, int, Route]]:
+    """
+    Route every leg (pair of consecutive points) of every segment in parallel, yielding legs as soon as they finish.
+
+    Legs are routed on threads, or on the shared routing process pool if ROUTING_EXECUTOR is "process".
+
+    Args:
+        segments: Lists of points, each routed through in order
+        bike_type: Bike type to route for
+        vertex_ids: Vertices every point of the segments was snapped to by `engine.snap_points`, if they were
+
+    Returns:
+        Iterator of (segment index, leg index within the segment, route), in order of completion
+    """
+    if os.getenv("ROUTING_EXECUTOR", "thread") == "process":
+        yield from get_routing_pool().iter_route_legs(segments, bike_type, vertex_ids)
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor()
+    try:
+        yield from iter_route_legs_on(executor, find_route, segments, bike_type, vertex_ids)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def build_route(points: list[Point], bike_type: BikeType) -> list[Route]:
+    return build_routes_multiple([points], bike_type)[0]
+
+
+def build_routes_multiple(segments: list[list[Point]], bike_type: BikeType) -> list[list[Route]]:
+    results: list[list[Route | None]] = [[None] * (len(segment) - 1) for segment in segments]
+    for segment_idx, leg_idx, route in iter_route_legs(segments, bike_type):
+        results[segment_idx][leg_idx] = route
+    return results  # type: ignore[return-value]
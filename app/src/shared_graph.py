@@ -0,0 +1,335 @@
+"""
+Read-only routing graph kept in shared memory, so that many routing processes can search it without a copy each.
+
+The graph is loaded from the `ways` table once, published as a set of shared memory blocks and attached by
+worker processes by name. Outgoing edges of every vertex are stored in CSR form (an offset array per vertex into
+flat edge arrays), and the geometry of every way as a flat coordinate array with per-way offsets.
+"""
+
+import heapq
+import itertools
+import math
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+import orjson
+import shapely
+from sqlalchemy import text
+
+import tracing
+from db_utils import session
+from engine import NoRouteError, Point, Route
+from enums import RoadType
+
+# rows fetched from the database at once while loading the graph
+LOAD_BATCH_SIZE = 200_000
+# snapping first looks for vertices in a box of this size around the point
+SNAP_SEARCH_DEG = 0.05
+
+ROAD_TYPES = list(RoadType)
+# same defaults as the database routing query
+DEFAULT_ROAD_TYPE_WEIGHTS = {
+    RoadType.paved: 1.0,
+    RoadType.unpaved: 1.5,
+    RoadType.unknown_surface: 2.0,
+    RoadType.primary: 1.0,
+    RoadType.secondary: 1.5,
+    RoadType.cycleway: 0.5,
+}
+
+
+class GraphArrays(NamedTuple):
+    # vertices, sorted by id
+    vertex_id: np.ndarray
+    vertex_lon: np.ndarray
+    vertex_lat: np.ndarray
+    # vertex indices sorted by longitude, used for snapping
+    vertex_lon_order: np.ndarray
+    # outgoing edges of vertex i are edge_*[offsets[i]:offsets[i + 1]]
+    offsets: np.ndarray
+    edge_target: np.ndarray
+    edge_way: np.ndarray
+    # False if the edge traverses its way from target to source
+    edge_forward: np.ndarray
+    # routing cost before road type weights, as in the database query
+    edge_base_cost: np.ndarray
+    edge_road_type: np.ndarray
+    # ways, in load order
+    way_gid: np.ndarray
+    way_length_m: np.ndarray
+    way_road_type: np.ndarray
+    # coordinates of way i are way_coordinates[way_offsets[i]:way_offsets[i + 1]]
+    way_offsets: np.ndarray
+    way_coordinates: np.ndarray
+
+
+# name of every array -> (shared memory block name, dtype, shape)
+GraphHandle = dict[str, tuple[str, str, tuple[int, ...]]]
+
+# attached blocks have to stay referenced for as long as their arrays are used
+_attached_blocks: list[shared_memory.SharedMemory] = []
+
+
+def _bbox_filter(bbox: tuple[float, float, float, float] | None) -> tuple[str, dict[str, float]]:
+    if bbox is None:
+        return "", {}
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return (
+        "WHERE the_geom && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)",
+        {"min_lon": min_lon, "min_lat": min_lat, "max_lon": max_lon, "max_lat": max_lat},
+    )
+
+
+def load_graph(bbox: tuple[float, float, float, float] | None = None) -> GraphArrays:
+    """
+    Load the routing graph from the database.
+
+    Args:
+        bbox: Only load ways intersecting (min_lon, min_lat, max_lon, max_lat), the whole graph if None
+
+    Returns:
+        Graph arrays
+    """
+    where, params = _bbox_filter(bbox)
+    stmt = f"""
+    SELECT gid, source, target, length, length_m, reverse_cost, road_type::text, x1, y1, x2, y2, ST_AsBinary(the_geom)
+    FROM ways
+    {where}
+    """
+    road_type_codes = {road_type.value: code for code, road_type in enumerate(ROAD_TYPES)}
+
+    columns: dict[str, list[np.ndarray]] = {}
+    geometry_chunks: list[np.ndarray] = []
+    geometry_counts: list[np.ndarray] = []
+    with session() as db_session:
+        result = db_session.execute(text(stmt).execution_options(yield_per=LOAD_BATCH_SIZE), params)
+        for rows in result.partitions():
+            gid, source, target, length, length_m, reverse_cost, road_type, x1, y1, x2, y2, wkb = zip(*rows)
+            for name, values, dtype in [
+                ("gid", gid, np.int64),
+                ("source", source, np.int64),
+                ("target", target, np.int64),
+                ("length", length, np.float64),
+                ("length_m", length_m, np.float64),
+                ("reverse_cost", reverse_cost, np.float64),
+                ("x1", x1, np.float64),
+                ("y1", y1, np.float64),
+                ("x2", x2, np.float64),
+                ("y2", y2, np.float64),
+            ]:
+                columns.setdefault(name, []).append(np.array(values, dtype=dtype))
+            # unknown road types are never routed on, as in the database query
+            columns.setdefault("road_type", []).append(
+                np.array([road_type_codes.get(value, -1) for value in road_type], dtype=np.int8)
+            )
+            geometries = shapely.from_wkb(np.array([bytes(value) for value in wkb], dtype=object))
+            coordinates, index = shapely.get_coordinates(geometries, return_index=True)
+            geometry_chunks.append(coordinates)
+            geometry_counts.append(np.bincount(index, minlength=len(rows)))
+
+    if not columns:
+        raise ValueError(f"No ways found in {bbox}")
+    ways = {name: np.concatenate(chunks) for name, chunks in columns.items()}
+    way_offsets = np.concatenate([[0], np.cumsum(np.concatenate(geometry_counts))])
+    return build_graph(ways, way_offsets, np.concatenate(geometry_chunks))
+
+
+def build_graph(ways: dict[str, np.ndarray], way_offsets: np.ndarray, way_coordinates: np.ndarray) -> GraphArrays:
+    """
+    Build the graph arrays from columns of the `ways` table.
+
+    Args:
+        ways: Arrays of gid, source, target, length, length_m, reverse_cost, x1, y1, x2, y2 and road_type, with road
+            types as indices into `ROAD_TYPES` and -1 for ways which are never routed on
+        way_offsets: Coordinates of way i are way_coordinates[way_offsets[i]:way_offsets[i + 1]]
+        way_coordinates: Array of shape (n, 2) with (lon, lat) rows of all ways
+
+    Returns:
+        Graph arrays
+    """
+    way_count = len(ways["gid"])
+
+    vertex_id, vertex_index = np.unique(np.concatenate([ways["source"], ways["target"]]), return_inverse=True)
+    source, target = vertex_index[:way_count], vertex_index[way_count:]
+    vertex_lon = np.empty(len(vertex_id))
+    vertex_lat = np.empty(len(vertex_id))
+    vertex_lon[source], vertex_lat[source] = ways["x1"], ways["y1"]
+    vertex_lon[target], vertex_lat[target] = ways["x2"], ways["y2"]
+
+    # every way can be traversed forward, and backward unless its reverse cost is negative
+    routable = ways["road_type"] >= 0
+    backward = routable & (ways["reverse_cost"] >= 0)
+    way_index = np.arange(way_count)
+    edge_from = np.concatenate([source[routable], target[backward]])
+    edge_to = np.concatenate([target[routable], source[backward]])
+    edge_way = np.concatenate([way_index[routable], way_index[backward]])
+    edge_forward = np.concatenate([np.ones(routable.sum(), dtype=bool), np.zeros(backward.sum(), dtype=bool)])
+    edge_base_cost = np.concatenate(
+        [ways["length"][routable], np.sign(ways["reverse_cost"][backward]) * ways["length"][backward]]
+    )
+    order = np.argsort(edge_from, kind="stable")
+
+    return GraphArrays(
+        vertex_id=vertex_id,
+        vertex_lon=vertex_lon,
+        vertex_lat=vertex_lat,
+        vertex_lon_order=np.argsort(vertex_lon).astype(np.int32),
+        offsets=np.concatenate([[0], np.cumsum(np.bincount(edge_from, minlength=len(vertex_id)))]),
+        edge_target=edge_to[order].astype(np.int32),
+        edge_way=edge_way[order].astype(np.int32),
+        edge_forward=edge_forward[order],
+        edge_base_cost=edge_base_cost[order],
+        edge_road_type=ways["road_type"][edge_way[order]],
+        way_gid=ways["gid"],
+        way_length_m=ways["length_m"],
+        way_road_type=ways["road_type"],
+        way_offsets=way_offsets,
+        way_coordinates=way_coordinates,
+    )
+
+
+def publish_graph(graph: GraphArrays) -> tuple[GraphHandle, list[shared_memory.SharedMemory]]:
+    """
+    Copy the graph into shared memory.
+
+    Args:
+        graph: Graph arrays
+
+    Returns:
+        Handle for `attach_graph`, and the shared memory blocks, which the caller has to unlink when done
+    """
+    handle: GraphHandle = {}
+    blocks = []
+    for name, array in graph._asdict().items():
+        # zero-sized blocks aren't allowed
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        handle[name] = (block.name, array.dtype.str, array.shape)
+        blocks.append(block)
+    return handle, blocks
+
+
+def attach_graph(handle: GraphHandle) -> GraphArrays:
+    """Read-only view of a graph published by `publish_graph`, without copying it."""
+    arrays = {}
+    for name, (block_name, dtype, shape) in handle.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _attached_blocks.append(block)
+        array: np.ndarray = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return GraphArrays(**arrays)
+
+
+def snap_vertex(graph: GraphArrays, point: Point) -> int:
+    """Index of the vertex closest to the point, in degrees like the database snapping."""
+    order = graph.vertex_lon_order
+    lo, hi = np.searchsorted(
+        graph.vertex_lon[order], [point.lon - SNAP_SEARCH_DEG, point.lon + SNAP_SEARCH_DEG], side="left"
+    )
+    candidates = order[lo:hi]
+    candidates = candidates[np.abs(graph.vertex_lat[candidates] - point.lat) <= SNAP_SEARCH_DEG]
+    if len(candidates) == 0:
+        candidates = order
+    distances = np.hypot(graph.vertex_lon[candidates] - point.lon, graph.vertex_lat[candidates] - point.lat)
+    return int(candidates[np.argmin(distances)])
+
+
+def _astar(graph: GraphArrays, source: int, target: int, road_type_weights: np.ndarray) -> tuple[list[int], int]:
+    """
+    Edge indices of the cheapest path, with a straight line heuristic scaled to stay admissible.
+
+    Returns:
+        Edges of the path, empty if there is none, and the number of edges scanned
+    """
+    lon, lat = graph.vertex_lon, graph.vertex_lat
+    target_lon, target_lat = float(lon[target]), float(lat[target])
+    heuristic_scale = float(road_type_weights.min())
+
+    costs = {source: 0.0}
+    # vertex -> (previous vertex, edge leading to it)
+    previous: dict[int, tuple[int, int]] = {}
+    closed = set()
+    # (estimated total cost, tie breaker, cost so far, vertex)
+    counter = itertools.count()
+    heap = [(0.0, next(counter), 0.0, source)]
+    scanned = 0
+    while heap:
+        _, _, cost, vertex = heapq.heappop(heap)
+        if vertex == target:
+            break
+        if vertex in closed:
+            continue
+        closed.add(vertex)
+
+        begin, end = int(graph.offsets[vertex]), int(graph.offsets[vertex + 1])
+        if begin == end:
+            continue
+        scanned += end - begin
+        targets = graph.edge_target[begin:end]
+        edge_costs = graph.edge_base_cost[begin:end] * road_type_weights[graph.edge_road_type[begin:end]]
+        estimates = heuristic_scale * np.hypot(lon[targets] - target_lon, lat[targets] - target_lat)
+        for edge, next_vertex, edge_cost, estimate in zip(
+            range(begin, end), targets.tolist(), edge_costs.tolist(), estimates.tolist()
+        ):
+            next_cost = cost + edge_cost
+            if next_vertex not in closed and next_cost < costs.get(next_vertex, math.inf):
+                costs[next_vertex] = next_cost
+                previous[next_vertex] = (vertex, edge)
+                heapq.heappush(heap, (next_cost + estimate, next(counter), next_cost, next_vertex))
+    else:
+        return [], scanned
+
+    path = []
+    vertex = target
+    while vertex != source:
+        vertex, edge = previous[vertex]
+        path.append(edge)
+    return path[::-1], scanned
+
+
+def find_route(
+    graph: GraphArrays, start_point: Point, end_point: Point, road_type_weights: dict[RoadType, float]
+) -> Route:
+    """
+    Route a single leg on the in-memory graph, the counterpart of the database routing query.
+
+    Args:
+        graph: Graph arrays
+        start_point: Start of the leg
+        end_point: End of the leg
+        road_type_weights: Cost multiplier of every road type, lower is preferred
+
+    Returns:
+        Route of the leg, without a database geometry
+    """
+    weights = np.array([road_type_weights.get(rt, DEFAULT_ROAD_TYPE_WEIGHTS[rt]) for rt in ROAD_TYPES], dtype=float)
+    source, target = snap_vertex(graph, start_point), snap_vertex(graph, end_point)
+    with tracing.span("leg.search") as search_span:
+        path, scanned = _astar(graph, source, target, weights) if source != target else ([], 0)
+        if search_span is not None:
+            search_span.set(edges=len(path), scanned_edges=scanned)
+    if not path:
+        raise NoRouteError(f"No route found between {start_point} and {end_point}")
+
+    with tracing.span("leg.geometry"):
+        ways = graph.edge_way[path]
+        parts = []
+        for way, forward in zip(ways.tolist(), graph.edge_forward[path].tolist()):
+            coordinates = graph.way_coordinates[graph.way_offsets[way] : graph.way_offsets[way + 1]]
+            parts.append(coordinates if forward else coordinates[::-1])
+        coordinates = np.concatenate(parts)
+        # consecutive ways share their joining vertex
+        coordinates = coordinates[np.r_[True, np.any(np.diff(coordinates, axis=0) != 0, axis=1)]]
+        geojson = orjson.dumps({"type": "LineString", "coordinates": coordinates.tolist()}).decode()
+
+    length_m = np.bincount(graph.way_road_type[ways], weights=graph.way_length_m[ways], minlength=len(ROAD_TYPES))
+    return Route(
+        start=start_point,
+        end=end_point,
+        geojson=geojson,
+        geom="",
+        length_m=float(length_m.sum()),
+        length_m_road_types={rt.value: float(length) for rt, length in zip(ROAD_TYPES, length_m)},  # type: ignore[misc]
+    )
@@ -0,0 +1,228 @@
+import functools
+import math
+from typing import NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+import orjson
+
+from engine import Point, Route
+from geo_utils import EARTH_RADIUS_M, route_coordinates, to_local_m
+
+# points closer than this to the simplified line are never worth keeping
+_MIN_DEVIATION_M = 0.01
+
+# a route vertex this close to a pinned point (e.g. a day endpoint) is always kept
+_KEEP_POINT_MAX_DISTANCE_M = 100.0
+
+# web map tiles are 256 pixels wide, the world is 2^zoom tiles wide
+_TILE_SIZE_PX = 256
+
+
+class ExportProfile(NamedTuple):
+    name: str
+    label: str
+    # maximum allowed deviation of the simplified track from the route, None to keep the full geometry
+    tolerance_m: float | None = None
+    # maximum number of track points in the whole export, None for no limit
+    max_points: int | None = None
+
+
+def tolerance_profile(tolerance_m: float) -> ExportProfile:
+    return ExportProfile(
+        name=f"tolerance_{tolerance_m:g}m", label=f"Tolerance {tolerance_m:g} m", tolerance_m=tolerance_m
+    )
+
+
+FULL_PROFILE = ExportProfile(name="full", label="Full detail")
+
+EXPORT_PROFILES: dict[str, ExportProfile] = {
+    profile.name: profile
+    for profile in [
+        FULL_PROFILE,
+        # most Garmin Edge head units cap a course at 10000 track points
+        ExportProfile(name="garmin_10k", label="Garmin (10k points)", tolerance_m=1.0, max_points=10000),
+        tolerance_profile(5),
+        tolerance_profile(10),
+        tolerance_profile(25),
+    ]
+}
+
+
+def douglas_peucker_importance(xy: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    Douglas-Peucker importance of every vertex of a line.
+
+    The importance of a vertex is the largest tolerance at which Douglas-Peucker still keeps it,
+    so `importance >= tolerance` is the Douglas-Peucker result for any tolerance, and the k most important
+    vertices are the best k-point simplification in the Douglas-Peucker sense. Both endpoints are always kept.
+
+    The recursion is evaluated level by level: every round splits all open ranges at once,
+    with distances and per-range maxima computed as whole-array numpy operations.
+
+    Args:
+        xy: Array of shape (n, 2) with projected coordinates in meters
+
+    Returns:
+        Array of shape (n,) with the importance of every vertex in meters
+    """
+    n = len(xy)
+    importance = np.zeros(n)
+    importance[[0, -1]] = np.inf
+    if n <= 2:
+        return importance
+
+    is_split = np.zeros(n, dtype=bool)
+    is_split[[0, -1]] = True
+    indices = np.arange(n)
+
+    while True:
+        split_idx = np.flatnonzero(is_split)
+        open_points = indices[~is_split]
+        if len(open_points) == 0:
+            break
+
+        # range of every open point, given by the closest split points on both sides
+        range_id = np.searchsorted(split_idx, open_points) - 1
+        start, end = split_idx[range_id], split_idx[range_id + 1]
+
+        seg = xy[end] - xy[start]
+        offset = xy[open_points] - xy[start]
+        seg_len_sq = (seg**2).sum(axis=1)
+        t = np.clip((offset * seg).sum(axis=1) / np.maximum(seg_len_sq, 1e-12), 0.0, 1.0)
+        distance = np.sqrt(((offset - t[:, None] * seg) ** 2).sum(axis=1))
+
+        # open points are sorted, so every range is a contiguous group
+        group_start = np.flatnonzero(np.r_[True, range_id[1:] != range_id[:-1]])
+        group_size = np.diff(np.r_[group_start, len(open_points)])
+        group_max = np.maximum.reduceat(distance, group_start)
+        is_group_max = distance == np.repeat(group_max, group_size)
+        max_positions = np.flatnonzero(is_group_max)
+        _, first = np.unique(range_id[max_positions], return_index=True)
+        new_split = open_points[max_positions[first]]
+
+        # a vertex can't be more important than the range it splits, which is the less important range end
+        parent = np.minimum(importance[start[group_start]], importance[end[group_start]])
+        importance[new_split] = np.minimum(group_max, parent)
+        is_split[new_split] = True
+
+        # ranges which are already straight are resolved at once instead of one vertex per round
+        flat = np.repeat(group_max < _MIN_DEVIATION_M, group_size)
+        is_split[open_points[flat]] = True
+
+    return importance
+
+
+def _route_coordinates_or_empty(route: Route) -> npt.NDArray[np.float64]:
+    try:
+        return route_coordinates(route)
+    except (ValueError, KeyError, IndexError) as e:
+        print(f"Error processing route geometry: {e}")
+        return np.empty((0, 2))
+
+
+def _leg_importance(coordinates: npt.NDArray[np.float64], keep_points: list[Point]) -> npt.NDArray[np.float64]:
+    if len(coordinates) == 0:
+        return np.empty(0)
+    ref_lat = float(coordinates[:, 1].mean())
+    xy = to_local_m(coordinates, ref_lat)
+    importance = douglas_peucker_importance(xy)
+
+    for point in keep_points:
+        distance = np.linalg.norm(xy - to_local_m(np.array([[point.lon, point.lat]]), ref_lat), axis=1)
+        nearest = int(distance.argmin())
+        if distance[nearest] <= _KEEP_POINT_MAX_DISTANCE_M:
+            importance[nearest] = np.inf
+    return importance
+
+
+def simplify_tracks(
+    tracks: list[list[Route]],
+    profile: ExportProfile,
+    keep_points: list[Point] | None = None,
+) -> list[list[npt.NDArray[np.float64]]]:
+    """
+    Simplify the coordinates of every route according to an export profile.
+
+    Start and end of every route (waypoints and day boundaries) and vertices next to `keep_points`
+    (e.g. day endpoints within a route) are always kept. For a point budget, vertices of all routes
+    compete for the budget by importance, so straight legs give up points to winding ones.
+
+    Args:
+        tracks: Routes grouped into tracks
+        profile: Export profile
+        keep_points: Points whose nearest route vertex must be kept
+
+    Returns:
+        Coordinates of every route as arrays of (lon, lat) rows, in the same structure as `tracks`.
+        Routes with invalid geometry get an empty array.
+    """
+    coordinates = [[_route_coordinates_or_empty(route) for route in track] for track in tracks]
+    if profile.tolerance_m is None and profile.max_points is None:
+        return coordinates
+
+    importance = [[_leg_importance(leg, keep_points or []) for leg in track] for track in coordinates]
+    threshold = profile.tolerance_m or 0.0
+
+    if profile.max_points is not None:
+        all_importance = np.concatenate([leg for track in importance for leg in track])
+        if np.count_nonzero(all_importance >= threshold) > profile.max_points:
+            # raise the tolerance to the importance of the last vertex within the budget
+            threshold = max(threshold, float(np.partition(all_importance, -profile.max_points)[-profile.max_points]))
+
+    simplified = [
+        [leg[leg_importance >= threshold] for leg, leg_importance in zip(track, track_importance)]
+        for track, track_importance in zip(coordinates, importance)
+    ]
+    print(
+        f"Simplified tracks with profile {profile.name}: "
+        f"{sum(len(leg) for track in coordinates for leg in track)} -> {sum(len(leg) for track in simplified for leg in track)} points"
+    )
+    return simplified
+
+
+def display_tolerance_m(zoom: int, lat: float) -> float:
+    """Size of a pixel of a web map at a zoom level and latitude."""
+    return 2 * math.pi * EARTH_RADIUS_M * math.cos(math.radians(lat)) / (_TILE_SIZE_PX * 2**zoom)
+
+
+@functools.lru_cache(maxsize=256)
+def _display_importance(geojson: str) -> tuple[list[npt.NDArray[np.float64]], list[npt.NDArray[np.float64]], float]:
+    geometry = orjson.loads(geojson)
+    if geometry.get("type") not in ("LineString", "MultiLineString"):
+        raise ValueError(f"Unsupported geometry type: {geometry.get('type')}")
+    parts = [geometry["coordinates"]] if geometry["type"] == "LineString" else geometry["coordinates"]
+    coordinates = [np.asarray([coord[:2] for coord in part], dtype=np.float64).reshape(-1, 2) for part in parts]
+    ref_lat = float(np.concatenate(coordinates)[:, 1].mean())
+    return coordinates, [douglas_peucker_importance(to_local_m(part, ref_lat)) for part in coordinates], ref_lat
+
+
+@functools.lru_cache(maxsize=1024)
+def _display_geojson(geojson: str, zoom: int) -> str:
+    coordinates, importance, ref_lat = _display_importance(geojson)
+    tolerance_m = display_tolerance_m(zoom, ref_lat)
+    parts = [part[part_importance >= tolerance_m].tolist() for part, part_importance in zip(coordinates, importance)]
+    if len(parts) == 1:
+        return orjson.dumps({"type": "LineString", "coordinates": parts[0]}).decode()
+    return orjson.dumps({"type": "MultiLineString", "coordinates": parts}).decode()
+
+
+def display_geojson(route: Route, zoom: int) -> str:
+    """
+    Geometry of a route simplified for drawing on a map at a zoom level.
+
+    Douglas-Peucker importance of the vertices is computed once per route, every zoom level then keeps the vertices
+    more important than a pixel, so the simplified route looks the same on the map with a fraction of the points.
+
+    Args:
+        route: Route to draw
+        zoom: Zoom level of the map
+
+    Returns:
+        GeoJSON geometry of the route, the full one if it can't be simplified
+    """
+    try:
+        return _display_geojson(route.geojson, zoom)
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        print(f"Error simplifying route geometry: {e}")
+        return route.geojson
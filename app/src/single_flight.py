@@ -0,0 +1,108 @@
+import concurrent.futures
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+from typing import Callable
+
+from disk_cache import DiskCache
+
+DEFAULT_LOCK_DIR = os.path.join(tempfile.gettempdir(), "spdb_locks")
+# keys are spread over this many lock files, keys sharing a file only wait for each other across processes
+LOCK_STRIPES = 4096
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key at a time, concurrent callers with the same key share its result.
+
+    Threads of one process wait for the running computation directly. With `shared`, processes coalesce too: the
+    computing process holds a file lock for the key and stores the result in a shared cache for `result_ttl_s`, where
+    processes which waited for the lock pick it up instead of computing it again. Failed computations aren't stored.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        result_ttl_s: float,
+        max_entries: int,
+        lock_dir: str | None = None,
+        area: Callable[[bytes], tuple[float, float, float, float] | None] | None = None,
+        shared: bool = True,
+    ) -> None:
+        self.lock_dir = lock_dir or os.getenv("SPDB_LOCK_DIR", DEFAULT_LOCK_DIR)
+        self._namespace = namespace
+        # area (min_lat, min_lon, max_lat, max_lon) a stored result depends on, see `invalidate`
+        self._area = area
+        self._results = DiskCache(namespace, ttl_s=result_ttl_s, max_entries=max_entries) if shared else None
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, concurrent.futures.Future[bytes]] = {}
+        self.computed = 0
+        self.coalesced = 0
+
+    def _lock_path(self, key: str) -> str:
+        digest = hashlib.blake2b(f"{self._namespace}:{key}".encode(), digest_size=8).digest()
+        return os.path.join(self.lock_dir, f"{int.from_bytes(digest, 'big') % LOCK_STRIPES}.lock")
+
+    def _run_locked(self, results: DiskCache, key: str, compute: Callable[[], bytes]) -> bytes:
+        os.makedirs(self.lock_dir, exist_ok=True)
+        # flock locks belong to the open file, so every caller opens its own
+        with open(self._lock_path(key), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                stored = results.get(key)
+                if stored is not None:
+                    with self._lock:
+                        self.coalesced += 1
+                    return stored
+                value = compute()
+                results.put(key, value, bbox=self._area(value) if self._area is not None else None)
+                with self._lock:
+                    self.computed += 1
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def invalidate(self, bboxes: list[tuple[float, float, float, float]]) -> int:
+        """Drop stored results overlapping any of the areas (min_lat, min_lon, max_lat, max_lon)."""
+        if self._results is None:
+            return 0
+        return self._results.invalidate(bboxes)
+
+    def run(self, key: str, compute: Callable[[], bytes]) -> bytes:
+        """
+        Compute the value of a key, or wait for the computation already running for it.
+
+        Args:
+            key: Key identifying the computation
+            compute: Function computing the serialized value
+
+        Returns:
+            Serialized value
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if future is None:
+                future = self._in_flight[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            if self._results is None:
+                value = compute()
+                with self._lock:
+                    self.computed += 1
+            else:
+                value = self._run_locked(self._results, key, compute)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
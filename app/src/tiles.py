@@ -0,0 +1,313 @@
+"""
+Vector tiles of the road network and of planned trips, rendered by PostGIS with ST_AsMVT.
+
+The map loads only the tiles in view, at the zoom level in view, instead of every route embedded as GeoJSON into the
+page on every rerun. Road tiles hold the edges of `ways` with their road type, at low zoom levels only the main roads
+and cycleways. Trips are registered once in the `display_routes` table and get an id derived from their geometry, so
+their tiles never change. Tiles are kept in the local disk cache, road tiles are dropped by map updates of their area.
+
+Usage:
+    python tiles.py roads 12 2287 1352 > tile.pbf
+"""
+
+import argparse
+import functools
+import hashlib
+import math
+import os
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from db_utils import session
+from disk_cache import DiskCache
+from enums import RoadType
+from geo_utils import tile_bounds
+
+ROAD_LAYER = "roads"
+ROUTE_LAYER = "routes"
+MAX_ZOOM = 20
+# road types drawn from a zoom level on, a tile of a lower zoom level covers too many edges to be drawn
+MIN_ZOOM_ROAD_TYPES = [
+    (12, [road_type.value for road_type in RoadType]),
+    (9, [RoadType.primary.value, RoadType.secondary.value, RoadType.cycleway.value]),
+]
+WEB_MERCATOR_RADIUS_M = 6378137.0
+# tiles are drawn 256 pixels wide
+TILE_SIZE_PX = 256
+# trips drawn from tiles are kept for DISPLAY_ROUTES_TTL_S after they were last drawn, refreshed this often
+TRIP_REFRESH_SHARE = 0.1
+
+CREATE_DISPLAY_ROUTES = """
+CREATE UNLOGGED TABLE IF NOT EXISTS display_routes (
+    trip_id text NOT NULL,
+    segment integer NOT NULL,
+    leg integer NOT NULL,
+    geom geometry(Geometry, 4326) NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (trip_id, segment, leg)
+);
+CREATE INDEX IF NOT EXISTS display_routes_geom_idx ON display_routes USING gist (geom);
+"""
+
+
+class TileError(ValueError):
+    pass
+
+
+class UnknownTripError(TileError):
+    pass
+
+
+@functools.lru_cache(maxsize=1)
+def get_tile_cache() -> DiskCache:
+    return DiskCache(
+        namespace="vector_tiles",
+        ttl_s=float(os.getenv("TILE_CACHE_TTL_S", "86400")),
+        max_entries=int(os.getenv("TILE_CACHE_MAX_ENTRIES", "50000")),
+    )
+
+
+def _check_tile(z: int, x: int, y: int) -> None:
+    if not 0 <= z <= MAX_ZOOM or not 0 <= x < 1 << z or not 0 <= y < 1 << z:
+        raise TileError(f"Invalid tile {z}/{x}/{y}")
+
+
+def _pixel_size(z: int) -> float:
+    # in web mercator units, routes simplified to a pixel look the same on the map with a fraction of the points
+    return 2 * math.pi * WEB_MERCATOR_RADIUS_M / (TILE_SIZE_PX << z)
+
+
+def _display_routes_ttl_s() -> float:
+    return float(os.getenv("DISPLAY_ROUTES_TTL_S", "86400"))
+
+
+def _road_types(z: int) -> list[str]:
+    for min_zoom, road_types in MIN_ZOOM_ROAD_TYPES:
+        if z >= min_zoom:
+            return road_types
+    return []
+
+
+def road_tile(z: int, x: int, y: int) -> bytes:
+    """
+    Vector tile of the road network, with the road type of every edge.
+
+    Args:
+        z: Zoom level
+        x: Tile column
+        y: Tile row
+
+    Returns:
+        Mapbox vector tile with a single layer of edges, empty below the lowest zoom level with roads
+    """
+    _check_tile(z, x, y)
+    road_types = _road_types(z)
+    if not road_types:
+        return b""
+
+    cache = get_tile_cache()
+    key = f"{ROAD_LAYER}/{z}/{x}/{y}"
+    if (tile := cache.get(key)) is not None:
+        return tile
+
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+    # edges are in the grid cell of their centroid, long ones cross tiles far from it, so only the spatial index
+    # of every partition finds all of them
+    stmt = f"""
+    SELECT ST_AsMVT(t, '{ROAD_LAYER}', 4096, 'geom') FROM (
+        SELECT road_type, ST_AsMVTGeom(ST_Transform(the_geom, 3857), ST_TileEnvelope(:z, :x, :y)) AS geom
+        FROM ways
+        WHERE the_geom && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)
+            AND road_type::text = ANY(:road_types)
+    ) t
+    """
+    with session() as db_session:
+        tile = db_session.execute(
+            text(stmt),
+            {
+                "z": z,
+                "x": x,
+                "y": y,
+                "min_lon": min_lon,
+                "min_lat": min_lat,
+                "max_lon": max_lon,
+                "max_lat": max_lat,
+                "road_types": road_types,
+            },
+        ).scalar()
+    tile = bytes(tile or b"")
+    cache.put(key, tile, bbox=(min_lat, min_lon, max_lat, max_lon))
+    return tile
+
+
+def trip_id(segments: list[list[str]]) -> str:
+    """Id of a trip, derived from the GeoJSON geometries of its legs in every segment."""
+    digest = hashlib.sha1()
+    for segment in segments:
+        for geojson in segment:
+            digest.update(geojson.encode())
+            digest.update(b"\n")
+        digest.update(b"\n")
+    return digest.hexdigest()[:20]
+
+
+@functools.lru_cache(maxsize=1)
+def _create_display_routes() -> None:
+    with session() as db_session:
+        # concurrent CREATE ... IF NOT EXISTS may still collide
+        db_session.execute(text("SELECT pg_advisory_xact_lock(hashtext('display_routes'))"))
+        db_session.execute(text(CREATE_DISPLAY_ROUTES))
+
+
+def register_trip(segments: list[list[str]]) -> str:
+    """
+    Store the legs of a trip for route tiles, dropping trips not registered for DISPLAY_ROUTES_TTL_S.
+
+    Args:
+        segments: GeoJSON geometries of the legs of every segment, e.g. of the days of a trip
+
+    Returns:
+        Trip id of the route tiles
+    """
+    _create_display_routes()
+    trip = trip_id(segments)
+    rows = [
+        {"trip_id": trip, "segment": segment_idx, "leg": leg_idx, "geojson": geojson}
+        for segment_idx, segment in enumerate(segments)
+        for leg_idx, geojson in enumerate(segment)
+    ]
+    with session() as db_session:
+        db_session.execute(
+            text("DELETE FROM display_routes WHERE created_at < now() - make_interval(secs => :ttl_s)"),
+            {"ttl_s": _display_routes_ttl_s()},
+        )
+        if rows:
+            db_session.execute(
+                text(
+                    """
+                    INSERT INTO display_routes (trip_id, segment, leg, geom)
+                    VALUES (:trip_id, :segment, :leg, ST_SetSRID(ST_GeomFromGeoJSON(:geojson), 4326))
+                    ON CONFLICT (trip_id, segment, leg) DO UPDATE SET created_at = now()
+                    """
+                ),
+                rows,
+            )
+    return trip
+
+
+def touch_trip(trip: str) -> bool:
+    """
+    Keep a registered trip for another DISPLAY_ROUTES_TTL_S, while it's still drawn.
+
+    Args:
+        trip: Trip id returned by `register_trip`
+
+    Returns:
+        Whether the trip is registered, it has to be registered again otherwise
+    """
+    _create_display_routes()
+    with session() as db_session:
+        return _touch_trip(db_session, trip)
+
+
+def _touch_trip(db_session: Session, trip: str) -> bool:
+    # rows are only rewritten once in a while, not for every tile, the update runs even though nothing reads it
+    return bool(
+        db_session.execute(
+            text(
+                """
+                WITH touched AS (
+                    UPDATE display_routes SET created_at = now()
+                    WHERE trip_id = :trip_id AND created_at < now() - make_interval(secs => :refresh_s)
+                    RETURNING 1
+                )
+                SELECT EXISTS (SELECT 1 FROM display_routes WHERE trip_id = :trip_id)
+                """
+            ),
+            {"trip_id": trip, "refresh_s": _display_routes_ttl_s() * TRIP_REFRESH_SHARE},
+        ).scalar()
+    )
+
+
+def route_tile(trip: str, z: int, x: int, y: int) -> bytes:
+    """
+    Vector tile of a registered trip, with the segment index of every leg, simplified to a pixel of the zoom level.
+
+    Serving a tile keeps the trip registered. Tiles of unknown trips, e.g. dropped after DISPLAY_ROUTES_TTL_S or not
+    committed yet, aren't cached, so they are drawn once the trip is registered again.
+
+    Args:
+        trip: Trip id returned by `register_trip`
+        z: Zoom level
+        x: Tile column
+        y: Tile row
+
+    Returns:
+        Mapbox vector tile with a single layer of legs
+
+    Raises:
+        UnknownTripError: If the trip isn't registered
+    """
+    _check_tile(z, x, y)
+    cache = get_tile_cache()
+    key = f"{ROUTE_LAYER}/{trip}/{z}/{x}/{y}"
+    if (tile := cache.get(key)) is not None:
+        return tile
+
+    _create_display_routes()
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+    stmt = f"""
+    SELECT ST_AsMVT(t, '{ROUTE_LAYER}', 4096, 'geom') FROM (
+        SELECT
+            segment,
+            leg,
+            ST_AsMVTGeom(
+                ST_SimplifyPreserveTopology(ST_Transform(geom, 3857), :tolerance), ST_TileEnvelope(:z, :x, :y)
+            ) AS geom
+        FROM display_routes
+        WHERE trip_id = :trip_id AND geom && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)
+    ) t
+    """
+    with session() as db_session:
+        if not _touch_trip(db_session, trip):
+            raise UnknownTripError(f"Unknown trip {trip}")
+        tile = db_session.execute(
+            text(stmt),
+            {
+                "trip_id": trip,
+                "tolerance": _pixel_size(z),
+                "z": z,
+                "x": x,
+                "y": y,
+                "min_lon": min_lon,
+                "min_lat": min_lat,
+                "max_lon": max_lon,
+                "max_lat": max_lat,
+            },
+        ).scalar()
+    tile = bytes(tile or b"")
+    # trip ids are derived from their geometry, so tiles of a trip never change
+    cache.put(key, tile)
+    return tile
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("layer", choices=[ROAD_LAYER, ROUTE_LAYER])
+    parser.add_argument("z", type=int)
+    parser.add_argument("x", type=int)
+    parser.add_argument("y", type=int)
+    parser.add_argument("--trip", help="Trip id of a route tile")
+    args = parser.parse_args()
+
+    if args.layer == ROAD_LAYER:
+        tile = road_tile(args.z, args.x, args.y)
+    else:
+        tile = route_tile(args.trip, args.z, args.x, args.y)
+    sys.stdout.buffer.write(tile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Lightweight per-request tracing.
+
+A trace is started for every request with `trace`, and stages of the request are timed with nested `span`s.
+Spans outside of a trace cost nothing and are not recorded. Work submitted to thread pools with `submit` keeps
+the trace of the submitting thread.
+
+Finished spans are kept on their trace, e.g. for the timing panel of the visualizer, and exported in the
+background as JSON lines to TRACE_FILE and in OTLP/HTTP JSON format to OTEL_EXPORTER_OTLP_ENDPOINT, if set.
+"""
+
+import atexit
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import os
+import queue
+import secrets
+import threading
+import time
+from typing import Any, Callable, Iterator, TypeVar
+
+import orjson
+import requests
+
+# spans are exported in batches of up to this size, at least this often
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL_S = 2.0
+OTLP_TIMEOUT_S = 5
+
+T = TypeVar("T")
+
+
+class Span:
+    def __init__(self, trace: "Trace", name: str, parent_id: str | None, attributes: dict[str, Any]) -> None:
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+
+class Trace:
+    """Spans of a single request, in order of completion."""
+
+    def __init__(self) -> None:
+        self.trace_id = secrets.token_hex(16)
+        self.spans: list[Span] = []
+        self.root_id: str | None = None
+        self._lock = threading.Lock()
+
+    def _add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def breakdown(self) -> list[tuple[int, Span]]:
+        """Finished spans in depth-first order of their start, with their nesting depth."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ns)
+        children: dict[str | None, list[Span]] = {}
+        for span in spans:
+            children.setdefault(span.parent_id, []).append(span)
+        known = {span.span_id for span in spans}
+
+        result: list[tuple[int, Span]] = []
+
+        def visit(span: Span, depth: int) -> None:
+            result.append((depth, span))
+            for child in children.get(span.span_id, []):
+                visit(child, depth + 1)
+
+        # spans whose parent hasn't finished yet are shown at the top level
+        for span in spans:
+            if span.parent_id is None or span.parent_id not in known:
+                visit(span, 0)
+        return result
+
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+
+
+@contextlib.contextmanager
+def span(name: str, trace: Trace | None = None, **attributes: Any) -> Iterator[Span | None]:
+    """
+    Time a stage of the current request as a child of the current span.
+
+    Args:
+        name: Name of the stage
+        trace: Trace to add the span to, instead of the current one, e.g. to time work after a request finished
+        attributes: Attributes of the span, more can be added with `Span.set`
+
+    Returns:
+        Context manager yielding the span, or None if there is no trace
+    """
+    parent = _current_span.get()
+    if trace is None:
+        if parent is None:
+            yield None
+            return
+        trace = parent.trace
+    elif parent is not None and parent.trace is not trace:
+        parent = None
+
+    new_span = Span(trace, name, parent.span_id if parent is not None else trace.root_id, attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except Exception as e:
+        new_span.set(error=repr(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end_ns = time.time_ns()
+        trace._add(new_span)
+        _get_exporter().export(new_span)
+
+
+@contextlib.contextmanager
+def trace(name: str, **attributes: Any) -> Iterator[Trace]:
+    """
+    Start a new trace, with a root span of the given name covering the whole block.
+
+    Args:
+        name: Name of the request
+        attributes: Attributes of the root span
+
+    Returns:
+        Context manager yielding the trace
+    """
+    new_trace = Trace()
+    token = _current_span.set(None)
+    try:
+        with span(name, trace=new_trace, **attributes) as root:
+            new_trace.root_id = root.span_id  # type: ignore[union-attr]
+            yield new_trace
+    finally:
+        _current_span.reset(token)
+
+
+def traced(name: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Decorator timing every call of a function as a span of the given name."""
+
+    def decorator(fn: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def submit(
+    executor: concurrent.futures.Executor, fn: Callable[..., T], *args: Any, **kwargs: Any
+) -> "concurrent.futures.Future[T]":
+    """Submit work to a thread pool, keeping the current trace, so spans of the work nest under the current span."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span: Span) -> dict[str, Any]:
+    return {
+        "traceId": span.trace.trace_id,
+        "spanId": span.span_id,
+        "parentSpanId": span.parent_id or "",
+        "name": span.name,
+        # internal
+        "kind": 1,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+        "status": {"code": 2, "message": span.attributes["error"]} if "error" in span.attributes else {},
+    }
+
+
+class _Exporter:
+    """Exports finished spans from a background thread, so requests never wait for it."""
+
+    def __init__(self, path: str | None, otlp_endpoint: str | None, service_name: str) -> None:
+        self.path = path
+        self.otlp_url = otlp_endpoint.rstrip("/") + "/v1/traces" if otlp_endpoint else None
+        self.service_name = service_name
+        self._queue: queue.Queue[Span | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None or self.otlp_url is not None
+
+    def export(self, span: Span) -> None:
+        if not self.enabled:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        self._queue.put(span)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout=OTLP_TIMEOUT_S)
+
+    def _run(self) -> None:
+        done = False
+        while not done:
+            batch: list[Span] = []
+            deadline = time.monotonic() + EXPORT_INTERVAL_S
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    # tracing must never break requests
+                    print(f"Exporting {len(batch)} spans failed: {e}")
+
+    def _write(self, spans: list[Span]) -> None:
+        if self.path is not None:
+            with open(self.path, "ab") as file:
+                for span in spans:
+                    row = {
+                        "trace_id": span.trace.trace_id,
+                        "span_id": span.span_id,
+                        "parent_id": span.parent_id,
+                        "name": span.name,
+                        "start": span.start_ns / 1e9,
+                        "duration_ms": span.duration_ms,
+                        "attributes": span.attributes,
+                    }
+                    file.write(orjson.dumps(row, default=str) + b"\n")
+        if self.otlp_url is not None:
+            body = {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]
+                        },
+                        "scopeSpans": [{"scope": {"name": "spdb"}, "spans": [_otlp_span(span) for span in spans]}],
+                    }
+                ]
+            }
+            response = requests.post(
+                self.otlp_url,
+                data=orjson.dumps(body),
+                headers={"Content-Type": "application/json"},
+                timeout=OTLP_TIMEOUT_S,
+            )
+            response.raise_for_status()
+
+
+@functools.lru_cache(maxsize=None)
+def _exporter_for_process(pid: int) -> _Exporter:
+    return _Exporter(
+        path=os.getenv("TRACE_FILE") or None,
+        otlp_endpoint=os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT") or None,
+        service_name=os.getenv("OTEL_SERVICE_NAME", "spdb"),
+    )
+
+
+def _get_exporter() -> _Exporter:
+    # the export thread doesn't survive a fork, children start their own
+    return _exporter_for_process(os.getpid())
@@ -1,3 +1,5 @@
+import json
+import os
 import traceback
 from itertools import cycle
 from typing import OrderedDict
@@ -5,28 +7,84 @@ from typing import OrderedDict
 import folium
 import plotly.express as px  # type: ignore[import-untyped]
 import streamlit as st
+from folium.plugins import VectorGridProtobuf
 from streamlit_extras.stylable_container import stylable_container  # type: ignore[import-untyped]
 from streamlit_folium import st_folium  # type: ignore[import-untyped]
 
-from engine import Point, PointTypes, build_routes_multiple, get_closest_point
+import tracing
+from engine import Point, PointTypes, Route, get_closest_point
 from enums import BikeType, FitnessLevel, RoadType
+from exporters import EXPORT_FORMATS, prepare_export
 from helper import (
-    calculate_day_endpoints,
     estimate_speed_kph,
     estimate_time_needed_s,
     find_nearby,
-    split_route_by_sleeping_points,
     insert_multiple_points_logically,
+    split_route_by_sleeping_points,
+)
+from map_matching import import_track
+from map_updates import start_update_watcher
+from pipeline import plan_trip
+from poi_suggester import suggest_pois
+from simplify import EXPORT_PROFILES, display_geojson
+from tiles import ROAD_LAYER, ROUTE_LAYER, register_trip, touch_trip, trip_id
+from warmup import start_warm_up
+
+# vector tiles of the routing API, loaded by the browser, empty to embed routes into the page as GeoJSON
+TILES_URL = os.getenv("TILES_URL", "")
+DEFAULT_MAP_ZOOM = 6
+MAP_KEY = "route_map"
+SEGMENT_COLORS = ["blue", "green", "orange", "red", "purple"]
+ROAD_TYPE_COLORS = {
+    RoadType.primary.value: "#d7301f",
+    RoadType.secondary.value: "#fc8d59",
+    RoadType.paved.value: "#737373",
+    RoadType.unpaved.value: "#a6761d",
+    RoadType.unknown_surface.value: "#bdbdbd",
+    RoadType.cycleway.value: "#1a9850",
+}
+
+
+def vector_grid_options(layer: str, style: str) -> str:
+    # styles are JavaScript functions of the feature properties, so options are passed as code rather than JSON
+    return f"{{rendererFactory: L.canvas.tile, interactive: false, vectorTileLayerStyles: {{{layer}: {style}}}}}"
+
+
+ROAD_TILE_OPTIONS = vector_grid_options(
+    ROAD_LAYER,
+    f"""function(properties, zoom) {{
+        return {{color: {json.dumps(ROAD_TYPE_COLORS)}[properties.road_type] || "#999999", weight: zoom >= 14 ? 2 : 1}};
+    }}""",
 )
-from poi_suggester import (
-    get_max_bounds_from_routes,
-    suggest_pois,
-    suggest_sleeping_places,
+ROUTE_TILE_OPTIONS = vector_grid_options(
+    ROUTE_LAYER,
+    f"""function(properties) {{
+        var colors = {json.dumps(SEGMENT_COLORS)};
+        return {{color: colors[properties.segment % colors.length], weight: 4, opacity: 0.9}};
+    }}""",
 )
-from gpx_utils import export_to_gpx
+
+
+@st.cache_data(max_entries=16)
+def export_bytes(
+    trip: str, waypoints: tuple[Point, ...], format_name: str, profile_name: str, _segment_routes: list[list[Route]]
+) -> bytes:
+    # reruns reuse the file, the routes themselves are identified by the trip id
+    export_data = prepare_export(
+        _segment_routes,
+        waypoints,
+        profile=EXPORT_PROFILES[profile_name],
+        keep_points=list(waypoints),
+    )
+    return b"".join(EXPORT_FORMATS[format_name].write(export_data))
+
 
 # Configure page
 st.set_page_config(page_title="Bike Route Planner", layout="wide")
+# drop cached results in areas changed by map updates, once per server process
+start_update_watcher()
+# warm up the connection pool of this process, once
+start_warm_up()
 
 # Initialize session state
 for key in [
@@ -42,6 +100,9 @@ for key in [
     "road_type_to_distance",
     "bike_type",
     "fitness_level",
+    "last_trace",
+    "registered_trip",
+    "handled_click",
 ]:
     if key not in st.session_state:
         if key in (
@@ -53,6 +114,9 @@ for key in [
             "suggested_sleeping",
             "bike_type",
             "fitness_level",
+            "last_trace",
+            "registered_trip",
+            "handled_click",
         ):
             st.session_state[key] = None
         elif key in ("selected_pois", "selected_sleeping"):
@@ -94,66 +158,119 @@ with st.sidebar:
     st.session_state.bike_type = bike_type_name_mapping[bike_type]
     st.session_state.fitness_level = fitness_level_name_mapping[fitness_level]
 
+    st.header("Import Track")
+    uploaded_track = st.file_uploader("GPX or TCX file", type=["gpx", "tcx"])
+    if uploaded_track is not None and st.button("Match to map"):
+        try:
+            with st.spinner("Matching track to the road network..."):
+                imported_routes = import_track(uploaded_track)
+                if not imported_routes:
+                    st.error("No part of the track could be matched to the road network")
+                else:
+                    # start and end become route points, so the track can be re-planned right away
+                    st.session_state.points = [imported_routes[0].start, imported_routes[-1].end]
+                    st.session_state.segment_routes = [imported_routes]
+                    st.session_state.route_segments = [("Day 1", sum(route.length_m for route in imported_routes))]
+                    st.session_state.suggested_pois = suggest_pois(imported_routes)
+                    st.session_state.selected_pois = set()
+                    st.session_state.suggested_sleeping = None
+                    st.session_state.selected_sleeping = set()
+                    st.rerun()
+        except Exception as e:
+            st.error(f"Error importing track: {str(e)}")
+            print(traceback.format_exc())
+
 # Main layout
 map_col, config_col = st.columns([2, 1])
 
 # --- Map Column ---
 with map_col:
     st.subheader("Route Map")
-    m = folium.Map(location=[52.2370, 21.0175], zoom_start=6)
-
-    for idx, point in enumerate(st.session_state.points):
-        if idx == 0:
-            color = "green"
-            tooltip = "Start Point"
-        elif idx == len(st.session_state.points) - 1:
-            color = "red"
-            tooltip = "End Point"
-        else:
-            color = "orange"
-            tooltip = point.short_desc
-
-        if point.type == PointTypes.SLEEPING and point not in (st.session_state.suggested_sleeping or []):
-            folium.Marker(
-                location=(point.lat, point.lon),
-                icon=folium.Icon(color="darkblue", icon="bed", prefix="fa"),
-                tooltip=point.short_desc,
-            ).add_to(m)
-        else:
-            folium.Marker(
-                location=(point.lat, point.lon),
-                icon=folium.Icon(color=color),
-                tooltip=tooltip,
-            ).add_to(m)
-
-    if st.session_state.segment_routes:
-        color_cycle = cycle(["blue", "green", "orange", "red", "purple"])
-        for segment_route in st.session_state.segment_routes:
-            color = next(color_cycle)
-            for route in segment_route:
-                folium.GeoJson(
-                    data=route.geojson,
-                    name=f"Segment {len(st.session_state.segment_routes)}",
-                    color = color
+    # the map is drawn on the run after a route was generated, time it as part of that request
+    with tracing.span("render", trace=st.session_state.pop("trace_to_render", None)):
+        m = folium.Map(location=[52.2370, 21.0175], zoom_start=DEFAULT_MAP_ZOOM)
+        # routes drawn as GeoJSON are simplified to the zoom level the map was left at on the previous run
+        map_state = st.session_state.get(MAP_KEY)
+        map_zoom = int((map_state or {}).get("zoom") or DEFAULT_MAP_ZOOM)
+        route_group = None
+
+        for idx, point in enumerate(st.session_state.points):
+            if idx == 0:
+                color = "green"
+                tooltip = "Start Point"
+            elif idx == len(st.session_state.points) - 1:
+                color = "red"
+                tooltip = "End Point"
+            else:
+                color = "orange"
+                tooltip = point.short_desc
+
+            if point.type == PointTypes.SLEEPING and point not in (st.session_state.suggested_sleeping or []):
+                folium.Marker(
+                    location=(point.lat, point.lon),
+                    icon=folium.Icon(color="darkblue", icon="bed", prefix="fa"),
+                    tooltip=point.short_desc,
+                ).add_to(m)
+            else:
+                folium.Marker(
+                    location=(point.lat, point.lon),
+                    icon=folium.Icon(color=color),
+                    tooltip=tooltip,
                 ).add_to(m)
 
-    if st.session_state.suggested_pois:
-        for poi in st.session_state.suggested_pois:
-            folium.Marker(
-                location=(poi.lat, poi.lon),
-                icon=folium.Icon(color="purple"),
-                tooltip=poi.short_desc,
+        if TILES_URL:
+            VectorGridProtobuf(f"{TILES_URL}/roads/{{z}}/{{x}}/{{y}}.pbf", "Road network", ROAD_TILE_OPTIONS).add_to(m)
+
+        if st.session_state.segment_routes and TILES_URL:
+            # the trip is drawn from tiles, registered again when the routes change or it was dropped after its TTL
+            segments = [[route.geojson for route in segment] for segment in st.session_state.segment_routes]
+            registered = st.session_state.registered_trip
+            if registered != trip_id(segments) or not touch_trip(registered):
+                st.session_state.registered_trip = register_trip(segments)
+            VectorGridProtobuf(
+                f"{TILES_URL}/routes/{st.session_state.registered_trip}/{{z}}/{{x}}/{{y}}.pbf",
+                "Route",
+                ROUTE_TILE_OPTIONS,
             ).add_to(m)
+        elif st.session_state.segment_routes:
+            # added to the map without reloading it, so zooming only swaps the level of detail
+            route_group = folium.FeatureGroup(name="Route")
+            color_cycle = cycle(SEGMENT_COLORS)
+            for segment_route in st.session_state.segment_routes:
+                color = next(color_cycle)
+                for route in segment_route:
+                    folium.GeoJson(
+                        data=display_geojson(route, map_zoom),
+                        name=f"Segment {len(st.session_state.segment_routes)}",
+                        color=color,
+                    ).add_to(route_group)
 
-    if st.session_state.suggested_sleeping:
-        for sleep in st.session_state.suggested_sleeping:
-            folium.Marker(
-                location=(sleep.lat, sleep.lon),
-                icon=folium.Icon(color="cadetblue", icon="bed", prefix="fa"),
-                tooltip=sleep.short_desc,
-            ).add_to(m)
+        if st.session_state.suggested_pois:
+            for poi in st.session_state.suggested_pois:
+                folium.Marker(
+                    location=(poi.lat, poi.lon),
+                    icon=folium.Icon(color="purple"),
+                    tooltip=poi.short_desc,
+                ).add_to(m)
+
+        if st.session_state.suggested_sleeping:
+            for sleep in st.session_state.suggested_sleeping:
+                folium.Marker(
+                    location=(sleep.lat, sleep.lon),
+                    icon=folium.Icon(color="cadetblue", icon="bed", prefix="fa"),
+                    tooltip=sleep.short_desc,
+                ).add_to(m)
 
-    map_data = st_folium(m, width=800, height=600, returned_objects=["last_clicked"])
+        folium.LayerControl().add_to(m)
+        map_data = st_folium(
+            m,
+            width=800,
+            height=600,
+            key=MAP_KEY,
+            # tiles are loaded for the zoom level by the map itself, GeoJSON routes need a rerun
+            returned_objects=["last_clicked"] if TILES_URL else ["last_clicked", "zoom"],
+            feature_group_to_add=route_group,
+        )
 
     if st.session_state.route_segments:
         total_days = max(len(st.session_state.route_segments), st.session_state.trip_days)
@@ -302,17 +419,15 @@ with config_col:
 
         # Flatten all route distances in order
         point_to_point_distances_km = [
-            route.length_m / 1000
-            for segment in st.session_state.segment_routes or []
-            for route in segment
+            route.length_m / 1000 for segment in st.session_state.segment_routes or [] for route in segment
         ]
 
         for i, point in enumerate(st.session_state.points):
             cols = st.columns([1.3, 1.3, 10, 5], vertical_alignment="center")
             with cols[0]:
                 with stylable_container(
-                        key=f"points_number_{i}",
-                        css_styles="""
+                    key=f"points_number_{i}",
+                    css_styles="""
                     h4{
                         margin-bottom: 5px;
                     }
@@ -321,8 +436,8 @@ with config_col:
                     st.write(f"#### {i + 1}.")
             with cols[1]:
                 with stylable_container(
-                        key=f"point_actions_left_{i}",
-                        css_styles="""
+                    key=f"point_actions_left_{i}",
+                    css_styles="""
                     button{
                         float: left;
                         margin-bottom: 10px;
@@ -349,8 +464,8 @@ with config_col:
                     st.write(f"📏 _Distance from previous_: **{point_to_point_distances_km[i - 1]:.2f} km**")
             with cols[3]:
                 with stylable_container(
-                        key=f"point_actions_right_{i}",
-                        css_styles="""
+                    key=f"point_actions_right_{i}",
+                    css_styles="""
                     button{
                         float: right;
                         margin-bottom: 10px;
@@ -403,70 +518,25 @@ with config_col:
                 submitted = st.form_submit_button("Generate Route")
                 if submitted:
                     try:
-                        with st.spinner("Generating optimal route..."):
+                        with (
+                            st.spinner("Generating route and looking up POIs and sleeping places..."),
+                            tracing.trace("generate_route", points=len(st.session_state.points)) as trace,
+                        ):
+                            st.session_state.last_trace = trace
+                            st.session_state.trace_to_render = trace
                             segment_points = split_route_by_sleeping_points(st.session_state.points)
-                            segment_routes = []
-                            route_segments = []
-
-                            full_route_segments = build_routes_multiple(segment_points, st.session_state.bike_type)
-                            for idx, seg_routes in enumerate(full_route_segments):
-                                segment_routes.append(seg_routes)
-                                route_segments.append(
-                                    (
-                                        f"Day {idx + 1}",
-                                        sum([route.length_m for route in seg_routes]),
-                                    )
-                                )
-
-                            st.session_state.segment_routes = segment_routes
-                            st.session_state.route_segments = route_segments
-
-                        with st.spinner("Waiting for Overpass..."):
-                            import concurrent.futures
-
-                            pois_bbox = get_max_bounds_from_routes([r for seg in segment_routes for r in seg])
-                            st.session_state.suggested_pois = suggest_pois(pois_bbox)
-                            st.session_state.selected_pois = set()
+                            plan = plan_trip(segment_points, st.session_state.bike_type, st.session_state.daily_m)
 
+                            route_segments = [
+                                (f"Day {idx + 1}", sum([route.length_m for route in seg_routes]))
+                                for idx, seg_routes in enumerate(plan.segment_routes)
+                            ]
 
-                            # Calculate day endpoints based on daily distance
-                            all_routes = [route for seg in segment_routes for route in seg]
-
-                            # For now, use the first route to calculate day endpoints
-                            # TODO: Handle multiple routes better
-                            if all_routes:
-                                day_endpoints = calculate_day_endpoints(all_routes[0], st.session_state.daily_m)
-                            else:
-                                day_endpoints = []
-
-                            # Find sleeping places for each day endpoint
-                            all_sleeping_places = []
-                            SLEEP_SEARCH_RADIUS_DEG = 0.1
-
-                            with concurrent.futures.ThreadPoolExecutor() as executor:
-                                suggested_pois_future = executor.submit(suggest_pois, pois_bbox)
-                                future_sleep_places = {
-                                    executor.submit(suggest_sleeping_places, (
-                                        float(endpoint.lat) - SLEEP_SEARCH_RADIUS_DEG,
-                                        float(endpoint.lon) - SLEEP_SEARCH_RADIUS_DEG,
-                                        float(endpoint.lat) + SLEEP_SEARCH_RADIUS_DEG,
-                                        float(endpoint.lon) + SLEEP_SEARCH_RADIUS_DEG,
-                                    )): endpoint for endpoint in day_endpoints
-                                }
-                            suggested_pois = suggested_pois_future.result()
-                            all_sleeping_places = []
-                            # Collect all sleeping places from futures
-                            for future in concurrent.futures.as_completed(future_sleep_places):
-                                try:
-                                    sleeping_places = future.result()
-                                    all_sleeping_places.extend(sleeping_places)
-                                except Exception as e:
-                                    print(f"Error fetching sleeping places: {str(e)}")
-                                    print(traceback.format_exc())
-
-                            st.session_state.suggested_sleeping = all_sleeping_places
+                            st.session_state.segment_routes = plan.segment_routes
+                            st.session_state.route_segments = route_segments
+                            st.session_state.suggested_sleeping = plan.sleeping_places
                             st.session_state.selected_sleeping = set()
-                            st.session_state.suggested_pois = suggested_pois
+                            st.session_state.suggested_pois = plan.pois
                             st.session_state.selected_pois = set()
 
                             st.success("Route generated successfully!")
@@ -476,14 +546,43 @@ with config_col:
                         print(e)
                         print(traceback.format_exc())
             if st.session_state.segment_routes:
-                print("Downloading GPX")
-                # Flatten the segment routes into a single list of Route objects
-                all_routes = [route for seg in st.session_state.segment_routes for route in seg]
+                # One track per day, with chosen POIs and sleeping places as waypoints
+                waypoints = tuple(point for point in st.session_state.points if point.type is not None)
+                format_name = st.selectbox(
+                    "Export format",
+                    list(EXPORT_FORMATS),
+                    format_func=lambda name: EXPORT_FORMATS[name].label,
+                )
+                profile_name = st.selectbox(
+                    "Export profile",
+                    list(EXPORT_PROFILES),
+                    format_func=lambda name: EXPORT_PROFILES[name].label,
+                )
+                export_format = EXPORT_FORMATS[format_name]
+                segments = [[route.geojson for route in segment] for segment in st.session_state.segment_routes]
                 st.download_button(
-                    "Download GPX",
-                    export_to_gpx(all_routes, "route.gpx"),
-                    file_name="route.gpx",
-                    mime="application/gpx+xml"
+                    f"Download {export_format.label}",
+                    export_bytes(
+                        trip_id(segments), waypoints, format_name, profile_name, st.session_state.segment_routes
+                    ),
+                    file_name=f"route.{export_format.extension}",
+                    mime=export_format.mime_type,
+                )
+
+        if st.session_state.last_trace is not None:
+            with st.expander("Timing of the last request"):
+                breakdown = st.session_state.last_trace.breakdown()
+                request_start_ns = min(span.start_ns for _, span in breakdown)
+                st.table(
+                    {
+                        "Stage": ["\u2003" * depth + span.name for depth, span in breakdown],
+                        "Start": [f"{(span.start_ns - request_start_ns) / 1e6:.0f} ms" for _, span in breakdown],
+                        "Duration": [f"{span.duration_ms:.0f} ms" for _, span in breakdown],
+                        "Details": [
+                            ", ".join(f"{key}={value}" for key, value in span.attributes.items())
+                            for _, span in breakdown
+                        ],
+                    }
                 )
 
     with tab2:
@@ -519,7 +618,9 @@ with config_col:
                 st.rerun()
 
 # --- Handle map clicks ---
-if map_data and map_data.get("last_clicked"):
+# the map returns its last click on every rerun, e.g. after zooming, handle every click once
+if map_data and map_data.get("last_clicked") and map_data["last_clicked"] != st.session_state.handled_click:
+    st.session_state.handled_click = map_data["last_clicked"]
     click_latlon = (map_data["last_clicked"]["lat"], map_data["last_clicked"]["lng"])
 
     if st.session_state.choosing_point_idx is not None:
@@ -539,16 +640,8 @@ if map_data and map_data.get("last_clicked"):
         # Check for nearby sleeping place first
         nearby_sleep = find_nearby(click_latlon, st.session_state.suggested_sleeping or [])
         if nearby_sleep:
-            new_sleep = Point(
-                nearby_sleep.lat,
-                nearby_sleep.lon,
-                nearby_sleep.short_desc,
-                type=PointTypes.SLEEPING
-            )
-            st.session_state.points = insert_multiple_points_logically(
-                st.session_state.points,
-                [new_sleep]
-            )
+            new_sleep = Point(nearby_sleep.lat, nearby_sleep.lon, nearby_sleep.short_desc, type=PointTypes.SLEEPING)
+            st.session_state.points = insert_multiple_points_logically(st.session_state.points, [new_sleep])
             st.session_state.suggested_sleeping.remove(nearby_sleep)
             st.rerun()
 
@@ -557,12 +650,6 @@ if map_data and map_data.get("last_clicked"):
             nearby_poi = find_nearby(click_latlon, st.session_state.suggested_pois or [])
             if nearby_poi:
                 new_poi = Point(nearby_poi.lat, nearby_poi.lon, nearby_poi.short_desc, type="poi")
-                st.session_state.points = insert_multiple_points_logically(
-                    st.session_state.points,
-                    [new_poi]
-                )
+                st.session_state.points = insert_multiple_points_logically(st.session_state.points, [new_poi])
                 st.session_state.suggested_pois.remove(nearby_poi)
                 st.rerun()
-
-
-
@@ -0,0 +1,238 @@
+"""
+Warm-up after a restart, so the first routes of a fresh instance aren't the slow ones.
+
+After a restart the connection pool is empty, every new connection plans its first queries with cold catalog caches,
+and `ways` and its indices are read from disk by the first routes. Warm-up opens the whole pool and plans the
+corridor and snapping queries on every connection, then loads into shared buffers with pg_prewarm:
+- every partition of `ways` crossed by WARMUP_REGIONS, with all its indices
+- the BRIN grid indices of all other partitions, which every corridor query reads
+- the spatial index of `ways_vertices_pgr`, which snapping reads
+
+Without the pg_prewarm extension the rows of the regions are read instead. Finally a leg is routed through every
+region, on the routing worker processes if there are any.
+
+The API and the app warm up in a background thread of their own process, so it's their connection pool and routing
+workers which get warmed up. The API answers `GET /ready` once it's done, the app creates WARMUP_READY_FILE, which
+the compose healthcheck looks for.
+
+Usage:
+    python warmup.py
+"""
+
+import argparse
+import functools
+import math
+import os
+import pathlib
+import re
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from db_utils import open_pool, session
+from engine import NoRouteError, Point
+from enums import BikeType
+from routing_workers import build_routes_multiple
+
+# planned on every pooled connection, planning a query on `ways` without a grid_lon filter opens every partition
+PLANNED_QUERIES = [
+    "EXPLAIN SELECT gid, source, target, length, x1, y1, x2, y2 FROM ways WHERE grid_lat BETWEEN 0 AND 0",
+    "EXPLAIN SELECT id FROM ways_vertices_pgr ORDER BY the_geom <-> ST_SetSRID(ST_MakePoint(0, 0), 4326) LIMIT 1",
+]
+# grid cells are 0.2 degree wide, rows of a region may lie in cells half a cell outside of it
+GRID_MARGIN = 10
+RETRY_INTERVAL_S = 10
+
+Region = tuple[float, float, float, float]
+
+_ready = threading.Event()
+
+
+def _parse_regions(value: str | None) -> list[Region]:
+    regions = []
+    for part in (value or "").split(";"):
+        if part.strip():
+            min_lon, min_lat, max_lon, max_lat = (float(coord) for coord in part.split(","))
+            regions.append((min_lon, min_lat, max_lon, max_lat))
+    return regions
+
+
+def _grid_range(min_deg: float, max_deg: float) -> tuple[int, int]:
+    return math.floor(min_deg * 100) - GRID_MARGIN, math.ceil(max_deg * 100) + GRID_MARGIN
+
+
+def _enable_prewarm() -> bool:
+    try:
+        with session() as db_session:
+            db_session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_prewarm"))
+    except DBAPIError as e:
+        print(f"Warm-up: pg_prewarm unavailable, reading rows of the regions instead: {e}")
+        return False
+    return True
+
+
+def _relations_to_prewarm(regions: list[Region]) -> list[str]:
+    """Partitions of `ways` crossed by the regions with their indices, the other partitions' BRIN indices."""
+    with session() as db_session:
+        partitions = db_session.execute(
+            text(
+                """
+                SELECT c.oid::regclass::text, pg_get_expr(c.relpartbound, c.oid)
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'ways'::regclass
+                """
+            )
+        ).fetchall()
+        indices = db_session.execute(
+            text(
+                """
+                SELECT x.indrelid::regclass::text, c.oid::regclass::text, a.amname
+                FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid JOIN pg_am a ON a.oid = c.relam
+                WHERE x.indrelid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'ways'::regclass)
+                    OR x.indrelid = 'ways'::regclass AND c.relkind = 'i'
+                    OR x.indexrelid = (
+                        SELECT indexrelid FROM pg_index
+                        WHERE indrelid = 'ways_vertices_pgr'::regclass
+                            AND pg_get_indexdef(indexrelid) LIKE '%USING gist (the_geom)%'
+                        LIMIT 1
+                    )
+                """
+            )
+        ).fetchall()
+
+    ranges = [_grid_range(min_lon, max_lon) for min_lon, _, max_lon, _ in regions]
+    hot = set()
+    for name, bound in partitions:
+        match = re.search(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)", bound)
+        # the default partition only holds edges added by map updates outside of the imported bands
+        if match is None or any(int(match[1]) <= upper and lower < int(match[2]) for lower, upper in ranges):
+            hot.add(name)
+
+    relations = sorted(hot)
+    relations += [
+        index for table, index, method in indices if table in hot or method == "brin" or table == "ways_vertices_pgr"
+    ]
+    return relations
+
+
+def _read_regions(regions: list[Region]) -> None:
+    with session() as db_session:
+        for min_lon, min_lat, max_lon, max_lat in regions:
+            min_grid_lon, max_grid_lon = _grid_range(min_lon, max_lon)
+            min_grid_lat, max_grid_lat = _grid_range(min_lat, max_lat)
+            # summing a column reads every row, and with it every heap page of the region
+            edges = db_session.execute(
+                text(
+                    """
+                    SELECT count(*), sum(length) FROM ways
+                    WHERE grid_lon BETWEEN :min_grid_lon AND :max_grid_lon
+                        AND grid_lat BETWEEN :min_grid_lat AND :max_grid_lat
+                    """
+                ),
+                {
+                    "min_grid_lon": min_grid_lon,
+                    "max_grid_lon": max_grid_lon,
+                    "min_grid_lat": min_grid_lat,
+                    "max_grid_lat": max_grid_lat,
+                },
+            ).scalar()
+            print(f"Warm-up: read {edges} edges of region {min_lon},{min_lat},{max_lon},{max_lat}")
+
+
+def prewarm(regions: list[Region]) -> None:
+    """
+    Load partitions of hot regions and the indices used by routing into shared buffers.
+
+    Args:
+        regions: Hot regions as (min_lon, min_lat, max_lon, max_lat)
+    """
+    if not _enable_prewarm():
+        _read_regions(regions)
+        return
+
+    relations = _relations_to_prewarm(regions)
+    blocks = 0
+    with session() as db_session:
+        for relation in relations:
+            stmt = text("SELECT pg_prewarm(CAST(:relation AS regclass))")
+            blocks += db_session.execute(stmt, {"relation": relation}).scalar() or 0
+    print(f"Warm-up: prewarmed {len(relations)} relations, {blocks * 8 // 1024} MB")
+    if regions and not any(relation.startswith("ways_lon_") for relation in relations):
+        # `ways` isn't partitioned, its whole heap wouldn't fit into shared buffers
+        _read_regions(regions)
+
+
+def route_sample_legs(regions: list[Region]) -> None:
+    """Route a leg across the middle of every region, which loads pgRouting into the database and routing workers."""
+    for min_lon, min_lat, max_lon, max_lat in regions:
+        start = Point(lat=min_lat + (max_lat - min_lat) / 4, lon=min_lon + (max_lon - min_lon) / 4)
+        end = Point(lat=max_lat - (max_lat - min_lat) / 4, lon=max_lon - (max_lon - min_lon) / 4)
+        try:
+            build_routes_multiple([[start, end]], BikeType.trekking)
+        except NoRouteError as e:
+            print(f"Warm-up: no route across region {min_lon},{min_lat},{max_lon},{max_lat}: {e}")
+
+
+def _set_ready(ready_file: pathlib.Path | None) -> None:
+    _ready.set()
+    if ready_file is not None:
+        ready_file.touch()
+
+
+def warm_up(ready_file: pathlib.Path | None = None) -> None:
+    """
+    Warm up the connection pool and the database for the regions of WARMUP_REGIONS, retrying until it succeeds.
+
+    Args:
+        ready_file: File created once the warm-up has finished
+    """
+    regions = _parse_regions(os.getenv("WARMUP_REGIONS"))
+    while True:
+        started = time.monotonic()
+        try:
+            connections = open_pool(PLANNED_QUERIES)
+            print(f"Warm-up: opened {connections} connections")
+            prewarm(regions)
+            route_sample_legs(regions)
+        except Exception as e:
+            # the database may still be starting, and a failed warm-up must not leave the process unready for good
+            print(f"Warm-up failed, retrying in {RETRY_INTERVAL_S}s: {e}")
+            time.sleep(RETRY_INTERVAL_S)
+            continue
+        print(f"Warm-up finished in {time.monotonic() - started:.1f}s")
+        _set_ready(ready_file)
+        return
+
+
+def is_ready() -> bool:
+    """Whether the warm-up of this process has finished, always true if WARMUP is disabled."""
+    return _ready.is_set()
+
+
+@functools.lru_cache(maxsize=1)
+def start_warm_up() -> None:
+    """
+    Warm up in a background thread, once per process, and create WARMUP_READY_FILE once done if it's set.
+
+    WARMUP=0 skips it and reports readiness right away.
+    """
+    ready_file = pathlib.Path(os.environ["WARMUP_READY_FILE"]) if os.getenv("WARMUP_READY_FILE") else None
+    if ready_file is not None:
+        # left over from before a restart of the process or the container
+        ready_file.unlink(missing_ok=True)
+    if os.getenv("WARMUP", "1") != "1":
+        _set_ready(ready_file)
+        return
+    threading.Thread(target=warm_up, args=(ready_file,), name="warm-up", daemon=True).start()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+    warm_up()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,795 @@
+"""
+Import OSM extracts into the routing tables `ways` and `ways_vertices_pgr`.
+
+Every extract is read in a single streaming pass, with extracts read in parallel processes. Ways accepted by the
+osm2pgrouting configuration (mapconfig_bikes.xml) are kept with their node locations, and their road type is
+classified from tags with the rules of the osmfilter/*.txt files. Ways are split into edges at nodes shared with other
+ways, as osm2pgrouting does, only the largest connected component is kept, and grid cells are computed before the
+edges are bulk-loaded with COPY, so no intermediate tables or UPDATE passes are needed afterwards.
+
+Ways crossing the border of two extracts are present in both and are imported once.
+
+`ways` is partitioned into longitude bands and its rows are written in order of a Hilbert curve through the grid
+cells, so the edges of a routing corridor are stored close together.
+
+Usage:
+    python import_osm.py --dbname routing --workers 4 /data/poland-*.osm.pbf
+"""
+
+import argparse
+import array
+import concurrent.futures
+import csv
+import io
+import itertools
+import os
+import time
+import xml.etree.ElementTree as ET
+from collections.abc import Mapping
+from typing import Any, NamedTuple
+
+import numpy as np
+import osmium
+import psycopg2
+import shapely
+
+MAPCONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mapconfig_bikes.xml")
+EARTH_RADIUS_M = 6371000.0
+# edges written to the database in one COPY
+COPY_BATCH_SIZE = 500_000
+# cell size of the grid columns used to filter the routing corridor
+GRID_CELL_LON, GRID_CELL_LAT = 0.2, 0.16
+# width of the longitude bands `ways` is partitioned into, corridor queries only read the bands they cross
+PARTITION_WIDTH_DEG = 1.0
+
+# values of road_type_enum, in the order of its definition
+ROAD_TYPES = [
+    "roads_primary",
+    "roads_secondary",
+    "roads_paved",
+    "roads_unpaved",
+    "roads_unknown_surface",
+    "cycleways",
+]
+
+# rules of the osmfilter/*.txt files, the first matching road type wins in the order they used to be applied in
+PRIMARY_HIGHWAYS = {"primary", "primary_link"}
+SECONDARY_HIGHWAYS = {"secondary", "secondary_link"}
+MINOR_HIGHWAYS = {
+    "path",
+    "pedestrian",
+    "footway",
+    "bridleway",
+    "track",
+    "living_street",
+    "service",
+    "residential",
+    "unclassified",
+    "tertiary_link",
+    "tertiary",
+    "services",
+    "road",
+}
+PAVED_SURFACES = {
+    "paved",
+    "asphalt",
+    "concrete",
+    "chipseal",
+    "concrete:lanes",
+    "concrete:plates",
+    "paving_stones",
+    "sett",
+    "bricks",
+    "metal",
+    "metal_grid",
+    "wood",
+    "rubber",
+    "tiles",
+    "fibre_reinforced_polymer_grate",
+}
+UNPAVED_SURFACES = {
+    "unpaved",
+    "grass_paver",
+    "unhewn_cobblestone",
+    "cobblestone",
+    "cobblestone:flattened",
+    "compacted",
+    "fine_gravel",
+    "gravel",
+    "shells",
+    "rock",
+    "pebblestone",
+    "ground",
+    "dirt",
+    "earth",
+    "grass",
+    "mud",
+    "woodchips",
+}
+CYCLEWAY_KEYS = ("cycleway", "cycleway:left", "cycleway:right", "cycleway:both")
+NOT_A_CYCLEWAY = {"no", "separate", "opposite", "shoulder"}
+
+# one_way values of osm2pgrouting
+ONE_WAY_UNKNOWN, ONE_WAY_YES, ONE_WAY_NO, ONE_WAY_REVERSED = 0, 1, 2, -1
+
+
+def classify_road_type(tags: Mapping[str, str]) -> str:
+    """Road type of a way, with the rules of the osmfilter/*.txt files."""
+    highway = tags.get("highway")
+    if highway in PRIMARY_HIGHWAYS:
+        return "roads_primary"
+    if highway in SECONDARY_HIGHWAYS:
+        return "roads_secondary"
+    surface = tags.get("surface")
+    if highway in MINOR_HIGHWAYS and surface in PAVED_SURFACES:
+        return "roads_paved"
+    if highway in MINOR_HIGHWAYS and surface in UNPAVED_SURFACES:
+        return "roads_unpaved"
+    if highway is not None and (
+        highway.startswith("cycleway")
+        or any(tags.get(key) not in (None, *NOT_A_CYCLEWAY) for key in CYCLEWAY_KEYS)
+        or "segregated" in tags
+    ):
+        return "cycleways"
+    # everything else the configuration accepts has an unknown surface
+    return "roads_unknown_surface"
+
+
+def one_way(tags: Mapping[str, str]) -> int:
+    """Direction of a way, as osm2pgrouting reads it."""
+    value = tags.get("oneway")
+    if value in ("yes", "true", "1"):
+        return ONE_WAY_YES
+    if value in ("-1", "reverse"):
+        return ONE_WAY_REVERSED
+    if value in ("no", "false", "0"):
+        return ONE_WAY_NO
+    if tags.get("junction") == "roundabout":
+        return ONE_WAY_YES
+    return ONE_WAY_UNKNOWN
+
+
+class TagRule(NamedTuple):
+    key: str
+    value: str
+    tag_id: int
+    priority: float
+
+
+def load_mapconfig(path: str = MAPCONFIG_PATH) -> list[TagRule]:
+    """Tags accepted by an osm2pgrouting configuration, in the order osm2pgrouting matches them."""
+    rules = [
+        TagRule(tag.get("name", ""), value.get("name", ""), int(value.get("id", 0)), float(value.get("priority", 1)))
+        for tag in ET.parse(path).getroot().iter("tag_name")
+        for value in tag.iter("tag_value")
+    ]
+    return sorted(rules, key=lambda rule: (rule.priority, rule.tag_id))
+
+
+def match_rule(rules: list[TagRule], tags: Mapping[str, str]) -> TagRule | None:
+    """First rule matching the tags of a way, None if the way isn't routable."""
+    return next((rule for rule in rules if tags.get(rule.key) == rule.value), None)
+
+
+class RegionWays(NamedTuple):
+    way_id: np.ndarray
+    tag_id: np.ndarray
+    priority: np.ndarray
+    road_type: np.ndarray
+    one_way: np.ndarray
+    name: list[str | None]
+    # nodes of way i are refs[offsets[i]:offsets[i + 1]], with their locations in lon and lat
+    offsets: np.ndarray
+    refs: np.ndarray
+    lon: np.ndarray
+    lat: np.ndarray
+
+
+class _WayReader(osmium.SimpleHandler):
+    """Collects accepted ways with node locations, node callbacks are left to the location index."""
+
+    def __init__(self, rules: list[TagRule]) -> None:
+        super().__init__()
+        self.rules = rules
+        self.rule_keys = {rule.key for rule in rules}
+        self.way_id = array.array("q")
+        self.tag_id = array.array("l")
+        self.priority = array.array("d")
+        self.road_type = array.array("b")
+        self.one_way = array.array("b")
+        self.name: list[str | None] = []
+        self.node_count = array.array("l")
+        self.refs = array.array("q")
+        self.lon = array.array("d")
+        self.lat = array.array("d")
+
+    def way(self, way: Any) -> None:
+        tags = way.tags
+        if not any(key in tags for key in self.rule_keys):
+            return
+        rule = match_rule(self.rules, tags)
+        if rule is None:
+            return
+
+        # nodes missing from the extract are left out, as osm2pgrouting does
+        count = 0
+        for node in way.nodes:
+            location = node.location
+            if location.valid():
+                self.refs.append(node.ref)
+                self.lon.append(location.lon)
+                self.lat.append(location.lat)
+                count += 1
+        if count < 2:
+            del self.refs[len(self.refs) - count :]
+            del self.lon[len(self.lon) - count :]
+            del self.lat[len(self.lat) - count :]
+            return
+
+        plain_tags = {tag.k: tag.v for tag in tags}
+        self.way_id.append(way.id)
+        self.tag_id.append(rule.tag_id)
+        self.priority.append(rule.priority)
+        self.road_type.append(ROAD_TYPES.index(classify_road_type(plain_tags)))
+        self.one_way.append(one_way(plain_tags))
+        self.name.append(plain_tags.get("name"))
+        self.node_count.append(count)
+
+
+def read_region(path: str) -> RegionWays:
+    """
+    Read the routable ways of an extract in a single pass.
+
+    Args:
+        path: .osm.pbf or .osm file
+
+    Returns:
+        Ways with their nodes and node locations
+    """
+    started = time.perf_counter()
+    reader = _WayReader(load_mapconfig())
+    reader.apply_file(path, locations=True, idx="flex_mem")
+    node_count = np.array(reader.node_count, dtype=np.int64)
+    region = RegionWays(
+        way_id=np.frombuffer(reader.way_id, dtype=np.int64),
+        tag_id=np.array(reader.tag_id, dtype=np.int32),
+        priority=np.frombuffer(reader.priority, dtype=np.float64),
+        road_type=np.frombuffer(reader.road_type, dtype=np.int8),
+        one_way=np.frombuffer(reader.one_way, dtype=np.int8),
+        name=reader.name,
+        offsets=np.concatenate([[0], np.cumsum(node_count, dtype=np.int64)]),
+        refs=np.frombuffer(reader.refs, dtype=np.int64),
+        lon=np.frombuffer(reader.lon, dtype=np.float64),
+        lat=np.frombuffer(reader.lat, dtype=np.float64),
+    )
+    print(f"Read {len(region.way_id)} ways from {path} in {time.perf_counter() - started:.0f}s")
+    return region
+
+
+def merge_regions(regions: list[RegionWays]) -> RegionWays:
+    """Concatenate regions, keeping a single copy of ways present in more than one."""
+    way_id = np.concatenate([region.way_id for region in regions])
+    _, first = np.unique(way_id, return_index=True)
+    keep = np.zeros(len(way_id), dtype=bool)
+    keep[first] = True
+
+    lengths = np.concatenate([np.diff(region.offsets) for region in regions])
+    keep_nodes = np.repeat(keep, lengths)
+    names = [name for region in regions for name in region.name]
+    return RegionWays(
+        way_id=way_id[keep],
+        tag_id=np.concatenate([region.tag_id for region in regions])[keep],
+        priority=np.concatenate([region.priority for region in regions])[keep],
+        road_type=np.concatenate([region.road_type for region in regions])[keep],
+        one_way=np.concatenate([region.one_way for region in regions])[keep],
+        name=[name for name, kept in zip(names, keep.tolist()) if kept],
+        offsets=np.concatenate([[0], np.cumsum(lengths[keep])]),
+        refs=np.concatenate([region.refs for region in regions])[keep_nodes],
+        lon=np.concatenate([region.lon for region in regions])[keep_nodes],
+        lat=np.concatenate([region.lat for region in regions])[keep_nodes],
+    )
+
+
+class Topology(NamedTuple):
+    # edges: way index and first and last node position of every edge in the node arrays of the ways
+    edge_way: np.ndarray
+    edge_begin: np.ndarray
+    edge_end: np.ndarray
+    source: np.ndarray
+    target: np.ndarray
+    # vertices, the id of vertex i is i + 1
+    vertex_osm_id: np.ndarray
+    vertex_lon: np.ndarray
+    vertex_lat: np.ndarray
+
+
+def build_topology(ways: RegionWays, junctions: np.ndarray | None = None) -> Topology:
+    """
+    Split ways into edges at their ends and at every node shared with another way, or used twice by the same way.
+
+    Args:
+        ways: Ways with their nodes
+        junctions: Sorted ids of nodes used more than once by all ways, including ways other than `ways`,
+            counted from `ways` if None
+
+    Returns:
+        Edges and vertices of the routing graph
+    """
+    if junctions is None:
+        node_id, counts = np.unique(ways.refs, return_counts=True)
+        junctions = node_id[counts > 1]
+    split = np.isin(ways.refs, junctions, assume_unique=False)
+    split[ways.offsets[:-1]] = True
+    split[ways.offsets[1:] - 1] = True
+
+    positions = np.flatnonzero(split)
+    way_of = np.searchsorted(ways.offsets, positions, side="right") - 1
+    # consecutive split positions of the same way delimit an edge
+    same_way = way_of[:-1] == way_of[1:]
+    edge_begin, edge_end, edge_way = positions[:-1][same_way], positions[1:][same_way], way_of[:-1][same_way]
+
+    vertex_osm_id, first = np.unique(ways.refs[positions], return_index=True)
+    vertex_positions = positions[first]
+    return Topology(
+        edge_way=edge_way,
+        edge_begin=edge_begin,
+        edge_end=edge_end,
+        source=np.searchsorted(vertex_osm_id, ways.refs[edge_begin]) + 1,
+        target=np.searchsorted(vertex_osm_id, ways.refs[edge_end]) + 1,
+        vertex_osm_id=vertex_osm_id,
+        vertex_lon=ways.lon[vertex_positions],
+        vertex_lat=ways.lat[vertex_positions],
+    )
+
+
+def connected_components(source: np.ndarray, target: np.ndarray, vertex_count: int) -> np.ndarray:
+    """Component label of every vertex, the smallest vertex index of its component."""
+    labels = np.arange(vertex_count)
+    a, b = source - 1, target - 1
+    while True:
+        previous = labels.copy()
+        low = np.minimum(labels[a], labels[b])
+        np.minimum.at(labels, a, low)
+        np.minimum.at(labels, b, low)
+        # pointer jumping, so long chains collapse in a few rounds
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def keep_largest_component(topology: Topology) -> tuple[Topology, int]:
+    """Drop edges and vertices outside of the largest connected component, renumbering vertices."""
+    labels = connected_components(topology.source, topology.target, len(topology.vertex_osm_id))
+    largest = np.bincount(labels).argmax()
+    keep_vertex = labels == largest
+    new_id = np.cumsum(keep_vertex)
+    keep_edge = keep_vertex[topology.source - 1]
+    return (
+        Topology(
+            edge_way=topology.edge_way[keep_edge],
+            edge_begin=topology.edge_begin[keep_edge],
+            edge_end=topology.edge_end[keep_edge],
+            source=new_id[topology.source[keep_edge] - 1],
+            target=new_id[topology.target[keep_edge] - 1],
+            vertex_osm_id=topology.vertex_osm_id[keep_vertex],
+            vertex_lon=topology.vertex_lon[keep_vertex],
+            vertex_lat=topology.vertex_lat[keep_vertex],
+        ),
+        # labelled with its smallest vertex id, as pgr_connectedComponents does
+        int(new_id[largest]),
+    )
+
+
+class EdgeColumns(NamedTuple):
+    length: np.ndarray
+    length_m: np.ndarray
+    grid_lon: np.ndarray
+    grid_lat: np.ndarray
+    geometry: np.ndarray
+
+
+def _edge_measures(ways: RegionWays, first: np.ndarray, last: np.ndarray) -> tuple[np.ndarray, ...]:
+    """Points, lengths and centroids of edges running from node position `first` to `last` of their ways."""
+    point_counts = last - first + 1
+    # node positions of all edges, edge after edge
+    edge_index = np.repeat(np.arange(len(first)), point_counts)
+    positions = (
+        first[edge_index]
+        + np.arange(point_counts.sum())
+        - np.repeat(np.cumsum(point_counts) - point_counts, point_counts)
+    )
+    lon, lat = ways.lon[positions], ways.lat[positions]
+
+    # segments between consecutive points of the same edge
+    same_edge = edge_index[:-1] == edge_index[1:]
+    segment_edge = edge_index[:-1][same_edge]
+    d_lon, d_lat = np.diff(lon)[same_edge], np.diff(lat)[same_edge]
+    segment_length = np.hypot(d_lon, d_lat)
+    lat_a, lat_b = np.radians(lat[:-1][same_edge]), np.radians(lat[1:][same_edge])
+    haversine = np.sin((lat_b - lat_a) / 2) ** 2 + np.cos(lat_a) * np.cos(lat_b) * np.sin(np.radians(d_lon) / 2) ** 2
+    segment_length_m = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+    length = np.bincount(segment_edge, weights=segment_length, minlength=len(first))
+    length_m = np.bincount(segment_edge, weights=segment_length_m, minlength=len(first))
+    # length weighted centroid, as ST_Centroid of a line, the first point for edges of zero length
+    mid_lon, mid_lat = (lon[:-1][same_edge] + lon[1:][same_edge]) / 2, (lat[:-1][same_edge] + lat[1:][same_edge]) / 2
+    weighted_lon = np.bincount(segment_edge, weights=mid_lon * segment_length, minlength=len(first))
+    weighted_lat = np.bincount(segment_edge, weights=mid_lat * segment_length, minlength=len(first))
+    has_length = length > 0
+    centroid_lon = np.where(has_length, weighted_lon / np.where(has_length, length, 1), ways.lon[first])
+    centroid_lat = np.where(has_length, weighted_lat / np.where(has_length, length, 1), ways.lat[first])
+    return edge_index, lon, lat, length, length_m, centroid_lon, centroid_lat
+
+
+def _grid_cells(centroid_lon: np.ndarray, centroid_lat: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    return (
+        np.round(np.round(centroid_lon / GRID_CELL_LON) * GRID_CELL_LON * 100).astype(np.int64),
+        np.round(np.round(centroid_lat / GRID_CELL_LAT) * GRID_CELL_LAT * 100).astype(np.int64),
+    )
+
+
+def edge_columns(ways: RegionWays, topology: Topology, begin: int, end: int) -> EdgeColumns:
+    """Lengths, grid cells and hex EWKB geometries of a batch of edges."""
+    first, last = topology.edge_begin[begin:end], topology.edge_end[begin:end]
+    edge_index, lon, lat, length, length_m, centroid_lon, centroid_lat = _edge_measures(ways, first, last)
+    grid_lon, grid_lat = _grid_cells(centroid_lon, centroid_lat)
+    geometry = shapely.set_srid(shapely.linestrings(np.column_stack([lon, lat]), indices=edge_index), 4326)
+    return EdgeColumns(
+        length=length,
+        length_m=length_m,
+        grid_lon=grid_lon,
+        grid_lat=grid_lat,
+        geometry=shapely.to_wkb(geometry, hex=True, include_srid=True),
+    )
+
+
+def hilbert_index(x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+    """Distance along a Hilbert curve filling a 2^order x 2^order grid, of every (x, y) cell of the grid."""
+    x, y = x.astype(np.int64), y.astype(np.int64)
+    side = 1 << order
+    distance = np.zeros(len(x), dtype=np.int64)
+    s = side >> 1
+    while s > 0:
+        rx, ry = (x & s) > 0, (y & s) > 0
+        distance += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve continues where the previous one ended
+        flip = ~ry & rx
+        x, y = np.where(flip, side - 1 - x, x), np.where(flip, side - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return distance
+
+
+def spatial_order(ways: RegionWays, topology: Topology) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Order edges along a Hilbert curve through the grid cells, and within every cell along one through its area.
+
+    Edges close to each other end up in the same or in neighbouring pages of their partition, so the edges of a
+    corridor are read from few pages and every BRIN block range covers a small area.
+
+    Args:
+        ways: Ways the edges were split from
+        topology: Edges
+
+    Returns:
+        Edge indices in curve order, and the grid cell longitude of every edge
+    """
+    edge_count = len(topology.edge_way)
+    keys = np.empty(edge_count, dtype=np.int64)
+    grid_lon = np.empty(edge_count, dtype=np.int64)
+    for begin in range(0, edge_count, COPY_BATCH_SIZE):
+        end = min(begin + COPY_BATCH_SIZE, edge_count)
+        *_, centroid_lon, centroid_lat = _edge_measures(
+            ways, topology.edge_begin[begin:end], topology.edge_end[begin:end]
+        )
+        cell_lon, cell_lat = _grid_cells(centroid_lon, centroid_lat)
+        # grid cell indices, with Poland well within the 2^16 cells of the curve
+        cell_x = np.round(cell_lon / (GRID_CELL_LON * 100)).astype(np.int64) + (1 << 15)
+        cell_y = np.round(cell_lat / (GRID_CELL_LAT * 100)).astype(np.int64) + (1 << 15)
+        # position of the centroid within its cell, on a 1024 x 1024 grid
+        in_x = np.clip((centroid_lon / GRID_CELL_LON - cell_x + (1 << 15) + 0.5) * 1024, 0, 1023).astype(np.int64)
+        in_y = np.clip((centroid_lat / GRID_CELL_LAT - cell_y + (1 << 15) + 0.5) * 1024, 0, 1023).astype(np.int64)
+        keys[begin:end] = (hilbert_index(cell_x, cell_y, 16) << 20) | hilbert_index(in_x, in_y, 10)
+        grid_lon[begin:end] = cell_lon
+    return np.argsort(keys, kind="stable"), grid_lon
+
+
+def copy_csv(cursor: Any, table: str, columns: list[str], rows: Any) -> None:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+CREATE_TABLES = """
+DROP TABLE IF EXISTS ways, ways_vertices_pgr, osm_ways, osm_nodes;
+CREATE TABLE ways_vertices_pgr (
+    id bigint NOT NULL,
+    osm_id bigint,
+    lon double precision,
+    lat double precision,
+    the_geom geometry(Point, 4326),
+    component bigint
+);
+CREATE TABLE ways (
+    gid bigint NOT NULL,
+    osm_id bigint,
+    tag_id integer,
+    length double precision,
+    length_m double precision,
+    name text,
+    source bigint,
+    target bigint,
+    source_osm bigint,
+    target_osm bigint,
+    cost double precision,
+    reverse_cost double precision,
+    one_way integer,
+    x1 double precision,
+    y1 double precision,
+    x2 double precision,
+    y2 double precision,
+    priority double precision,
+    road_type road_type_enum NOT NULL,
+    component bigint,
+    grid_lon numeric NOT NULL,
+    grid_lat numeric NOT NULL,
+    the_geom geometry(LineString, 4326)
+) PARTITION BY RANGE (grid_lon);
+-- every accepted way with its nodes and the locations of those nodes, so diffs can be applied later
+CREATE TABLE osm_ways (
+    osm_id bigint NOT NULL,
+    tag_id integer,
+    priority double precision,
+    road_type road_type_enum NOT NULL,
+    one_way integer,
+    name text,
+    nodes bigint[] NOT NULL
+);
+CREATE TABLE osm_nodes (
+    id bigint NOT NULL,
+    lon double precision NOT NULL,
+    lat double precision NOT NULL
+);
+"""
+
+# indices of the former post-import script, and the ones needed to apply diffs
+CREATE_INDICES = """
+-- primary keys of partitioned tables have to include the partition key
+ALTER TABLE ways ADD PRIMARY KEY (gid, grid_lon);
+ALTER TABLE ways_vertices_pgr ADD PRIMARY KEY (id);
+CREATE INDEX ON ways USING gist (the_geom);
+CREATE INDEX ON ways_vertices_pgr USING gist (the_geom);
+CREATE INDEX ON ways (source);
+CREATE INDEX ON ways (target);
+CREATE INDEX ON ways (source_osm);
+CREATE INDEX ON ways (target_osm);
+CREATE INDEX ON ways (gid, road_type);
+CREATE INDEX ON ways USING gist( (the_geom::geography) );
+CREATE INDEX ON ways_vertices_pgr USING gist( (the_geom::geography) );
+-- rows are ordered along a curve through the grid cells, so block ranges cover small areas
+CREATE INDEX ON ways USING brin (grid_lon, grid_lat) WITH (pages_per_range = 16, autosummarize = on);
+CREATE INDEX ON ways (osm_id);
+CREATE INDEX ON ways_vertices_pgr (osm_id);
+ALTER TABLE osm_ways ADD PRIMARY KEY (osm_id);
+ALTER TABLE osm_nodes ADD PRIMARY KEY (id);
+CREATE INDEX ON osm_ways USING gin (nodes);
+"""
+
+WAY_COLUMNS = [
+    "gid",
+    "osm_id",
+    "tag_id",
+    "length",
+    "length_m",
+    "name",
+    "source",
+    "target",
+    "source_osm",
+    "target_osm",
+    "cost",
+    "reverse_cost",
+    "one_way",
+    "x1",
+    "y1",
+    "x2",
+    "y2",
+    "priority",
+    "road_type",
+    "component",
+    "grid_lon",
+    "grid_lat",
+    "the_geom",
+]
+
+
+def copy_vertices(cursor: Any, topology: Topology, vertex_ids: np.ndarray, component: int) -> None:
+    """Write vertices of the topology with the given ids."""
+    for begin in range(0, len(vertex_ids), COPY_BATCH_SIZE):
+        batch = slice(begin, begin + COPY_BATCH_SIZE)
+        copy_csv(
+            cursor,
+            "ways_vertices_pgr",
+            ["id", "osm_id", "lon", "lat", "the_geom", "component"],
+            (
+                (vertex_id, osm_id, x, y, f"SRID=4326;POINT({x!r} {y!r})", component)
+                for vertex_id, osm_id, x, y in zip(
+                    vertex_ids[batch].tolist(),
+                    topology.vertex_osm_id[batch].tolist(),
+                    topology.vertex_lon[batch].tolist(),
+                    topology.vertex_lat[batch].tolist(),
+                )
+            ),
+        )
+
+
+def copy_edges(cursor: Any, ways: RegionWays, topology: Topology, first_gid: int, component: int) -> None:
+    """Write edges of the topology with consecutive ids, source and target are ids of written vertices."""
+    edge_count = len(topology.edge_way)
+    for begin in range(0, edge_count, COPY_BATCH_SIZE):
+        end = min(begin + COPY_BATCH_SIZE, edge_count)
+        columns = edge_columns(ways, topology, begin, end)
+        way = topology.edge_way[begin:end]
+        first, last = topology.edge_begin[begin:end], topology.edge_end[begin:end]
+        one_ways = ways.one_way[way]
+        length = columns.length
+        # negative costs close a direction, as osm2pgrouting sets them
+        cost = np.where(one_ways == ONE_WAY_REVERSED, -length, length)
+        reverse_cost = np.where(one_ways == ONE_WAY_YES, -length, length)
+        copy_csv(
+            cursor,
+            "ways",
+            WAY_COLUMNS,
+            zip(
+                range(first_gid + begin, first_gid + end),
+                ways.way_id[way].tolist(),
+                ways.tag_id[way].tolist(),
+                length.tolist(),
+                columns.length_m.tolist(),
+                (ways.name[i] for i in way.tolist()),
+                topology.source[begin:end].tolist(),
+                topology.target[begin:end].tolist(),
+                ways.refs[first].tolist(),
+                ways.refs[last].tolist(),
+                cost.tolist(),
+                reverse_cost.tolist(),
+                one_ways.tolist(),
+                ways.lon[first].tolist(),
+                ways.lat[first].tolist(),
+                ways.lon[last].tolist(),
+                ways.lat[last].tolist(),
+                ways.priority[way].tolist(),
+                (ROAD_TYPES[road_type] for road_type in ways.road_type[way].tolist()),
+                itertools.repeat(component, end - begin),
+                columns.grid_lon.tolist(),
+                columns.grid_lat.tolist(),
+                columns.geometry.tolist(),
+            ),
+        )
+        if edge_count > COPY_BATCH_SIZE:
+            print(f"Loaded {end} of {edge_count} edges")
+
+
+def copy_osm_elements(cursor: Any, ways: RegionWays) -> None:
+    """Write ways with their nodes, and locations of all their nodes."""
+    for begin in range(0, len(ways.way_id), COPY_BATCH_SIZE):
+        end = min(begin + COPY_BATCH_SIZE, len(ways.way_id))
+        offsets = ways.offsets[begin : end + 1].tolist()
+        refs = ways.refs[offsets[0] : offsets[-1]].astype(str).tolist()
+        base = offsets[0]
+        copy_csv(
+            cursor,
+            "osm_ways",
+            ["osm_id", "tag_id", "priority", "road_type", "one_way", "name", "nodes"],
+            zip(
+                ways.way_id[begin:end].tolist(),
+                ways.tag_id[begin:end].tolist(),
+                ways.priority[begin:end].tolist(),
+                (ROAD_TYPES[road_type] for road_type in ways.road_type[begin:end].tolist()),
+                ways.one_way[begin:end].tolist(),
+                ways.name[begin:end],
+                ("{" + ",".join(refs[start - base : stop - base]) + "}" for start, stop in itertools.pairwise(offsets)),
+            ),
+        )
+
+    node_id, first = np.unique(ways.refs, return_index=True)
+    for begin in range(0, len(node_id), COPY_BATCH_SIZE):
+        batch = first[begin : begin + COPY_BATCH_SIZE]
+        copy_csv(
+            cursor,
+            "osm_nodes",
+            ["id", "lon", "lat"],
+            zip(ways.refs[batch].tolist(), ways.lon[batch].tolist(), ways.lat[batch].tolist()),
+        )
+
+
+def create_partitions(cursor: Any, min_grid_lon: int, max_grid_lon: int) -> None:
+    """Create longitude band partitions of `ways` covering the grid cells, and a default one for edges added later."""
+    width = round(PARTITION_WIDTH_DEG * 100)
+    for lower in range(min_grid_lon // width * width, max_grid_lon + 1, width):
+        name = f"ways_lon_{lower}".replace("-", "m")
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF ways FOR VALUES FROM ({lower}) TO ({lower + width})")
+    cursor.execute("CREATE TABLE ways_lon_other PARTITION OF ways DEFAULT")
+
+
+def load_into_database(
+    connection: Any, ways: RegionWays, topology: Topology, component: int, grid_lon_range: tuple[int, int]
+) -> None:
+    """
+    Create the routing tables and bulk-load edges and vertices.
+
+    Args:
+        connection: psycopg2 connection
+        ways: Ways the edges were split from
+        topology: Edges and vertices, edges are written in their order
+        component: Component label stored with every edge and vertex
+        grid_lon_range: Smallest and largest grid cell longitude of the edges
+    """
+    with connection, connection.cursor() as cursor:
+        cursor.execute(CREATE_TABLES)
+        create_partitions(cursor, *grid_lon_range)
+        copy_vertices(cursor, topology, np.arange(1, len(topology.vertex_osm_id) + 1), component)
+        print(f"Loaded {len(topology.vertex_osm_id)} vertices")
+        copy_edges(cursor, ways, topology, 1, component)
+        print(f"Loaded {len(topology.edge_way)} edges")
+        # ways of dropped components are kept too, a diff may connect them later
+        copy_osm_elements(cursor, ways)
+        print(f"Loaded {len(ways.way_id)} ways with their nodes")
+
+        print("Building indices")
+        cursor.execute(CREATE_INDICES)
+
+    # VACUUM can't run inside a transaction
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        for table in ("ways", "ways_vertices_pgr", "osm_ways", "osm_nodes"):
+            cursor.execute(f"VACUUM ANALYZE {table}")
+    connection.autocommit = False
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import OSM extracts into the routing tables")
+    parser.add_argument("files", nargs="+", help=".osm.pbf or .osm extracts, e.g. one per voivodeship")
+    parser.add_argument("--dbname", default="routing")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Extracts read at the same time")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    # connection parameters come from PGHOST, PGUSER, PGPASSWORD etc.
+    connection = psycopg2.connect(dbname=args.dbname)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.workers, len(args.files))) as executor:
+        regions = list(executor.map(read_region, args.files))
+    ways = merge_regions(regions)
+    del regions
+    print(f"Read {len(ways.way_id)} ways with {len(ways.refs)} nodes in {time.perf_counter() - started:.0f}s")
+
+    topology = build_topology(ways)
+    edge_count, vertex_count = len(topology.edge_way), len(topology.vertex_osm_id)
+    topology, component = keep_largest_component(topology)
+    print(
+        f"Split into {edge_count} edges and {vertex_count} vertices, kept {len(topology.edge_way)} edges and "
+        f"{len(topology.vertex_osm_id)} vertices of the largest component"
+    )
+
+    order, grid_lon = spatial_order(ways, topology)
+    topology = topology._replace(
+        edge_way=topology.edge_way[order],
+        edge_begin=topology.edge_begin[order],
+        edge_end=topology.edge_end[order],
+        source=topology.source[order],
+        target=topology.target[order],
+    )
+    print(f"Ordered edges along the grid in {time.perf_counter() - started:.0f}s")
+
+    load_into_database(connection, ways, topology, component, (int(grid_lon.min()), int(grid_lon.max())))
+    connection.close()
+    print(f"Import completed in {time.perf_counter() - started:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+"""
+Apply OSM change files (.osc, e.g. the daily diffs of Geofabrik extracts) to the routing tables of an import.
+
+Changed ways are reclassified with the import rules and stored with their nodes in `osm_ways`, moved nodes in
+`osm_nodes`. Only ways touched by the changes are split into edges again: changed ways, ways using a moved node and
+ways sharing a node with a changed way, whose split points may have changed. Their edges in `ways` are replaced,
+with lengths, costs and grid cells computed as on import, and vertices are added and removed as needed.
+
+Connected components are checked only in the grid cells of the replaced edges. Parts of the graph there that are
+connected to edges of other cells are kept, the rest was cut off by the changes (or never connected) and is dropped,
+as the import drops everything outside of the largest component.
+
+Everything is applied in a single transaction, so the routing service keeps answering from the previous state until
+the update commits. The areas of replaced edges are recorded in `map_update_areas`, where app processes pick them up
+to drop cached results in these areas (see app/src/map_updates.py).
+
+Usage:
+    python update_osm.py --dbname routing /data/updates/mazowieckie/*.osc.gz
+"""
+
+import argparse
+import os
+import time
+from typing import Any, NamedTuple
+
+import numpy as np
+import osmium
+import psycopg2
+from import_osm import (
+    ROAD_TYPES,
+    RegionWays,
+    TagRule,
+    build_topology,
+    classify_road_type,
+    connected_components,
+    copy_csv,
+    copy_edges,
+    copy_vertices,
+    load_mapconfig,
+    match_rule,
+    one_way,
+)
+
+# any constant, held for the whole transaction so two updates never run at the same time
+UPDATE_LOCK_ID = 4_204_601
+
+CREATE_UPDATE_TABLES = """
+CREATE TABLE IF NOT EXISTS map_updates (
+    id serial PRIMARY KEY,
+    applied_at timestamptz NOT NULL DEFAULT now(),
+    files text[] NOT NULL,
+    ways_changed integer,
+    nodes_changed integer,
+    edges_removed integer,
+    edges_added integer
+);
+CREATE TABLE IF NOT EXISTS map_update_areas (
+    update_id integer NOT NULL REFERENCES map_updates (id),
+    min_lat double precision NOT NULL,
+    min_lon double precision NOT NULL,
+    max_lat double precision NOT NULL,
+    max_lon double precision NOT NULL
+);
+CREATE INDEX IF NOT EXISTS map_update_areas_update_id ON map_update_areas (update_id);
+"""
+
+
+class WayVersion(NamedTuple):
+    tags: dict[str, str]
+    nodes: list[int]
+
+
+class ChangeSet(NamedTuple):
+    # latest location of every changed node, None if the node was deleted
+    nodes: dict[int, tuple[float, float] | None]
+    # latest version of every changed way, None if the way was deleted
+    ways: dict[int, WayVersion | None]
+
+
+class _ChangeReader(osmium.SimpleHandler):
+    def __init__(self, changes: ChangeSet) -> None:
+        super().__init__()
+        self.changes = changes
+        self._node_versions: dict[int, int] = {}
+        self._way_versions: dict[int, int] = {}
+
+    @staticmethod
+    def _is_newest(versions: dict[int, int], element: Any) -> bool:
+        if element.version < versions.get(element.id, 0):
+            return False
+        versions[element.id] = element.version
+        return True
+
+    def node(self, node: Any) -> None:
+        if not self._is_newest(self._node_versions, node):
+            return
+        if node.deleted or not node.location.valid():
+            self.changes.nodes[node.id] = None
+        else:
+            self.changes.nodes[node.id] = (node.location.lon, node.location.lat)
+
+    def way(self, way: Any) -> None:
+        if not self._is_newest(self._way_versions, way):
+            return
+        if way.deleted:
+            self.changes.ways[way.id] = None
+        else:
+            self.changes.ways[way.id] = WayVersion({tag.k: tag.v for tag in way.tags}, [node.ref for node in way.nodes])
+
+
+def read_changes(paths: list[str]) -> ChangeSet:
+    """
+    Read change files, keeping the highest version of every element.
+
+    Elements near region borders appear in the diffs of several regions, so the order of the files doesn't matter.
+    Of equal versions the one read last is kept.
+    """
+    changes = ChangeSet({}, {})
+    reader = _ChangeReader(changes)
+    for path in paths:
+        reader.apply_file(path)
+    return changes
+
+
+def _accepted_ways(changes: ChangeSet, rules: list[TagRule]) -> dict[int, tuple[TagRule, WayVersion]]:
+    """Changed ways which are routable after the changes, the rest is removed."""
+    accepted = {}
+    for way_id, version in changes.ways.items():
+        if version is None or len(version.nodes) < 2:
+            continue
+        rule = match_rule(rules, version.tags)
+        if rule is not None:
+            accepted[way_id] = (rule, version)
+    return accepted
+
+
+def _warn_missing_nodes(cursor: Any, accepted: dict[int, tuple[TagRule, WayVersion]], refs: list[int]) -> None:
+    """
+    Report changed ways with nodes of unknown location.
+
+    Only nodes of routable ways are stored on import, so a way which becomes routable through a change of its tags
+    alone uses nodes which are neither in the change files nor in `osm_nodes`. These nodes are left out of its edges,
+    as nodes outside of the extract are on import, until the database is imported again.
+    """
+    cursor.execute(
+        "SELECT ref FROM unnest(%s::bigint[]) AS ref WHERE NOT EXISTS (SELECT 1 FROM osm_nodes WHERE id = ref)",
+        (refs,),
+    )
+    missing = {row[0] for row in cursor.fetchall()}
+    if not missing:
+        return
+    way_ids = [way_id for way_id, (_, version) in accepted.items() if missing.intersection(version.nodes)]
+    print(
+        f"WARNING: {len(way_ids)} changed ways use {len(missing)} nodes of unknown location, e.g. ways "
+        f"{', '.join(map(str, way_ids[:10]))}. Their edges leave these nodes out, import the database again to fix them"
+    )
+
+
+def _update_osm_elements(cursor: Any, changes: ChangeSet, rules: list[TagRule]) -> tuple[set[int], set[int]]:
+    """
+    Apply changes to `osm_ways` and `osm_nodes`.
+
+    Returns:
+        Ids of nodes whose ways have to be split again: moved nodes and nodes of changed ways, before and after the
+        changes, and ids of changed ways which were or are routable
+    """
+    accepted = _accepted_ways(changes, rules)
+    cursor.execute(
+        "CREATE TEMP TABLE changed_nodes (id bigint, lon double precision, lat double precision) ON COMMIT DROP"
+    )
+    copy_csv(
+        cursor,
+        "changed_nodes",
+        ["id", "lon", "lat"],
+        ((node_id, *location) for node_id, location in changes.nodes.items() if location is not None),
+    )
+    cursor.execute(
+        "UPDATE osm_nodes n SET lon = c.lon, lat = c.lat FROM changed_nodes c WHERE n.id = c.id RETURNING n.id"
+    )
+    touched = {row[0] for row in cursor.fetchall()}
+    # nodes of routable ways only, other nodes can't be used by routable ways
+    new_refs = sorted({node for _, version in accepted.values() for node in version.nodes})
+    cursor.execute(
+        """
+        INSERT INTO osm_nodes (id, lon, lat)
+        SELECT id, lon, lat FROM changed_nodes WHERE id = ANY(%s)
+        ON CONFLICT (id) DO NOTHING
+        """,
+        (new_refs,),
+    )
+    _warn_missing_nodes(cursor, accepted, new_refs)
+    deleted_nodes = [node_id for node_id, location in changes.nodes.items() if location is None]
+    cursor.execute("DELETE FROM osm_nodes WHERE id = ANY(%s)", (deleted_nodes,))
+
+    cursor.execute("DELETE FROM osm_ways WHERE osm_id = ANY(%s) RETURNING osm_id, nodes", (list(changes.ways),))
+    # most changed ways are buildings and the like, which were never stored
+    changed_ways = set(accepted)
+    for way_id, nodes in cursor.fetchall():
+        changed_ways.add(way_id)
+        touched.update(nodes)
+    touched.update(new_refs)
+    copy_csv(
+        cursor,
+        "osm_ways",
+        ["osm_id", "tag_id", "priority", "road_type", "one_way", "name", "nodes"],
+        (
+            (
+                way_id,
+                rule.tag_id,
+                rule.priority,
+                classify_road_type(version.tags),
+                one_way(version.tags),
+                version.tags.get("name"),
+                "{" + ",".join(map(str, version.nodes)) + "}",
+            )
+            for way_id, (rule, version) in accepted.items()
+        ),
+    )
+    return touched, changed_ways
+
+
+def _load_ways(cursor: Any, way_ids: list[int]) -> RegionWays:
+    """Ways with their nodes, leaving out nodes without a location as the import does."""
+    cursor.execute(
+        "SELECT osm_id, tag_id, priority, road_type::text, one_way, name, nodes FROM osm_ways WHERE osm_id = ANY(%s)",
+        (way_ids,),
+    )
+    rows = cursor.fetchall()
+    refs = np.array([node for row in rows for node in row[6]], dtype=np.int64)
+    cursor.execute("SELECT id, lon, lat FROM osm_nodes WHERE id = ANY(%s)", (np.unique(refs).tolist(),))
+    locations = {node_id: (lon, lat) for node_id, lon, lat in cursor.fetchall()}
+
+    kept_rows, kept_nodes = [], []
+    for row in rows:
+        nodes = [node for node in row[6] if node in locations]
+        if len(nodes) >= 2:
+            kept_rows.append(row)
+            kept_nodes.append(nodes)
+    refs = np.array([node for nodes in kept_nodes for node in nodes], dtype=np.int64)
+    coordinates = np.array([locations[node] for node in refs.tolist()], dtype=np.float64).reshape(-1, 2)
+    road_type_codes = {road_type: code for code, road_type in enumerate(ROAD_TYPES)}
+    return RegionWays(
+        way_id=np.array([row[0] for row in kept_rows], dtype=np.int64),
+        tag_id=np.array([row[1] for row in kept_rows], dtype=np.int32),
+        priority=np.array([row[2] for row in kept_rows], dtype=np.float64),
+        road_type=np.array([road_type_codes[row[3]] for row in kept_rows], dtype=np.int8),
+        one_way=np.array([row[4] for row in kept_rows], dtype=np.int8),
+        name=[row[5] for row in kept_rows],
+        offsets=np.concatenate([[0], np.cumsum([len(nodes) for nodes in kept_nodes], dtype=np.int64)]),
+        refs=refs,
+        lon=coordinates[:, 0],
+        lat=coordinates[:, 1],
+    )
+
+
+def _junctions(cursor: Any, refs: np.ndarray) -> np.ndarray:
+    """Sorted ids of the given nodes used more than once by all stored ways."""
+    node_ids = np.unique(refs).tolist()
+    cursor.execute(
+        """
+        SELECT node
+        FROM osm_ways, unnest(nodes) AS node
+        WHERE nodes && %(nodes)s::bigint[] AND node = ANY(%(nodes)s)
+        GROUP BY node
+        HAVING count(*) > 1
+        ORDER BY node
+        """,
+        {"nodes": node_ids},
+    )
+    return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+
+def _cell_areas(cursor: Any, where: str, params: dict[str, Any]) -> dict[tuple[int, int], list[float]]:
+    cursor.execute(
+        f"""
+        SELECT grid_lon, grid_lat, min(ST_YMin(the_geom)), min(ST_XMin(the_geom)), max(ST_YMax(the_geom)),
+            max(ST_XMax(the_geom))
+        FROM ways
+        WHERE {where}
+        GROUP BY grid_lon, grid_lat
+        """,
+        params,
+    )
+    return {(int(row[0]), int(row[1])): list(row[2:]) for row in cursor.fetchall()}
+
+
+def _merge_areas(areas: dict[tuple[int, int], list[float]], other: dict[tuple[int, int], list[float]]) -> None:
+    for cell, (min_lat, min_lon, max_lat, max_lon) in other.items():
+        if cell in areas:
+            area = areas[cell]
+            areas[cell] = [min(area[0], min_lat), min(area[1], min_lon), max(area[2], max_lat), max(area[3], max_lon)]
+        else:
+            areas[cell] = [min_lat, min_lon, max_lat, max_lon]
+
+
+def _drop_disconnected(cursor: Any, cells: list[tuple[int, int]]) -> tuple[int, list[int]]:
+    """
+    Drop edges of the given grid cells which aren't connected to edges of other cells.
+
+    Returns:
+        Number of dropped edges and the vertices they used
+    """
+    cell_params = {"cell_lons": [cell[0] for cell in cells], "cell_lats": [cell[1] for cell in cells]}
+    cursor.execute(
+        """
+        SELECT gid, source, target
+        FROM ways JOIN unnest(%(cell_lons)s::numeric[], %(cell_lats)s::numeric[]) AS cell(lon, lat)
+            ON grid_lon = cell.lon AND grid_lat = cell.lat
+        """,
+        cell_params,
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return 0, []
+    gid, source, target = (np.array(column, dtype=np.int64) for column in zip(*rows))
+    vertex_ids, inverse = np.unique(np.concatenate([source, target]), return_inverse=True)
+    labels = connected_components(inverse[: len(gid)] + 1, inverse[len(gid) :] + 1, len(vertex_ids))
+
+    # vertices also used by edges of other cells connect their component to the rest of the graph
+    cursor.execute(
+        """
+        WITH cell(lon, lat) AS (SELECT * FROM unnest(%(cell_lons)s::numeric[], %(cell_lats)s::numeric[]))
+        SELECT DISTINCT vertex
+        FROM (
+            SELECT source AS vertex, grid_lon, grid_lat FROM ways WHERE source = ANY(%(vertices)s)
+            UNION ALL
+            SELECT target, grid_lon, grid_lat FROM ways WHERE target = ANY(%(vertices)s)
+        ) AS edge
+        WHERE NOT EXISTS (SELECT 1 FROM cell WHERE cell.lon = edge.grid_lon AND cell.lat = edge.grid_lat)
+        """,
+        {**cell_params, "vertices": vertex_ids.tolist()},
+    )
+    boundary = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+    connected = np.unique(labels[np.searchsorted(vertex_ids, boundary)])
+    if not len(connected):
+        cursor.execute(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM ways
+                WHERE (grid_lon, grid_lat) NOT IN (
+                    SELECT * FROM unnest(%(cell_lons)s::numeric[], %(cell_lats)s::numeric[])
+                )
+            )
+            """,
+            cell_params,
+        )
+        if not cursor.fetchone()[0]:
+            # the cells hold the whole graph, keep its largest component as the import does
+            connected = np.array([np.bincount(labels).argmax()])
+
+    dropped = ~np.isin(labels[inverse[: len(gid)]], connected)
+    if not dropped.any():
+        return 0, []
+    cursor.execute("DELETE FROM ways WHERE gid = ANY(%s)", (gid[dropped].tolist(),))
+    return int(dropped.sum()), np.unique(np.concatenate([source[dropped], target[dropped]])).tolist()
+
+
+def apply_changes(connection: Any, changes: ChangeSet, files: list[str]) -> None:
+    """
+    Apply changes to the routing tables in a single transaction and record the changed areas.
+
+    Args:
+        connection: psycopg2 connection
+        changes: Changes to apply
+        files: Names of the change files, recorded with the update
+    """
+    with connection, connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (UPDATE_LOCK_ID,))
+        cursor.execute("SELECT to_regclass('osm_ways')")
+        if cursor.fetchone()[0] is None:
+            raise SystemExit("No osm_ways table, the database has to be imported with import_osm.py first")
+        cursor.execute(CREATE_UPDATE_TABLES)
+        cursor.execute("SELECT component FROM ways WHERE component IS NOT NULL LIMIT 1")
+        row = cursor.fetchone()
+        component = row[0] if row is not None else 1
+
+        touched, changed_ways = _update_osm_elements(cursor, changes, load_mapconfig())
+        cursor.execute("SELECT osm_id FROM osm_ways WHERE nodes && %s::bigint[]", (sorted(touched),))
+        affected = [row[0] for row in cursor.fetchall()]
+        # removed ways are no longer in osm_ways, their edges go too
+        affected_edges = sorted(set(affected) | changed_ways)
+        print(
+            f"{len(changes.ways)} ways and {len(changes.nodes)} nodes changed, {len(changed_ways)} routable ways "
+            f"changed, splitting {len(affected)} ways"
+        )
+
+        areas = _cell_areas(cursor, "osm_id = ANY(%(ways)s)", {"ways": affected_edges})
+        cursor.execute("DELETE FROM ways WHERE osm_id = ANY(%s) RETURNING source, target", (affected_edges,))
+        old_edges = cursor.fetchall()
+        orphan_candidates = {vertex for edge in old_edges for vertex in edge}
+
+        ways = _load_ways(cursor, affected)
+        topology = build_topology(ways, _junctions(cursor, ways.refs))
+
+        # existing vertices keep their ids and follow moved nodes, new ones are numbered after the last one
+        cursor.execute(
+            """
+            UPDATE ways_vertices_pgr v
+            SET lon = c.lon, lat = c.lat, the_geom = ST_SetSRID(ST_MakePoint(c.lon, c.lat), 4326)
+            FROM changed_nodes c
+            WHERE v.osm_id = c.id
+            """
+        )
+        cursor.execute(
+            "SELECT osm_id, id FROM ways_vertices_pgr WHERE osm_id = ANY(%s)", (topology.vertex_osm_id.tolist(),)
+        )
+        existing = dict(cursor.fetchall())
+        cursor.execute("SELECT coalesce(max(id), 0) FROM ways_vertices_pgr")
+        next_vertex_id = cursor.fetchone()[0] + 1
+        missing = np.array([osm_id not in existing for osm_id in topology.vertex_osm_id.tolist()], dtype=bool)
+        vertex_ids = np.array([existing.get(osm_id, 0) for osm_id in topology.vertex_osm_id.tolist()], dtype=np.int64)
+        vertex_ids[missing] = np.arange(next_vertex_id, next_vertex_id + missing.sum())
+        copy_vertices(
+            cursor,
+            topology._replace(
+                vertex_osm_id=topology.vertex_osm_id[missing],
+                vertex_lon=topology.vertex_lon[missing],
+                vertex_lat=topology.vertex_lat[missing],
+            ),
+            vertex_ids[missing],
+            component,
+        )
+
+        cursor.execute("SELECT coalesce(max(gid), 0) FROM ways")
+        first_gid = cursor.fetchone()[0] + 1
+        topology = topology._replace(source=vertex_ids[topology.source - 1], target=vertex_ids[topology.target - 1])
+        copy_edges(cursor, ways, topology, first_gid, component)
+        _merge_areas(areas, _cell_areas(cursor, "gid >= %(first_gid)s", {"first_gid": first_gid}))
+
+        dropped, dropped_vertices = _drop_disconnected(cursor, sorted(areas))
+        orphan_candidates.update(dropped_vertices)
+        cursor.execute(
+            """
+            DELETE FROM ways_vertices_pgr v
+            WHERE id = ANY(%s)
+                AND NOT EXISTS (SELECT 1 FROM ways WHERE source = v.id)
+                AND NOT EXISTS (SELECT 1 FROM ways WHERE target = v.id)
+            """,
+            (sorted(orphan_candidates),),
+        )
+        removed_vertices = cursor.rowcount
+
+        cursor.execute(
+            """
+            INSERT INTO map_updates (files, ways_changed, nodes_changed, edges_removed, edges_added)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (files, len(changes.ways), len(changes.nodes), len(old_edges) + dropped, len(topology.edge_way)),
+        )
+        update_id = cursor.fetchone()[0]
+        copy_csv(
+            cursor,
+            "map_update_areas",
+            ["update_id", "min_lat", "min_lon", "max_lat", "max_lon"],
+            ((update_id, *area) for area in areas.values()),
+        )
+        print(
+            f"Replaced {len(old_edges)} edges with {len(topology.edge_way)} in {len(areas)} grid cells, dropped "
+            f"{dropped} disconnected edges, added {missing.sum()} and removed {removed_vertices} vertices"
+        )
+
+
+def applied_files(connection: Any) -> set[str]:
+    """Change files recorded by earlier updates."""
+    with connection, connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('map_updates')")
+        if cursor.fetchone()[0] is None:
+            return set()
+        cursor.execute("SELECT unnest(files) FROM map_updates")
+        return {row[0] for row in cursor.fetchall()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply OSM change files to the routing tables")
+    parser.add_argument("files", nargs="+", help=".osc or .osc.gz change files, applied in the given order")
+    parser.add_argument("--dbname", default="routing")
+    parser.add_argument("--force", action="store_true", help="Apply files recorded by earlier updates again")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    # connection parameters come from PGHOST, PGUSER, PGPASSWORD etc.
+    connection = psycopg2.connect(dbname=args.dbname)
+    applied = set() if args.force else applied_files(connection)
+    files = [os.path.abspath(path) for path in args.files if os.path.abspath(path) not in applied]
+    if not files:
+        print("All change files were applied already")
+        return
+
+    changes = read_changes(files)
+    print(f"Read {len(files)} change files in {time.perf_counter() - started:.0f}s")
+    apply_changes(connection, changes, files)
+    connection.close()
+    print(f"Update completed in {time.perf_counter() - started:.0f}s")
+
+
+if __name__ == "__main__":
+    main()